@@ -25,9 +25,9 @@ from langchain_core.runnables import RunnableConfig
 from langchain_core.tools import tool
 from langchain_google_vertexai import ChatVertexAI, VertexAIEmbeddings
 from langgraph.graph import END, MessagesState, StateGraph
-from langgraph.prebuilt import ToolNode
 from app.templates import rag_template, format_docs, inspect_conversation_template
 from app.retrievers import get_retriever, get_compressor
+from app.utils.tool_executor import ConcurrentToolNode
 
 EMBEDDING_MODEL = "text-embedding-004"
 LLM_MODEL = "gemini-1.5-flash-002"
@@ -125,7 +125,7 @@ workflow.set_entry_point("agent")
 
 workflow.add_node(
     "tools",
-    ToolNode(
+    ConcurrentToolNode(
         tools=tools,
         # With False, tool errors won't be caught by LangGraph
         handle_tool_errors=False,
@@ -15,12 +15,12 @@
 
 from typing import Dict
 
+from app.utils.tool_executor import ConcurrentToolNode
 from langchain_core.messages import BaseMessage
 from langchain_core.runnables import RunnableConfig
 from langchain_core.tools import tool
 from langchain_google_vertexai import ChatVertexAI
 from langgraph.graph import END, MessagesState, StateGraph
-from langgraph.prebuilt import ToolNode
 
 LOCATION = "us-central1"
 LLM = "gemini-1.5-pro-002"
@@ -64,7 +64,7 @@ def call_model(state: MessagesState, config: RunnableConfig) -> Dict[str, BaseMe
 # 4. Create the workflow graph
 workflow = StateGraph(MessagesState)
 workflow.add_node("agent", call_model)
-workflow.add_node("tools", ToolNode(tools))
+workflow.add_node("tools", ConcurrentToolNode(tools))
 workflow.set_entry_point("agent")
 
 # 5. Define graph edges
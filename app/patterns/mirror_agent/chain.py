@@ -1,56 +1,120 @@
 import os
-from typing import Any, Dict, List, Union, Optional
+import tempfile
+import time
+from typing import Annotated, Any, Dict, List
 
 import google.auth
 import vertexai
-from langchain_core.messages import AIMessage
 from langchain_core.messages import (
-    BaseMessage, HumanMessage, AIMessage, SystemMessage
+    AnyMessage,
+    BaseMessage,
+    HumanMessage,
+    AIMessage,
+    SystemMessage,
+    ToolMessage,
 )
 from pydantic import BaseModel
 from langchain_core.runnables import RunnableConfig
 from langchain_core.tools import tool
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_google_vertexai import ChatVertexAI
-from langgraph.graph import END, StateGraph
-from langgraph.prebuilt import ToolNode
+from langgraph.constants import TAG_NOSTREAM
+from langgraph.graph import END, StateGraph, add_messages
+from langgraph.utils.runnable import RunnableCallable
+
+from app.patterns.mirror_agent.user_docs import search_user_docs
+from app.utils.digest_store import DigestStore
+from app.utils.history import HistoryManager
+from app.utils.tool_executor import ConcurrentToolNode
+from app.utils.tool_loop import ToolLoop, tool_calls_of
+
+LOCATION = "us-central1"
+LLM = "gemini-2.0-flash-exp"
+# Token budget of the recent history sent verbatim, older turns being folded
+# into a summary at least HISTORY_FOLD_TOKENS at a time
+HISTORY_MAX_TOKENS = int(os.environ.get("MIRROR_HISTORY_MAX_TOKENS", "4000"))
+HISTORY_FOLD_TOKENS = int(os.environ.get("MIRROR_HISTORY_FOLD_TOKENS", "1000"))
+# Rounds of tool calls per user message, after which the model has to answer
+MAX_TOOL_ROUNDS = int(os.environ.get("MIRROR_MAX_TOOL_ROUNDS", "3"))
+# Deadline of a tool call, after which the model gets an error instead
+TOOL_TIMEOUT_SECONDS = float(os.environ.get("MIRROR_TOOL_TIMEOUT_SECONDS", "10"))
+# Digests of the recent sessions of each user, read by reflect_on_recent_interactions
+DIGEST_PATH = os.environ.get(
+    "MIRROR_DIGEST_PATH", os.path.join(tempfile.gettempdir(), "mirror_digests.sqlite")
+)
+DIGEST_MAX_SESSIONS = int(os.environ.get("MIRROR_DIGEST_MAX_SESSIONS", "20"))
+DIGEST_TOP_K = int(os.environ.get("MIRROR_DIGEST_TOP_K", "3"))
+
 
 class MirrorAgentState(BaseModel):
-    messages: List[Union[SystemMessage, HumanMessage, AIMessage]] = []
+    # The server passes message objects, which are kept as they are. The union
+    # is discriminated by message type, so tool results validate as well.
+    # Nodes return their new messages, which are appended to the history.
+    messages: Annotated[List[AnyMessage], add_messages] = []
+    # Rolling summary of the turns older than the history window
     memory: Dict[str, Any] = {}
+    # Model and tool calls made by the run
+    llm_calls: int = 0
+    tool_calls: int = 0
+
 
 @tool
-def retrieve_user_docs(query: str) -> str:
+def retrieve_user_docs(query: str, config: RunnableConfig) -> str:
     """Retrieve relevant user documents based on the query.
-    
+
     Args:
         query: The search query to find relevant documents.
-        
+
     Returns:
         str: The retrieved document content or search results.
     """
-    return f"Retrieved docs for query: {query}"
+    # The server passes the user of the request in the run config; the index
+    # is searched in process
+    user_id = config.get("configurable", {}).get("user_id")
+    return search_user_docs(user_id, query)
+
 
 @tool
-def reflect_on_recent_interactions(context: str) -> str:
+def reflect_on_recent_interactions(context: str, config: RunnableConfig) -> str:
     """Analyze and reflect on recent user interactions to provide insights.
-    
+
     Args:
         context: The context or topic to reflect upon.
-        
+
     Returns:
         str: Reflective insights based on the context.
     """
-    return f"Reflecting on: {context}"
+    # The digests of the other sessions of the user are maintained in the
+    # background as turns end, so they are only read and ranked here
+    configurable = config.get("configurable", {})
+    user_id = configurable.get("user_id")
+    digests = (
+        interaction_digests.recent(
+            user_id, context, k=DIGEST_TOP_K, exclude=configurable.get("session_id")
+        )
+        if user_id
+        else []
+    )
+    if not digests:
+        return "No earlier interactions with the user are available."
+    return "\n\n".join(
+        f"Session {digest.session_id}, "
+        f"{time.strftime('%Y-%m-%d', time.gmtime(digest.updated_at))}:\n"
+        f"{digest.summary}"
+        for digest in digests
+    )
+
 
 credentials, project_id = google.auth.default()
 vertexai.init(project=project_id)
 
 # Initialize with system message
-system_message = SystemMessage(content=(
-    "You are a wise and helpful mirror agent. You use a Socratic style, "
-    "helping the user to know themselves better."
-))
+system_message = SystemMessage(
+    content=(
+        "You are a wise and helpful mirror agent. You use a Socratic style, "
+        "helping the user to know themselves better."
+    )
+)
 
 mirror_system_prompt = ChatPromptTemplate.from_messages(
     [
@@ -60,24 +124,63 @@ mirror_system_prompt = ChatPromptTemplate.from_messages(
 )
 
 mirror_llm = ChatVertexAI(
-    model_name="gemini-2.0-flash-exp",
-    location="us-central1",
+    model_name=LLM,
+    location=LOCATION,
     temperature=0.7,
     max_output_tokens=4096,
     streaming=True,
 )
 
+# The model decides whether to call a tool or answer. Once the tool budget of
+# the run is spent, it is called without tools and has to answer.
 mirror_agent = mirror_system_prompt | mirror_llm.bind_tools(
-    [retrieve_user_docs, reflect_on_recent_interactions],
-    tool_choice="any"
+    [retrieve_user_docs, reflect_on_recent_interactions], tool_choice="auto"
+)
+mirror_agent_final = mirror_system_prompt | mirror_llm
+
+tool_loop = ToolLoop(max_tool_rounds=MAX_TOOL_ROUNDS)
+
+summary_prompt = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            (
+                "You maintain a summary of a conversation between a user and a "
+                "Socratic mirror agent. Extend the current summary with the new "
+                "lines of the conversation, keeping what the user revealed about "
+                "themselves, their goals and open questions. Answer with the "
+                "summary only."
+            ),
+        ),
+        ("human", "Current summary:\n{summary}\n\nNew lines:\n{conversation}"),
+    ]
+)
+
+# Summaries are internal: runs tagged nostream are not sent to the client
+history_manager = HistoryManager(
+    (summary_prompt | mirror_llm).with_config(
+        run_name="summarize_history", tags=[TAG_NOSTREAM]
+    ),
+    max_tokens=HISTORY_MAX_TOKENS,
+    fold_tokens=HISTORY_FOLD_TOKENS,
+)
+
+# Session digests are folded with the same prompt, off the request path
+interaction_digests = DigestStore(
+    DIGEST_PATH,
+    (summary_prompt | mirror_llm).with_config(
+        run_name="digest_session", tags=[TAG_NOSTREAM]
+    ),
+    max_sessions=DIGEST_MAX_SESSIONS,
 )
 
-def mirror_agent_node(state: MirrorAgentState, config: RunnableConfig) -> Dict[str, Any]:
-    """Process the current state and generate a response."""
+
+def _chat_history(state: MirrorAgentState) -> List[BaseMessage]:
+    """Build the chat history sent to the model from the graph state."""
     # Convert any BaseMessage items (if they slipped in) to recognized roles.
     chat_history = []
     for msg in state.messages:
-        if isinstance(msg, (SystemMessage, HumanMessage, AIMessage)):
+        if isinstance(msg, (SystemMessage, HumanMessage, AIMessage, ToolMessage)):
             if isinstance(msg, HumanMessage) and hasattr(msg, "additional_kwargs"):
                 # Remove leftover tool_calls from an otherwise valid HumanMessage
                 msg.additional_kwargs.pop("tool_calls", None)
@@ -90,48 +193,125 @@ def mirror_agent_node(state: MirrorAgentState, config: RunnableConfig) -> Dict[s
 
             # Fallback: treat unknown message type as user input
             chat_history.append(HumanMessage(content=str(msg.content)))
+    return chat_history
 
-    response_or_responses = mirror_agent.invoke({"chat_history": chat_history}, config)
 
+def _new_messages(response_or_responses: Any) -> List[BaseMessage]:
+    """Return the messages to append to the conversation for a model response."""
     # Sometimes the agent returns a single message, sometimes a list.
-    # Append to our conversation properly.
+    new_messages: List[BaseMessage] = []
     if isinstance(response_or_responses, BaseMessage):
-        state.messages.append(response_or_responses)
+        new_messages.append(response_or_responses)
     elif isinstance(response_or_responses, list):
         for r in response_or_responses:
             if isinstance(r, BaseMessage):
-                state.messages.append(r)
+                new_messages.append(r)
             else:
                 # Fallback if a tool returns a raw string or something else
-                state.messages.append(AIMessage(content=str(r)))
+                new_messages.append(AIMessage(content=str(r)))
+    return new_messages
+
+
+def _agent_for(state: MirrorAgentState) -> Any:
+    """Pick the agent with tools while the tool budget of the run lasts."""
+    return (
+        mirror_agent if tool_loop.tools_allowed(state.llm_calls) else mirror_agent_final
+    )
+
+
+def _record_digest(
+    state: MirrorAgentState, new_messages: List[BaseMessage], config: RunnableConfig
+) -> None:
+    """Queue the digest update of the session once the agent has answered."""
+    configurable = config.get("configurable", {})
+    user_id, session_id = configurable.get("user_id"), configurable.get("session_id")
+    if user_id and session_id and new_messages and not tool_calls_of(new_messages[-1]):
+        interaction_digests.record(
+            user_id, session_id, [*state.messages, *new_messages]
+        )
+
+
+def _update(
+    state: MirrorAgentState,
+    response_or_responses: Any,
+    memory: Dict[str, Any],
+    config: RunnableConfig,
+) -> Dict[str, Any]:
+    """Build the state update of a model call."""
+    new_messages = _new_messages(response_or_responses)
+    _record_digest(state, new_messages, config)
+    return {
+        "messages": new_messages,
+        **tool_loop.count(state.llm_calls, state.tool_calls, new_messages),
+        "memory": memory,
+    }
+
+
+def mirror_agent_node(
+    state: MirrorAgentState, config: RunnableConfig
+) -> Dict[str, Any]:
+    """Process the current state and generate a response, for `invoke`."""
+    chat_history, memory = history_manager.window(
+        _chat_history(state), state.memory, config
+    )
+    response_or_responses = _agent_for(state).invoke(
+        {"chat_history": chat_history}, config
+    )
+    return _update(state, response_or_responses, memory, config)
+
+
+async def amirror_agent_node(
+    state: MirrorAgentState, config: RunnableConfig
+) -> Dict[str, Any]:
+    """
+    Process the current state and generate a response, for `ainvoke` and
+    `astream_events`.
+
+    The model call is awaited on the event loop instead of holding a worker
+    thread for its whole latency. The model is built with `streaming=True`,
+    so its tokens reach the event stream as they are generated.
+    """
+    chat_history, memory = await history_manager.awindow(
+        _chat_history(state), state.memory, config
+    )
+    response_or_responses = await _agent_for(state).ainvoke(
+        {"chat_history": chat_history}, config
+    )
+    return _update(state, response_or_responses, memory, config)
 
-    return {"messages": state.messages}
 
 mirror_workflow = StateGraph(MirrorAgentState)
-mirror_workflow.add_node("mirror_agent", mirror_agent_node)
-mirror_workflow.add_node("tools", ToolNode(tools=[retrieve_user_docs, reflect_on_recent_interactions]))
+# The graph runs the coroutine when it is run asynchronously, as by the server
+mirror_workflow.add_node(
+    "mirror_agent",
+    RunnableCallable(
+        mirror_agent_node, amirror_agent_node, name="mirror_agent", trace=False
+    ),
+)
+# The tool calls of a response run concurrently, each within its deadline
+mirror_workflow.add_node(
+    "tools",
+    ConcurrentToolNode(
+        tools=[retrieve_user_docs, reflect_on_recent_interactions],
+        timeout=TOOL_TIMEOUT_SECONDS,
+    ),
+)
 mirror_workflow.set_entry_point("mirror_agent")
 
-def should_call_tools(state: MirrorAgentState) -> bool:
-    """Check if we should call tools based on the last message."""
-    if not state.messages:
-        return False
-    
-    last_msg = state.messages[-1]
-    if not isinstance(last_msg, AIMessage):
-        return False
-        
-    # Safely check for tool_calls
-    tool_calls = getattr(last_msg, "additional_kwargs", {}).get("tool_calls", [])
-    return bool(tool_calls)
+
+def should_call_tools(state: MirrorAgentState) -> str:
+    """Route to the tools if the model called any and the budget allows it."""
+    return tool_loop.route(state.messages, state.llm_calls)
+
 
 # Add edges with proper tool call handling
 mirror_workflow.add_conditional_edges(
     "mirror_agent",
-    lambda x: "tools" if should_call_tools(x) else END
+    should_call_tools,
+    ["tools", END],
 )
 
 # After tools, return to the agent for another round
 mirror_workflow.add_edge("tools", "mirror_agent")
 
-chain = mirror_workflow.compile()
\ No newline at end of file
+chain = mirror_workflow.compile()
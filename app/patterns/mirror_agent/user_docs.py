@@ -0,0 +1,84 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The document indexes searched by the mirror agent, and their ingestion.
+
+Each user has a local index under `MIRROR_USER_DOCS_PATH`, searched by the
+`retrieve_user_docs` tool in process. Documents are added, replaced and
+deleted with:
+
+    python -m app.patterns.mirror_agent.user_docs --user-id USER FILE...
+    python -m app.patterns.mirror_agent.user_docs --user-id USER --delete DOC_ID
+"""
+import argparse
+import os
+import tempfile
+from typing import List, Optional, Sequence
+
+from app.utils.doc_index import DocIndexRegistry
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+USER_DOCS_PATH = os.environ.get(
+    "MIRROR_USER_DOCS_PATH", os.path.join(tempfile.gettempdir(), "mirror_user_docs")
+)
+# Chunks returned to the model per search
+USER_DOCS_TOP_K = int(os.environ.get("MIRROR_USER_DOCS_TOP_K", "4"))
+
+user_docs = DocIndexRegistry(USER_DOCS_PATH)
+text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+
+
+def search_user_docs(user_id: Optional[str], query: str) -> str:
+    """Search the documents of a user and format the matches for the model."""
+    # Searching does not create indexes for users without documents
+    if not user_id or not os.path.isdir(user_docs.directory_of(user_id)):
+        return "No user documents are available."
+    results = user_docs.get(user_id).search(query, k=USER_DOCS_TOP_K)
+    if not results:
+        return f"No user documents match the query: {query}"
+    return "\n\n".join(f"[{result.doc_id}]\n{result.text}" for result in results)
+
+
+def add_user_doc(user_id: str, doc_id: str, text: str) -> int:
+    """Split a document into chunks, index them and return their number."""
+    chunks = text_splitter.split_text(text)
+    user_docs.get(user_id).add(doc_id, chunks)
+    return len(chunks)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    """Add files to, or delete documents from, the index of a user."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--user-id", required=True)
+    parser.add_argument("--delete", action="append", default=[], metavar="DOC_ID")
+    parser.add_argument("--compact", action="store_true")
+    parser.add_argument("files", nargs="*", help="Text files, indexed by path.")
+    args = parser.parse_args(argv)
+
+    index = user_docs.get(args.user_id)
+    for doc_id in args.delete:
+        found = index.delete(doc_id)
+        print(f"{'deleted' if found else 'not found'}: {doc_id}")
+    paths: List[str] = args.files
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            count = add_user_doc(args.user_id, path, f.read())
+        print(f"added {count} chunks: {path}")
+    if args.compact:
+        index.compact()
+    print(f"{len(index)} chunks in {user_docs.directory_of(args.user_id)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Multi-process serving of the FastAPI application.
+
+A supervisor process imports the server module unless disabled, binds the
+listening socket and forks the uvicorn workers, which share the socket and
+the preloaded modules. The supervisor restarts workers that exit, and handles
+signals:
+
+    SIGHUP          re-execute the supervisor, which imports the server again
+                    and replaces the workers one at a time: each new worker is
+                    stopped only once its `/ready` route answers
+    SIGTERM/SIGINT  stop the workers gracefully, then exit
+
+Run with:
+    python -m app.serve --workers 4 --port 8080
+
+Only the server module is preloaded, not the chain it serves: each worker
+runs the warm-up of the server lifespan, which loads the chain and creates the
+tracing exporter and Cloud Logging client after the fork, as gRPC channels
+and background threads do not survive one. The admission limits, caches and
+metrics of the server are per worker.
+
+Each worker also listens on a private Unix socket, through which the
+supervisor polls `/ready`. Applications without that route, which answer
+`404`, are ready once they answer; `503` means warming up.
+"""
+import argparse
+import importlib
+import logging
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Sequence, Set
+
+import uvicorn
+
+logger = logging.getLogger(__name__)
+
+
+def default_workers() -> int:
+    """The worker count from WEB_CONCURRENCY, or one per CPU."""
+    return int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+
+
+class Supervisor:
+    """Forks uvicorn workers on a shared socket and keeps them running."""
+
+    def __init__(
+        self,
+        app: str,
+        sock: socket.socket,
+        workers: int,
+        graceful_timeout: float = 30.0,
+        preload: bool = True,
+        ready_timeout: float = 300.0,
+        argv: Optional[Sequence[str]] = None,
+        adopted: Sequence[int] = (),
+    ) -> None:
+        """
+        Initialize the supervisor.
+
+        Args:
+            app: Import path of the ASGI application, as `module:attribute`.
+            sock: The bound listening socket shared by the workers.
+            workers: Number of worker processes.
+            graceful_timeout: Time given to a worker to finish its requests
+                when stopped, after which it is killed.
+            preload: Import the server module before forking.
+            ready_timeout: Time given to a new worker to become ready during
+                a reload, after which the old worker is kept.
+            argv: Command line executed again on reload, with the listening
+                socket and the running workers appended. Without it, a reload
+                forks the new workers from this process, so they only import
+                new code if the server is not preloaded.
+            adopted: Workers started before the supervisor was executed
+                again, replaced by new workers once it has started.
+        """
+        if workers <= 0:
+            raise ValueError("workers must be positive")
+        self.app = app
+        self.sock = sock
+        self.workers = workers
+        self.graceful_timeout = graceful_timeout
+        self.preload = preload
+        self.ready_timeout = ready_timeout
+        self.argv = list(argv) if argv is not None else None
+        self.pids: List[int] = list(adopted)
+        # Private sockets of the workers, named after the supervisor process,
+        # whose pid survives its re-execution
+        self.ready_directory = os.path.join(
+            tempfile.gettempdir(), f"app-serve-{os.getpid()}"
+        )
+        self._ready_paths: Dict[int, str] = {}
+        self._stopping = False
+        self._reload = False
+
+    def load(self) -> None:
+        """Import the server module, to be shared by the workers."""
+        start = time.perf_counter()
+        importlib.import_module(self.app.partition(":")[0])
+        logger.info("Preloaded %s in %.2fs", self.app, time.perf_counter() - start)
+
+    def run(self) -> None:
+        """Start the workers and supervise them until stopped."""
+        if self.preload:
+            self.load()
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        os.makedirs(self.ready_directory, exist_ok=True)
+        if self.pids:
+            # Executed again by a reload: replace the workers of the old code
+            self._rolling_restart()
+        while len(self.pids) < self.workers:
+            self.pids.append(self._spawn())
+        try:
+            while not self._stopping:
+                if self._reload:
+                    self._reload = False
+                    self._reload_workers()
+                self._reap()
+                time.sleep(0.1)
+        finally:
+            self._stop_workers(self.pids)
+            shutil.rmtree(self.ready_directory, ignore_errors=True)
+
+    def _spawn(self) -> int:
+        ready_path = os.path.join(self.ready_directory, f"{time.time_ns()}.sock")
+        ready_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        ready_sock.bind(ready_path)
+        ready_sock.listen(16)
+        pid = os.fork()
+        if pid:
+            ready_sock.close()
+            self._ready_paths[pid] = ready_path
+            logger.info("Started worker %d", pid)
+            return pid
+        # Worker process: uvicorn installs its own shutdown handlers
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        exit_code = 0
+        try:
+            config = uvicorn.Config(
+                self.app,
+                timeout_graceful_shutdown=int(self.graceful_timeout),
+                log_config=None,
+            )
+            uvicorn.Server(config).run(sockets=[self.sock, ready_sock])
+        except BaseException:
+            logger.exception("Worker %d failed", os.getpid())
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def _reap(self) -> None:
+        """Restart the workers that exited."""
+        for pid in list(self.pids):
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done and not self._stopping:
+                logger.warning("Worker %d exited with status %d", pid, status)
+                self._forget(pid)
+                self.pids[self.pids.index(pid)] = self._spawn()
+
+    def _reload_workers(self) -> None:
+        """Replace the workers by workers running the current code."""
+        if self.argv is None:
+            self._rolling_restart()
+            return
+        logger.info("Executing the supervisor again to reload the server")
+        argv = [
+            *self.argv,
+            "--fd",
+            str(self.sock.fileno()),
+            "--adopt",
+            ",".join(str(pid) for pid in self.pids),
+        ]
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # The process keeps its pid, its workers and the listening socket
+        os.execv(sys.executable, [sys.executable, *argv])
+
+    def _rolling_restart(self) -> None:
+        """Replace every worker, keeping the others serving meanwhile."""
+        logger.info("Replacing %d workers", len(self.pids))
+        for index, old_pid in enumerate(list(self.pids)):
+            new_pid = self._spawn()
+            if not self._wait_ready(new_pid):
+                logger.error(
+                    "Worker %d did not become ready, keeping worker %d",
+                    new_pid,
+                    old_pid,
+                )
+                self._stop_workers([new_pid])
+                return
+            self.pids[index] = new_pid
+            self._stop_workers([old_pid])
+
+    def _wait_ready(self, pid: int) -> bool:
+        """Wait for a worker to answer its `/ready` route with another status
+        than 503, and return whether it did."""
+        deadline = time.monotonic() + self.ready_timeout
+        while time.monotonic() < deadline and not self._stopping:
+            if _exited(pid):
+                return False
+            status = _ready_status(self._ready_paths[pid])
+            if status is not None and status != 503:
+                return True
+            time.sleep(0.1)
+        return False
+
+    def _forget(self, pid: int) -> None:
+        """Remove the private socket of a worker that exited."""
+        path = self._ready_paths.pop(pid, None)
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+    def _stop_workers(self, pids: List[int]) -> None:
+        """Stop workers gracefully, killing those outliving the timeout."""
+        for pid in pids:
+            _signal(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout
+        remaining: Set[int] = set(pids)
+        while remaining and time.monotonic() < deadline:
+            remaining -= {pid for pid in remaining if _exited(pid)}
+            time.sleep(0.05)
+        for pid in remaining:
+            logger.warning("Killing worker %d", pid)
+            _signal(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        for pid in pids:
+            self._forget(pid)
+
+    def _on_stop(self, signum: int, frame: Optional[object]) -> None:
+        self._stopping = True
+
+    def _on_reload(self, signum: int, frame: Optional[object]) -> None:
+        self._reload = True
+
+
+def _signal(pid: int, signum: int) -> None:
+    try:
+        os.kill(pid, signum)
+    except ProcessLookupError:
+        pass
+
+
+def _exited(pid: int) -> bool:
+    try:
+        return os.waitpid(pid, os.WNOHANG)[0] != 0
+    except ChildProcessError:
+        return True
+
+
+def _ready_status(path: str) -> Optional[int]:
+    """Return the status of `GET /ready` on a Unix socket, None if unanswered."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(5)
+            sock.connect(path)
+            sock.sendall(
+                b"GET /ready HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n"
+            )
+            with sock.makefile("rb") as response:
+                return int(response.readline().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def bind(host: str, port: int) -> socket.socket:
+    """Create the listening socket shared by the workers."""
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def reload_argv(argv: Sequence[str]) -> List[str]:
+    """Drop the arguments a supervisor passes to itself from a command line."""
+    kept: List[str] = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in ("--fd", "--adopt"):
+            skip = True
+        elif not arg.startswith(("--fd=", "--adopt=")):
+            kept.append(arg)
+    return kept
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Parse the command line and serve the application."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--app", default="app.server:app")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8080)))
+    parser.add_argument("--workers", type=int, default=default_workers())
+    parser.add_argument(
+        "--graceful-timeout",
+        type=float,
+        default=float(os.environ.get("GRACEFUL_TIMEOUT_SECONDS", "30")),
+    )
+    parser.add_argument(
+        "--no-preload",
+        dest="preload",
+        action="store_false",
+        help="Import the server in each worker instead of before forking",
+    )
+    # Passed by the supervisor to itself when executed again on reload
+    parser.add_argument("--fd", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--adopt", default="", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s [%(process)d] %(message)s"
+    )
+    if args.fd is not None:
+        sock = socket.socket(fileno=args.fd)
+    else:
+        sock = bind(args.host, args.port)
+    logger.info(
+        "Serving %s on %s:%d with %d workers",
+        args.app,
+        args.host,
+        args.port,
+        args.workers,
+    )
+    Supervisor(
+        args.app,
+        sock,
+        args.workers,
+        graceful_timeout=args.graceful_timeout,
+        preload=args.preload,
+        argv=(
+            reload_argv(sys.orig_argv[1:])
+            if argv is None
+            else ["-m", "app.serve", *reload_argv(argv)]
+        ),
+        adopted=[int(pid) for pid in args.adopt.split(",") if pid],
+    ).run()
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,92 +14,435 @@
 # pylint: disable=W0718, C0411
 # ruff: noqa: I001
 
+import asyncio
+from contextlib import asynccontextmanager
+import functools
 import json
 import logging
 import os
-from typing import AsyncGenerator
+import tempfile
+import time
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, Optional, Tuple
 import uuid
 
-# Import the mirror agent chain
-from app.patterns.mirror_agent.chain import chain
-
-from app.utils.input_types import Feedback, Input, InputChat, default_serialization
-from app.utils.output_types import EndEvent, Event
-from app.utils.tracing import CloudTraceLoggingSpanExporter
-from fastapi import FastAPI
-from fastapi.responses import RedirectResponse, StreamingResponse
-from google.cloud import logging as google_cloud_logging
+from app.utils.admission import (
+    BATCH,
+    INTERACTIVE,
+    AdmissionController,
+    AdmissionRejected,
+    Permit,
+    release_when_done,
+)
+from app.utils.batch import BatchResult, run_batch
+from app.utils.cache import ResponseCache, make_cache_key
+from app.utils.coalescing import coalesce_chunk_events
+from app.utils.compression import compress_stream, negotiate_encoding
+from app.utils.encoding import NDJSON, WireFormat
+from app.utils.feedback import (
+    CloudLoggingFeedbackBackend,
+    FeedbackSink,
+    LocalFileFeedbackBackend,
+)
+from app.utils.input_types import Feedback, InputChat
+from app.utils.lazy import LazyChain
+from app.utils.metrics import CONTENT_TYPE, Counter, Gauge, Registry, StreamMetrics
+from app.utils.msgpack_encoding import MSGPACK, accepts_msgpack
+from app.utils.request_decoding import (
+    BATCH_OPENAPI_EXTRA,
+    INPUT_OPENAPI_EXTRA,
+    RequestDecoder,
+    parse_body,
+)
+from app.utils.session_store import SessionStore, StaleSessionError
+from app.utils.single_flight import SingleFlight
+from app.utils.streams import aclose
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import (
+    JSONResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
+from langgraph.constants import TAG_NOSTREAM
+from starlette.background import BackgroundTask
 from traceloop.sdk import Instruments, Traceloop
 
-def remove_tool_calls_from_human_messages(messages: list) -> list:
-    """
-    Strip out leftover 'tool_calls' from any HumanMessage in the conversation.
-    This prevents the 'HumanMessage object has no attribute get' error.
-    """
-    from langchain_core.messages import HumanMessage
-    for msg in messages:
-        # If the message is a HumanMessage with leftover tool_calls, remove them
-        if isinstance(msg, HumanMessage) and hasattr(msg, "additional_kwargs"):
-            if "tool_calls" in msg.additional_kwargs:
-                msg.additional_kwargs.pop("tool_calls", None)
-    return messages
-
-async def stream_event_response(input_chat: InputChat) -> AsyncGenerator[str, None]:
-    """Stream events in response to an input chat."""
-    run_id = uuid.uuid4()
-    input_dict = input_chat.model_dump()
 
+def chain_input(input_chat: InputChat, run_id: uuid.UUID) -> Dict[str, Any]:
+    """Build the input of a chain run and associate its traces with the run."""
     Traceloop.set_association_properties(
         {
             "log_type": "tracing",
             "run_id": str(run_id),
-            "user_id": input_dict["user_id"],
-            "session_id": input_dict["session_id"],
+            "user_id": input_chat.user_id,
+            "session_id": input_chat.session_id,
             "commit_sha": os.environ.get("COMMIT_SHA", "None"),
         }
     )
+    # The chain takes the validated message objects as they are: dumping them
+    # to dicts would only have the graph state coerce them back into messages.
+    # Leftover tool calls on human messages are dropped by the request decoder.
+    return {
+        "messages": list(input_chat.messages),
+        "user_id": input_chat.user_id,
+        "session_id": input_chat.session_id,
+    }
+
+
+def chain_config(input_dict: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the config of a chain run, passing the user to its nodes and tools."""
+    return {
+        "configurable": {
+            "user_id": input_dict.get("user_id"),
+            "session_id": input_dict.get("session_id"),
+        }
+    }
+
 
-    # Sanitize leftover tool_calls on user messages
-    if "messages" in input_dict:
-        input_dict["messages"] = remove_tool_calls_from_human_messages(
-            input_dict["messages"]
+async def stream_event_response(
+    input_chat: InputChat,
+    started_at: Optional[float] = None,
+    session_version: Optional[int] = None,
+    wire_format: WireFormat = NDJSON,
+) -> AsyncGenerator[bytes, None]:
+    """
+    Stream events in response to an input chat.
+
+    Args:
+        input_chat: The chat input, holding the whole conversation.
+        started_at: time.perf_counter() at the start of the request, for the
+            latency metrics. Defaults to now.
+        session_version: New version of the stored session history, returned
+            to the client in the metadata event.
+        wire_format: Encoding of the events, negotiated with the client.
+    """
+    if started_at is None:
+        started_at = time.perf_counter()
+    run_id = uuid.uuid4()
+    input_dict = chain_input(input_chat, run_id)
+
+    yield wire_format.encode_metadata(str(run_id), session_version)
+
+    # Identical conversations share cache entries and in-flight streams
+    request_key = None
+    if response_cache is not None or single_flight is not None:
+        request_key = make_cache_key(
+            input_chat.messages,
+            namespace=f"{CHAIN_ID}:{wire_format.name}",
+            # Tools read the documents and sessions of the user, so answers
+            # are never shared between users
+            user_id=input_chat.user_id,
         )
 
-    yield json.dumps(
-        Event(event="metadata", data={"run_id": str(run_id)}),
-        default=default_serialization,
-    ) + "\n"
+    # Replay a recorded response for an identical conversation, if any
+    if response_cache is not None and request_key is not None:
+        cached_frames = response_cache.get(request_key)
+        if cached_frames is not None:
+            for frame in cached_frames:
+                yield frame
+            yield wire_format.end_frame
+            return
+
+    # Join the stream of an identical conversation still being answered, if any
+    if single_flight is not None and request_key is not None:
+        stream = single_flight.subscribe(
+            request_key,
+            functools.partial(stream_chain_frames, input_dict, started_at, wire_format),
+        )
+    else:
+        stream = stream_chain_frames(input_dict, started_at, wire_format)
 
-    async for data in chain.astream_events(input_dict, version="v2"):
-        if data["event"] in SUPPORTED_EVENTS:
-            yield json.dumps(data, default=default_serialization) + "\n"
+    frames = []
+    async for frame in stream:
+        if response_cache is not None:
+            frames.append(frame)
+        yield frame
+
+    # Only complete responses are recorded; errors and disconnects skip this
+    if response_cache is not None and request_key is not None:
+        response_cache.put(request_key, frames)
+
+    yield wire_format.end_frame
+
+
+async def stream_chain_frames(
+    input_dict: Dict[str, Any], started_at: float, wire_format: WireFormat = NDJSON
+) -> AsyncGenerator[bytes, None]:
+    """Run the chain and stream its supported events as encoded frames."""
+    if not chain.loaded:
+        # Importing the chain blocks, so keep it off the event loop
+        await asyncio.to_thread(chain.load)
+
+    # Only runs of the types the UI consumes are turned into stream events;
+    # their start/end events not forwarded to the UI are dropped here. Runs
+    # tagged nostream, e.g. history summaries, are internal to the chain.
+    upstream = chain.astream_events(
+        input_dict,
+        config=chain_config(input_dict),
+        version="v2",
+        include_types=SUPPORTED_RUN_TYPES,
+        exclude_tags=[TAG_NOSTREAM],
+    )
+    events = (data async for data in upstream if data["event"] in SUPPORTED_EVENTS)
+    # Chunk timings are measured before coalescing merges them
+    events = stream_metrics.track(events, started_at)
+    # Merge consecutive model chunks so that each frame carries several tokens
+    if STREAM_COALESCE_MAX_DELAY_MS > 0:
+        events = coalesce_chunk_events(
+            events,
+            max_delay=STREAM_COALESCE_MAX_DELAY_MS / 1000,
+            max_chunks=STREAM_COALESCE_MAX_CHUNKS,
+        )
+
+    try:
+        async for data in events:
+            yield wire_format.encode_event(data)
+    finally:
+        # When the client disconnects, close the generators right away rather
+        # than when they are collected: closing astream_events cancels the
+        # chain run along with its in-flight graph nodes and tool calls. The
+        # outer generators go first, as they may still be awaiting the inner
+        # ones.
+        await aclose(events)
+        await aclose(upstream)
 
-    yield json.dumps(EndEvent(), default=default_serialization) + "\n"
 
 # The events that are supported by the UI Frontend
-SUPPORTED_EVENTS = [
-    "on_tool_start",
-    "on_tool_end",
-    "on_retriever_start",
-    "on_retriever_end",
-    "on_chat_model_stream",
-]
-
-# Initialize FastAPI app and logging
-app = FastAPI()
-logging_client = google_cloud_logging.Client()
-logger = logging_client.logger(__name__)
-
-# Initialize Traceloop
-try:
-    Traceloop.init(
-        app_name="Sample Chatbot Application",
-        disable_batch=False,
-        exporter=CloudTraceLoggingSpanExporter(),
-        instruments={Instruments.VERTEXAI, Instruments.LANGCHAIN},
+SUPPORTED_EVENTS = frozenset(
+    {
+        "on_tool_start",
+        "on_tool_end",
+        "on_retriever_start",
+        "on_retriever_end",
+        "on_chat_model_stream",
+    }
+)
+
+# The run types emitting the supported events, requested from astream_events
+SUPPORTED_RUN_TYPES = ["chat_model", "tool", "retriever"]
+
+# Chunk coalescing: a frame is flushed after this delay or number of chunks.
+# Setting the delay to 0 streams every chunk as its own frame.
+STREAM_COALESCE_MAX_DELAY_MS = float(
+    os.environ.get("STREAM_COALESCE_MAX_DELAY_MS", "20")
+)
+STREAM_COALESCE_MAX_CHUNKS = int(os.environ.get("STREAM_COALESCE_MAX_CHUNKS", "32"))
+
+# Responses are compressed with the coding negotiated from Accept-Encoding,
+# flushed after every frame.
+STREAM_COMPRESSION = os.environ.get("STREAM_COMPRESSION", "true").lower() == "true"
+STREAM_COMPRESSION_LEVEL = int(os.environ.get("STREAM_COMPRESSION_LEVEL", "6"))
+
+# The chain is imported on first use, or by the warm-up once the server is up.
+# Set CHAIN_MODULE to serve another pattern, e.g. "app.chain".
+CHAIN_MODULE = os.environ.get("CHAIN_MODULE", "app.patterns.mirror_agent.chain")
+chain = LazyChain(CHAIN_MODULE)
+
+# Identity of the chain and model, so cached answers never outlive a change of
+# the model, its parameters or prompts, nor a deployment
+CHAIN_ID = f"{CHAIN_MODULE}:{chain.source_digest()}"
+if os.environ.get("COMMIT_SHA"):
+    CHAIN_ID += f":{os.environ['COMMIT_SHA']}"
+
+# Exact-match response cache, disabled unless RESPONSE_CACHE_SIZE is positive.
+# Replays repeat one sampled answer, so enable it for deterministic chains.
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "0"))
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+response_cache = (
+    ResponseCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL_SECONDS)
+    if RESPONSE_CACHE_SIZE > 0
+    else None
+)
+
+# Identical conversations arriving while the first one is still streaming, e.g.
+# retries and double-submits, share its upstream stream instead of starting
+# their own. Keys are scoped like the response cache entries.
+SINGLE_FLIGHT = os.environ.get("SINGLE_FLIGHT", "true").lower() == "true"
+single_flight: Optional[SingleFlight[bytes]] = SingleFlight() if SINGLE_FLIGHT else None
+
+# Validated messages are reused across requests sharing a history prefix
+request_decoder = RequestDecoder(
+    maxsize=int(os.environ.get("REQUEST_DECODE_CACHE_SIZE", "4096")),
+    # 64 MiB of message JSON
+    max_bytes=int(os.environ.get("REQUEST_DECODE_CACHE_BYTES", "67108864")),
+)
+
+# Session histories, letting clients send only the new messages of each turn
+session_store = SessionStore(
+    os.environ.get(
+        "SESSION_STORE_PATH", os.path.join(tempfile.gettempdir(), "sessions.sqlite")
+    ),
+    max_sessions=int(os.environ.get("SESSION_CACHE_SIZE", "1024")),
+    # Abandoned sessions are deleted, a week after their last turn by default
+    ttl=float(os.environ.get("SESSION_STORE_TTL_SECONDS", "604800")),
+)
+
+# Admission control: at most ADMISSION_MAX_CONCURRENT streams run at once, the
+# others wait in a queue served round-robin across users. Requests arriving
+# once the queue is full, or waiting longer than the timeout, get a 429.
+# Interactive and batch requests share the queue by weight, and some slots are
+# kept for interactive requests, which batch requests cannot take.
+admission = AdmissionController(
+    max_concurrent=int(os.environ.get("ADMISSION_MAX_CONCURRENT", "64")),
+    max_per_user=int(os.environ.get("ADMISSION_MAX_PER_USER", "0")),
+    max_queue=int(os.environ.get("ADMISSION_MAX_QUEUE", "256")),
+    queue_timeout=float(os.environ.get("ADMISSION_QUEUE_TIMEOUT_SECONDS", "30")),
+    weights={
+        INTERACTIVE: int(os.environ.get("ADMISSION_INTERACTIVE_WEIGHT", "8")),
+        BATCH: int(os.environ.get("ADMISSION_BATCH_WEIGHT", "1")),
+    },
+    reserved={INTERACTIVE: int(os.environ.get("ADMISSION_INTERACTIVE_RESERVED", "16"))},
+)
+# Header setting the priority class of /stream_events and /ws requests
+PRIORITY_HEADER = "x-priority"
+
+# Batches run at most BATCH_MAX_CONCURRENCY items at once, each cancelled
+# BATCH_ITEM_TIMEOUT_SECONDS after it is admitted. Items rejected by admission
+# control are retried BATCH_ADMISSION_RETRIES times, after their Retry-After.
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", "8"))
+BATCH_ITEM_TIMEOUT_SECONDS = float(os.environ.get("BATCH_ITEM_TIMEOUT_SECONDS", "300"))
+BATCH_ADMISSION_RETRIES = int(os.environ.get("BATCH_ADMISSION_RETRIES", "5"))
+
+
+# Prometheus metrics served on /metrics
+metrics_registry = Registry()
+stream_metrics = StreamMetrics(metrics_registry)
+metrics_registry.register(
+    Gauge(
+        "admission_queued_streams",
+        "Chat streams waiting for a slot.",
+        function=lambda: admission.queued,
+    )
+)
+metrics_registry.register(
+    Counter(
+        "admission_wait_seconds_total",
+        "Total time chat streams waited for a slot.",
+        function=lambda: admission.wait_seconds_total,
+    )
+)
+metrics_registry.register(
+    Counter(
+        "admission_admitted_total",
+        "Chat streams admitted.",
+        function=lambda: admission.admitted,
+    )
+)
+metrics_registry.register(
+    Counter(
+        "admission_rejected_total",
+        "Chat streams rejected with a 429.",
+        function=lambda: (
+            admission.rejected_queue_full
+            + admission.rejected_timeout
+            + admission.rejected_preempted
+        ),
+    )
+)
+metrics_registry.register(
+    Counter(
+        "response_cache_hits_total",
+        "Responses replayed from the response cache.",
+        function=lambda: response_cache.hits if response_cache else 0,
+    )
+)
+metrics_registry.register(
+    Counter(
+        "single_flight_joined_total",
+        "Requests served by joining an identical stream in flight.",
+        function=lambda: single_flight.joined if single_flight else 0,
+    )
+)
+
+
+@functools.lru_cache(maxsize=1)
+def get_feedback_logger() -> Any:
+    """Create the Cloud Logging logger used for feedback."""
+    from google.cloud import logging as google_cloud_logging
+
+    logging_client = google_cloud_logging.Client()
+    return logging_client.logger(__name__)
+
+
+# Feedback is written in batches by a background task. FEEDBACK_LOG_FILE
+# replaces Cloud Logging with a local JSONL file, e.g. for local development.
+FEEDBACK_LOG_FILE = os.environ.get("FEEDBACK_LOG_FILE")
+feedback_sink = FeedbackSink(
+    backend=(
+        LocalFileFeedbackBackend(FEEDBACK_LOG_FILE)
+        if FEEDBACK_LOG_FILE
+        else CloudLoggingFeedbackBackend(get_feedback_logger)
+    ),
+    spill_path=os.environ.get(
+        "FEEDBACK_SPILL_PATH",
+        os.path.join(tempfile.gettempdir(), "feedback_spill.jsonl"),
+    ),
+    max_queue_size=int(os.environ.get("FEEDBACK_QUEUE_SIZE", "1000")),
+    batch_size=int(os.environ.get("FEEDBACK_BATCH_SIZE", "100")),
+    flush_interval=float(os.environ.get("FEEDBACK_FLUSH_INTERVAL_SECONDS", "1")),
+)
+metrics_registry.register(
+    Gauge(
+        "feedback_queue_depth",
+        "Feedback entries waiting to be written.",
+        function=lambda: feedback_sink.queue_depth,
     )
-except Exception as e:
-    logging.error("Failed to initialize Traceloop: %s", e)
+)
+
+
+def init_tracing() -> None:
+    """Initialize Traceloop with the Cloud Trace exporter."""
+    from app.utils.tracing import CloudTraceLoggingSpanExporter
+
+    try:
+        Traceloop.init(
+            app_name="Sample Chatbot Application",
+            disable_batch=False,
+            exporter=CloudTraceLoggingSpanExporter(),
+            instruments={Instruments.VERTEXAI, Instruments.LANGCHAIN},
+        )
+    except Exception as e:
+        logging.error("Failed to initialize Traceloop: %s", e)
+
+
+def warm_up() -> None:
+    """Initialize tracing, the Cloud Logging client and the chain."""
+    init_tracing()
+    try:
+        get_feedback_logger()
+    except Exception as e:
+        logging.error("Failed to initialize Cloud Logging: %s", e)
+    chain.load()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """
+    Run the warm-up in the background, so that the server accepts connections
+    while clients and the chain are being initialized, and flush the pending
+    feedback on shutdown.
+    """
+    started_at = time.monotonic()
+
+    def log_warmup(task: asyncio.Task) -> None:
+        elapsed = time.monotonic() - started_at
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Warm-up failed after %.2fs: %s", elapsed, task.exception())
+        else:
+            logging.info("Warm-up finished in %.2fs", elapsed)
+
+    app.state.warmup = asyncio.create_task(asyncio.to_thread(warm_up))
+    app.state.warmup.add_done_callback(log_warmup)
+    feedback_sink.start()
+    yield
+    await feedback_sink.stop()
+
+
+# Initialize FastAPI app
+app = FastAPI(lifespan=lifespan)
+
 
 # Routes
 @app.get("/")
@@ -107,18 +450,350 @@ async def redirect_root_to_docs() -> RedirectResponse:
     """Redirect the root URL to the API documentation."""
     return RedirectResponse("/docs")
 
+
 @app.post("/feedback")
 async def collect_feedback(feedback_dict: Feedback) -> None:
-    """Collect and log feedback."""
-    logger.log_struct(feedback_dict.model_dump(), severity="INFO")
+    """Collect feedback, logged in the background."""
+    feedback_sink.submit(feedback_dict.model_dump())
+
+
+@app.get("/ready")
+async def ready(request: Request) -> JSONResponse:
+    """Report whether the deferred initialization has completed."""
+    warmup = getattr(request.app.state, "warmup", None)
+    status: Dict[str, Any] = {"status": "starting", "chain": CHAIN_MODULE}
+    if warmup is not None and warmup.done():
+        if warmup.cancelled() or warmup.exception() is not None:
+            status["status"] = "failed"
+        else:
+            status["status"] = "ready"
+    elif warmup is None and chain.loaded is True:
+        # Served without the lifespan hook, e.g. by a test client
+        status["status"] = "ready"
+    if chain.load_seconds is not None:
+        status["chain_load_seconds"] = round(chain.load_seconds, 3)
+    return JSONResponse(status, status_code=200 if status["status"] == "ready" else 503)
+
+
+@app.get("/stats")
+async def stats() -> Dict[str, Any]:
+    """Report the admission, response cache and feedback counters."""
+    return {
+        "admission": admission.stats(),
+        "response_cache": response_cache.stats() if response_cache else None,
+        "single_flight": single_flight.stats() if single_flight else None,
+        "sessions": session_store.stats(),
+        "request_decoder": request_decoder.stats(),
+        "feedback": feedback_sink.stats(),
+    }
+
+
+@app.get("/metrics")
+async def metrics() -> Response:
+    """Expose the serving metrics in the Prometheus text format."""
+    return Response(metrics_registry.render(), media_type=CONTENT_TYPE)
+
+
+async def start_turn(
+    input_chat: InputChat, priority: str = INTERACTIVE
+) -> Tuple[Permit, InputChat, Optional[int]]:
+    """
+    Admit a chat turn and rebuild the conversation of its stored session.
+
+    Returns the admission permit, to release once the turn is over, the input
+    holding the whole conversation and the new session version, if any.
+
+    Raises:
+        AdmissionRejected: If the turn is not admitted.
+        StaleSessionError: If the turn is a delta of a version the server does
+            not hold.
+    """
+    permit = await admission.acquire(input_chat.user_id, priority)
+
+    # Rebuild the conversation of a stored session from the new messages
+    session_version = None
+    if input_chat.session_version is not None:
+        try:
+            session_version, messages = await asyncio.to_thread(
+                session_store.apply,
+                f"{input_chat.user_id}:{input_chat.session_id}",
+                input_chat.session_version,
+                input_chat.messages,
+            )
+        except BaseException:
+            # Stale deltas, database errors and cancellations while the
+            # session is applied all end the turn before its stream owns the
+            # permit
+            permit.release()
+            raise
+        input_chat = input_chat.model_copy(update={"messages": messages})
+    return permit, input_chat, session_version
+
+
+@app.post("/stream_events", openapi_extra=INPUT_OPENAPI_EXTRA)
+async def stream_chat_events(request: Request) -> Response:
+    """
+    Stream chat events in response to an input request.
+    The body is an `Input`, decoded by the request decoder rather than FastAPI.
+    """
+    started_at = time.perf_counter()
+    input_chat = request_decoder.decode(await request.body()).input
+    priority = request.headers.get(PRIORITY_HEADER, INTERACTIVE)
+    if priority not in admission.weights:
+        return JSONResponse(
+            {"detail": f"Unknown priority class: {priority}"}, status_code=400
+        )
+    try:
+        permit, input_chat, session_version = await start_turn(input_chat, priority)
+    except AdmissionRejected as e:
+        return JSONResponse(
+            {"detail": e.reason},
+            status_code=429,
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except StaleSessionError as e:
+        return JSONResponse(
+            {"detail": str(e), "session_version": e.current_version},
+            status_code=409,
+        )
+
+    # Clients opt in to the compact MessagePack format through Accept
+    wire_format = NDJSON
+    if MSGPACK is not None and accepts_msgpack(request.headers.get("accept")):
+        wire_format = MSGPACK
+    stream = release_when_done(
+        stream_metrics.measure(
+            stream_event_response(input_chat, started_at, session_version, wire_format),
+            started_at,
+        ),
+        permit,
+    )
+
+    headers: Dict[str, str] = {}
+    vary = ["Accept"] if MSGPACK is not None else []
+    if STREAM_COMPRESSION:
+        vary.append("Accept-Encoding")
+        encoding = negotiate_encoding(request.headers.get("accept-encoding"))
+        if encoding is not None:
+            stream = compress_stream(stream, encoding, STREAM_COMPRESSION_LEVEL)
+            headers["Content-Encoding"] = encoding
+    if vary:
+        headers["Vary"] = ", ".join(vary)
+
+    async def close_stream() -> None:
+        # Runs once the response is over, including after a disconnect: the
+        # stream, and with it the chain run, is closed right away instead of
+        # when it is collected, and the permit is released even if the stream
+        # never started.
+        await aclose(stream)
+        permit.release()
+
+    return StreamingResponse(
+        stream,
+        media_type=wire_format.media_type,
+        headers=headers,
+        background=BackgroundTask(close_stream),
+    )
+
+
+async def acquire_batch_permit(user_id: str) -> Permit:
+    """Wait for a batch slot, retrying while admission control rejects it."""
+    retries = 0
+    while True:
+        try:
+            return await admission.acquire(user_id, BATCH)
+        except AdmissionRejected as e:
+            if retries >= BATCH_ADMISSION_RETRIES:
+                raise
+            retries += 1
+            await asyncio.sleep(e.retry_after)
+
+
+async def invoke_chain(input_chat: InputChat) -> Any:
+    """Run the chain on a conversation and return its output."""
+    if not chain.loaded:
+        await asyncio.to_thread(chain.load)
+    input_dict = chain_input(input_chat, uuid.uuid4())
+    return await chain.ainvoke(input_dict, config=chain_config(input_dict))
+
+
+async def run_batch_item(item: Any) -> Any:
+    """Run the chain on a batch item and return its answer."""
+    input_chat = request_decoder.decode_payload({"input": item}).input
+    permit = await acquire_batch_permit(input_chat.user_id)
+    try:
+        # The deadline of the item starts once it is admitted: waiting behind
+        # interactive traffic does not count against it
+        output = await asyncio.wait_for(
+            invoke_chain(input_chat), BATCH_ITEM_TIMEOUT_SECONDS
+        )
+    finally:
+        permit.release()
+    # Graphs return their whole state: keep the message answering the input
+    if isinstance(output, dict) and output.get("messages"):
+        return output["messages"][-1]
+    return output
+
+
+def encode_batch_result(result: BatchResult) -> bytes:
+    """Encode the result of a batch item as an NDJSON line."""
+    if result.error is None:
+        return NDJSON.encode_event({"index": result.index, "output": result.output})
+    error = result.error
+    if isinstance(error, RequestValidationError):
+        status, detail = 422, jsonable_encoder(error.errors())
+    elif isinstance(error, AdmissionRejected):
+        status, detail = 429, error.reason
+    elif isinstance(error, asyncio.TimeoutError):
+        status, detail = 504, "Timed out"
+    else:
+        logging.error("Batch item failed", exc_info=error)
+        status, detail = 500, "Internal Server Error"
+    return NDJSON.encode_event(
+        {"index": result.index, "error": {"status": status, "detail": detail}}
+    )
+
+
+@app.post("/batch", openapi_extra=BATCH_OPENAPI_EXTRA)
+async def batch(request: Request) -> Response:
+    """
+    Run the chain on many conversations, streaming back one NDJSON line per
+    conversation as it completes, tagged with its index in `inputs`. Invalid
+    items are reported in their line and do not fail the batch.
+    """
+    payload = parse_body(await request.body())
+    inputs = payload.get("inputs") if isinstance(payload, dict) else None
+    if not isinstance(inputs, list):
+        raise RequestValidationError(
+            [
+                {
+                    "type": "list_type",
+                    "loc": ("body", "inputs"),
+                    "msg": "Input should be a valid list",
+                    "input": inputs,
+                }
+            ]
+        )
+    results = run_batch(inputs, run_batch_item, max_concurrency=BATCH_MAX_CONCURRENCY)
+    lines = (encode_batch_result(result) async for result in results)
+
+    async def close_batch() -> None:
+        # Cancels the items still running when the client disconnects
+        await aclose(lines)
+        await aclose(results)
 
-@app.post("/stream_events")
-async def stream_chat_events(request: Input) -> StreamingResponse:
-    """Stream chat events in response to an input request."""
     return StreamingResponse(
-        stream_event_response(input_chat=request.input), media_type="text/event-stream"
+        lines,
+        media_type="application/x-ndjson",
+        background=BackgroundTask(close_batch),
     )
 
+
+@app.websocket("/ws")
+async def chat_websocket(websocket: WebSocket) -> None:
+    """
+    Chat over a persistent connection, saving the request and stream setup of
+    every turn. Clients send JSON messages:
+
+    - `{"type": "turn", "input": {...}}` runs an `InputChat` as `/stream_events`
+      does. The connection remembers the session version of its last turn, so
+      the following turns of that session only send their new messages.
+    - `{"type": "cancel"}` stops the running turn, which ends with a
+      `cancelled` event instead of `end`.
+
+    Each event is sent as a text message holding its JSON. Requests that
+    `/stream_events` would answer with an error status get an `error` event.
+    Binary messages close the connection with code 1003.
+    """
+    priority = websocket.headers.get(PRIORITY_HEADER, INTERACTIVE)
+    if priority not in admission.weights:
+        await websocket.close(code=1008, reason="Unknown priority class")
+        return
+    await websocket.accept()
+    # Session versions of the turns run on this connection, by session
+    session_versions: Dict[str, int] = {}
+    turn: Optional[asyncio.Task] = None
+
+    async def send_error(status: int, detail: Any, **data: Any) -> None:
+        await websocket.send_json(
+            {"event": "error", "data": {"status": status, "detail": detail, **data}}
+        )
+
+    async def run_turn(payload: Any) -> None:
+        started_at = time.perf_counter()
+        try:
+            input_chat = request_decoder.decode_payload(payload, session_versions).input
+        except RequestValidationError as e:
+            await send_error(422, jsonable_encoder(e.errors()))
+            return
+        session_key = f"{input_chat.user_id}:{input_chat.session_id}"
+        try:
+            permit, input_chat, session_version = await start_turn(input_chat, priority)
+        except AdmissionRejected as e:
+            await send_error(429, e.reason, retry_after=e.retry_after)
+            return
+        except StaleSessionError as e:
+            session_versions.pop(session_key, None)
+            await send_error(409, str(e), session_version=e.current_version)
+            return
+        if session_version is not None:
+            session_versions[session_key] = session_version
+
+        stream = release_when_done(
+            stream_metrics.measure(
+                stream_event_response(input_chat, started_at, session_version),
+                started_at,
+            ),
+            permit,
+        )
+        try:
+            async for frame in stream:
+                # Frames are NDJSON lines: drop the line break
+                await websocket.send_text(frame[:-1].decode("utf-8"))
+        except Exception:
+            logging.exception("Chat turn failed")
+            await send_error(500, "Internal Server Error")
+        finally:
+            await aclose(stream)
+            permit.release()
+
+    async def cancel_turn() -> None:
+        if turn is not None and not turn.done():
+            turn.cancel()
+            await asyncio.gather(turn, return_exceptions=True)
+            await websocket.send_json({"event": "cancelled"})
+
+    try:
+        while True:
+            received = await websocket.receive()
+            if received["type"] == "websocket.disconnect":
+                break
+            if received.get("text") is None:
+                await websocket.close(code=1003, reason="Messages must be text")
+                break
+            try:
+                message = json.loads(received["text"])
+            except ValueError:
+                await send_error(422, "Messages must be JSON objects")
+                continue
+            kind = message.get("type") if isinstance(message, dict) else None
+            if kind == "cancel":
+                await cancel_turn()
+            elif kind != "turn":
+                await send_error(422, "Unknown message type, expected turn or cancel")
+            elif turn is not None and not turn.done():
+                await send_error(409, "A turn is already running")
+            else:
+                turn = asyncio.create_task(run_turn(message))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # The client left: stop the running turn along with its chain run
+        if turn is not None:
+            turn.cancel()
+            await asyncio.gather(turn, return_exceptions=True)
+
+
 # Main execution
 if __name__ == "__main__":
     import uvicorn
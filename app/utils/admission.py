@@ -0,0 +1,346 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Admission control for concurrent chat streams.
+
+A global cap bounds the number of streams running at once. Requests beyond
+it wait in a bounded queue with a timeout, and waiting requests are admitted
+round-robin across users, so a single user cannot starve the others.
+
+Requests belong to a priority class, interactive or batch by default. Waiting
+classes share the freed slots in proportion to their weights, slots can be
+reserved for a class, and a full queue makes room for a request by evicting
+a waiting request of a lower class, so bulk work yields to interactive chat.
+"""
+import asyncio
+from collections import OrderedDict, deque
+import math
+import time
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterable,
+    Deque,
+    Dict,
+    Optional,
+    TypeVar,
+)
+
+from app.utils.streams import aclose
+
+T = TypeVar("T")
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted."""
+
+    def __init__(self, reason: str, retry_after: int) -> None:
+        """
+        Initialize the exception.
+
+        Args:
+            reason: Why the request was rejected.
+            retry_after: Suggested delay before retrying, in seconds.
+        """
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+# Dequeue weights of the default priority classes
+DEFAULT_WEIGHTS = {INTERACTIVE: 8, BATCH: 1}
+
+
+class Permit:
+    """A slot held by an admitted request. Releasing it twice is a no-op."""
+
+    def __init__(
+        self,
+        controller: "AdmissionController",
+        user_id: str,
+        priority: str = INTERACTIVE,
+    ) -> None:
+        self.controller = controller
+        self.user_id = user_id
+        self.priority = priority
+        self.acquired_at = time.monotonic()
+        self.released = False
+
+    def release(self) -> None:
+        """Give the slot back to the controller."""
+        if not self.released:
+            self.released = True
+            self.controller._release(self)
+
+
+class AdmissionController:
+    """
+    A concurrency limiter with a bounded wait queue, shared between priority
+    classes by weight and, within a class, round-robin across users.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = 64,
+        max_per_user: int = 0,
+        max_queue: int = 256,
+        queue_timeout: float = 30.0,
+        weights: Optional[Dict[str, int]] = None,
+        reserved: Optional[Dict[str, int]] = None,
+    ) -> None:
+        """
+        Initialize the controller.
+
+        Args:
+            max_concurrent: Maximum number of requests running at once.
+            max_per_user: Maximum number of requests of a single user running at
+                once. 0 leaves users unbounded, relying on round-robin fairness.
+            max_queue: Maximum number of waiting requests. Requests arriving
+                once the queue is full are rejected immediately, unless a
+                request of a class with a lower weight can be evicted instead.
+            queue_timeout: Maximum time a request waits for a slot, in seconds.
+            weights: Dequeue weight of each priority class: while several
+                classes wait, slots are handed out in proportion to their
+                weights. Defaults to 8 interactive requests for 1 batch request.
+            reserved: Slots only usable by a class, e.g. a concurrency floor
+                for interactive requests that batch requests cannot take.
+        """
+        self.weights = dict(weights or DEFAULT_WEIGHTS)
+        self.reserved = dict(reserved or {})
+        if any(weight <= 0 for weight in self.weights.values()):
+            raise ValueError("Priority weights must be positive")
+        if not set(self.reserved) <= set(self.weights):
+            raise ValueError("Slots are reserved for an unknown priority class")
+        if sum(self.reserved.values()) > max_concurrent:
+            raise ValueError("More slots are reserved than max_concurrent")
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.rejected_preempted = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self._active_per_user: Dict[str, int] = {}
+        self._active_per_class = {priority: 0 for priority in self.weights}
+        self._queued_per_class = {priority: 0 for priority in self.weights}
+        # Users with waiting requests of each class, in round-robin order
+        self._waiters: Dict[str, "OrderedDict[str, Deque[asyncio.Future]]"] = {
+            priority: OrderedDict() for priority in self.weights
+        }
+        # Stride scheduling between classes: the waiting class with the lowest
+        # pass is served next, and each admission advances the pass of its
+        # class by 1 / weight. The virtual time is the pass last served.
+        self._pass = {priority: 0.0 for priority in self.weights}
+        self._virtual_time = 0.0
+        # Moving average of the time a slot is held, for Retry-After
+        self._hold_seconds = 1.0
+
+    async def acquire(self, user_id: str = "", priority: str = INTERACTIVE) -> Permit:
+        """
+        Wait for a slot and return its permit.
+
+        Raises:
+            AdmissionRejected: If the queue is full, the wait times out, or the
+                request is evicted from the queue by a higher priority one.
+            ValueError: If the priority class is unknown.
+        """
+        if priority not in self.weights:
+            raise ValueError(f"Unknown priority class: {priority}")
+        start = time.monotonic()
+        if not self.queued and self._has_capacity(user_id, priority):
+            return self._admit(user_id, priority, start)
+        if self.queued >= self.max_queue and not self._preempt(priority):
+            self.rejected_queue_full += 1
+            raise AdmissionRejected("Too many requests queued", self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        if not self._queued_per_class[priority]:
+            # A class starting to wait gets no credit for the time it was idle
+            self._pass[priority] = max(self._pass[priority], self._virtual_time)
+        self._waiters[priority].setdefault(user_id, deque()).append(waiter)
+        self.queued += 1
+        self._queued_per_class[priority] += 1
+        # Slots may be free while every other waiting user is at its own limit
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if not waiter.done():
+                waiter.cancel()
+                self._remove_waiter(priority, user_id, waiter)
+            elif not waiter.cancelled() and waiter.exception() is None:
+                # Admitted while timing out: hand the slot to the next request
+                waiter.result().release()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.rejected_timeout += 1
+            raise AdmissionRejected(
+                "Timed out waiting for capacity", self.retry_after()
+            ) from e
+        permit: Permit = waiter.result()
+        self._record_wait(time.monotonic() - start)
+        return permit
+
+    def retry_after(self) -> int:
+        """Estimate when a slot is likely to be available, in seconds."""
+        turns = self.queued / max(self.max_concurrent, 1) + 1
+        return max(1, math.ceil(self._hold_seconds * turns))
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the controller counters."""
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+            "rejected_preempted": self.rejected_preempted,
+            "wait_seconds_total": self.wait_seconds_total,
+            "wait_seconds_max": self.wait_seconds_max,
+            "classes": {
+                priority: {
+                    "active": self._active_per_class[priority],
+                    "queued": self._queued_per_class[priority],
+                }
+                for priority in self.weights
+            },
+        }
+
+    def _has_capacity(self, user_id: str, priority: str) -> bool:
+        # Reserved slots that the other classes are not using are held back
+        held_back = sum(
+            max(0, slots - self._active_per_class[other])
+            for other, slots in self.reserved.items()
+            if other != priority
+        )
+        if self.active + held_back >= self.max_concurrent:
+            return False
+        return (
+            not self.max_per_user
+            or self._active_per_user.get(user_id, 0) < self.max_per_user
+        )
+
+    def _admit(self, user_id: str, priority: str, start: float) -> Permit:
+        self.active += 1
+        self.admitted += 1
+        self._active_per_user[user_id] = self._active_per_user.get(user_id, 0) + 1
+        self._active_per_class[priority] += 1
+        if start:
+            self._record_wait(time.monotonic() - start)
+        return Permit(self, user_id, priority)
+
+    def _record_wait(self, seconds: float) -> None:
+        self.wait_seconds_total += seconds
+        self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def _release(self, permit: Permit) -> None:
+        self.active -= 1
+        self._active_per_class[permit.priority] -= 1
+        remaining = self._active_per_user[permit.user_id] - 1
+        if remaining:
+            self._active_per_user[permit.user_id] = remaining
+        else:
+            del self._active_per_user[permit.user_id]
+        held = time.monotonic() - permit.acquired_at
+        self._hold_seconds = 0.9 * self._hold_seconds + 0.1 * held
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """Admit waiting requests, the class with the lowest pass first."""
+        while self.queued and self.active < self.max_concurrent:
+            waiting = sorted(
+                (p for p in self.weights if self._queued_per_class[p]),
+                key=lambda p: self._pass[p],
+            )
+            if not any(self._dispatch_class(priority) for priority in waiting):
+                # Every waiting request is held back by a limit
+                return
+
+    def _dispatch_class(self, priority: str) -> bool:
+        """Admit the next request of a class, round-robin across users."""
+        waiting = self._waiters[priority]
+        for _ in range(len(waiting)):
+            user_id, waiters = next(iter(waiting.items()))
+            if not self._has_capacity(user_id, priority):
+                waiting.move_to_end(user_id)
+                continue
+            waiter = waiters.popleft()
+            self.queued -= 1
+            self._queued_per_class[priority] -= 1
+            if waiters:
+                waiting.move_to_end(user_id)
+            else:
+                del waiting[user_id]
+            self._virtual_time = self._pass[priority]
+            self._pass[priority] += 1 / self.weights[priority]
+            waiter.set_result(self._admit(user_id, priority, 0.0))
+            return True
+        return False
+
+    def _preempt(self, priority: str) -> bool:
+        """
+        Evict the newest waiting request of the lowest class weighing less
+        than `priority`, making room in the queue. Returns False if none waits.
+        """
+        lower = [
+            p
+            for p in self.weights
+            if self.weights[p] < self.weights[priority] and self._queued_per_class[p]
+        ]
+        if not lower:
+            return False
+        victim_class = min(lower, key=lambda p: self.weights[p])
+        user_id, waiters = next(reversed(self._waiters[victim_class].items()))
+        waiter = waiters[-1]
+        self._remove_waiter(victim_class, user_id, waiter)
+        self.rejected_preempted += 1
+        waiter.set_exception(
+            AdmissionRejected(
+                "Preempted by higher priority requests", self.retry_after()
+            )
+        )
+        return True
+
+    def _remove_waiter(
+        self, priority: str, user_id: str, waiter: asyncio.Future
+    ) -> None:
+        waiting = self._waiters[priority]
+        waiters = waiting.get(user_id)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            self.queued -= 1
+            self._queued_per_class[priority] -= 1
+            if not waiters:
+                del waiting[user_id]
+
+
+async def release_when_done(
+    stream: AsyncIterable[T], permit: Optional[Permit]
+) -> AsyncGenerator[T, None]:
+    """Forward a stream, releasing the permit once it ends, fails or is closed."""
+    try:
+        async for item in stream:
+            yield item
+    finally:
+        if permit is not None:
+            permit.release()
+        await aclose(stream)
@@ -0,0 +1,89 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bounded-concurrency execution of batches on the event loop.
+
+A fixed number of workers pull the items of a batch in order and run them, so
+at most `max_concurrency` items are in flight whatever the size of the batch.
+Results are handed back as they complete, tagged with the index of their item.
+Workers pause while the consumer is behind, and closing the results stops
+them, cancelling the items they are running.
+"""
+import asyncio
+from dataclasses import dataclass
+from typing import (
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Generic,
+    Optional,
+    Sequence,
+    TypeVar,
+)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+@dataclass
+class BatchResult(Generic[R]):
+    """The outcome of a batch item: its output, or the error it raised."""
+
+    index: int
+    output: Optional[R] = None
+    error: Optional[BaseException] = None
+
+
+async def run_batch(
+    items: Sequence[T],
+    run: Callable[[T], Awaitable[R]],
+    max_concurrency: int,
+    timeout: Optional[float] = None,
+) -> AsyncGenerator[BatchResult[R], None]:
+    """
+    Run the items of a batch and yield their results in completion order.
+
+    Args:
+        items: The batch items.
+        run: Runs a single item.
+        max_concurrency: Maximum number of items running at once.
+        timeout: Maximum duration of an item, after which it is cancelled and
+            fails with `asyncio.TimeoutError`. None waits indefinitely.
+    """
+    if max_concurrency <= 0:
+        raise ValueError("max_concurrency must be positive")
+    results: "asyncio.Queue[BatchResult[R]]" = asyncio.Queue(maxsize=max_concurrency)
+    # Shared by the workers, which take the next index when they are free
+    indices = iter(range(len(items)))
+
+    async def worker() -> None:
+        for index in indices:
+            try:
+                output = await asyncio.wait_for(run(items[index]), timeout)
+            except Exception as e:
+                result: BatchResult[R] = BatchResult(index, error=e)
+            else:
+                result = BatchResult(index, output=output)
+            await results.put(result)
+
+    workers = [
+        asyncio.create_task(worker()) for _ in range(min(max_concurrency, len(items)))
+    ]
+    try:
+        for _ in range(len(items)):
+            yield await results.get()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
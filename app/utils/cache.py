@@ -0,0 +1,145 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Exact-match response cache for streamed chat responses.
+
+Conversations are hashed into a canonical key, and the NDJSON frames produced
+for them are recorded so that an identical conversation can be answered by
+replaying the frames instead of calling the LLM again.
+
+A replay is the one answer sampled for the first request: with a model
+sampling at a positive temperature, such as the mirror agent at 0.7, every
+identical conversation gets that same answer until the entry expires, rather
+than an answer of its own.
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.messages import BaseMessage
+
+
+def normalize_message(message: BaseMessage) -> Dict[str, Any]:
+    """
+    Reduce a message to the fields that influence the model response.
+    Ids, metadata and usage statistics are dropped so that replays of the same
+    conversation produce the same key.
+    """
+    normalized: Dict[str, Any] = {"type": message.type, "content": message.content}
+    tool_calls = getattr(message, "tool_calls", None)
+    if tool_calls:
+        normalized["tool_calls"] = [
+            {"name": call["name"], "args": call["args"]} for call in tool_calls
+        ]
+    tool_call_id = getattr(message, "tool_call_id", None)
+    if tool_call_id:
+        normalized["tool_call_id"] = tool_call_id
+    if message.name:
+        normalized["name"] = message.name
+    return normalized
+
+
+def make_cache_key(
+    messages: Sequence[BaseMessage], namespace: str, user_id: str = ""
+) -> str:
+    """
+    Build a canonical hash for a conversation.
+
+    Args:
+        messages: The conversation messages.
+        namespace: Identity of the chain and model producing the response.
+        user_id: Scopes the key to a single user; leave empty to share entries.
+
+    Returns:
+        str: A hex digest identifying the conversation.
+    """
+    payload = {
+        "namespace": namespace,
+        "user_id": user_id,
+        "messages": [normalize_message(message) for message in messages],
+    }
+    canonical = json.dumps(
+        payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """An LRU cache with per-entry TTL holding recorded response frames."""
+
+    def __init__(
+        self,
+        maxsize: int = 256,
+        ttl: float = 3600.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        """
+        Initialize the cache.
+
+        Args:
+            maxsize: Maximum number of responses kept before evicting the least
+                recently used one.
+            ttl: Seconds after which an entry expires.
+            clock: Monotonic time source, injectable for tests.
+        """
+        if maxsize <= 0:
+            raise ValueError("maxsize must be positive")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries: OrderedDict[str, Tuple[float, List[bytes]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[List[bytes]]:
+        """Return the recorded frames for a key, or None on a miss."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, frames = entry
+            if expires_at > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return frames
+            del self._entries[key]
+            self.evictions += 1
+        self.misses += 1
+        return None
+
+    def put(self, key: str, frames: List[bytes]) -> None:
+        """Record the frames of a completed response."""
+        self._entries[key] = (self.clock() + self.ttl, frames)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        """Drop every entry, keeping the counters."""
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """Return the cache counters."""
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
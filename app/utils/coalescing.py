@@ -0,0 +1,138 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Coalescing of consecutive chat model chunks into larger frames.
+
+Merged frames keep the shape of a single `on_chat_model_stream` event, with
+the chunks added together, so consumers handle them like any other chunk.
+"""
+import asyncio
+from typing import Any, AsyncGenerator, AsyncIterable, Dict, Optional
+
+from app.utils.streams import aclose
+from langchain_core.messages import BaseMessageChunk
+
+CHAT_MODEL_STREAM = "on_chat_model_stream"
+
+
+def merge_chunk_events(
+    first: Dict[str, Any], second: Dict[str, Any]
+) -> Optional[Dict[str, Any]]:
+    """
+    Merge two `on_chat_model_stream` events into one.
+
+    Returns None when the events cannot be merged: they belong to different
+    runs, or their chunks are neither message chunks nor plain text dicts.
+    """
+    if first.get("run_id") != second.get("run_id"):
+        return None
+    chunk = first.get("data", {}).get("chunk")
+    other = second.get("data", {}).get("chunk")
+    merged: Any
+    if isinstance(chunk, BaseMessageChunk) and isinstance(other, BaseMessageChunk):
+        merged = chunk + other
+    elif (
+        isinstance(chunk, dict)
+        and isinstance(other, dict)
+        and isinstance(chunk.get("content"), str)
+        and isinstance(other.get("content"), str)
+    ):
+        # Custom chains emit chunks that were already dumped to dicts
+        merged = {
+            **chunk,
+            "content": chunk["content"] + other["content"],
+            "additional_kwargs": {
+                **chunk.get("additional_kwargs", {}),
+                **other.get("additional_kwargs", {}),
+            },
+        }
+    else:
+        return None
+    return {**first, "data": {**first["data"], "chunk": merged}}
+
+
+async def coalesce_chunk_events(
+    events: AsyncIterable[Dict[str, Any]],
+    max_delay: float = 0.02,
+    max_chunks: int = 32,
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """
+    Merge consecutive chat model chunk events into single frames.
+
+    A frame is flushed once `max_delay` seconds have passed since its first
+    chunk, once it holds `max_chunks` chunks, or as soon as any other event
+    arrives, so tool events are never delayed and ordering is preserved.
+
+    Args:
+        events: The upstream events.
+        max_delay: Maximum time a chunk may wait in a frame, in seconds.
+        max_chunks: Maximum number of chunks merged into a frame.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = events.__aiter__()
+    pending: Optional[asyncio.Future] = None
+    frame: Optional[Dict[str, Any]] = None
+    frame_chunks = 0
+    deadline = 0.0
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            if frame is not None:
+                # Wait for the next event only until the frame is due
+                done, _ = await asyncio.wait(
+                    {pending}, timeout=max(deadline - loop.time(), 0)
+                )
+                if not done:
+                    yield frame
+                    frame = None
+                    continue
+            try:
+                event = await pending
+            except StopAsyncIteration:
+                break
+            finally:
+                pending = None
+
+            if event.get("event") != CHAT_MODEL_STREAM:
+                if frame is not None:
+                    yield frame
+                    frame = None
+                yield event
+                continue
+
+            if frame is not None:
+                merged = merge_chunk_events(frame, event)
+                if merged is not None:
+                    frame = merged
+                    frame_chunks += 1
+                    if frame_chunks >= max_chunks:
+                        yield frame
+                        frame = None
+                    continue
+                yield frame
+            frame, frame_chunks = event, 1
+            deadline = loop.time() + max_delay
+            if frame_chunks >= max_chunks:
+                yield frame
+                frame = None
+
+        if frame is not None:
+            yield frame
+    finally:
+        if pending is not None:
+            pending.cancel()
+            # The iterator cannot be closed while its __anext__ is still running
+            await asyncio.wait({pending})
+        await aclose(iterator)
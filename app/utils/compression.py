@@ -0,0 +1,82 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streaming compression of the NDJSON event stream.
+
+A single compressor is kept for the whole response, so that the keys repeated
+on every event line are encoded as back-references, and it is sync-flushed
+after every frame: the client can decode each frame as soon as it is
+received, and compression adds no latency.
+"""
+from typing import AsyncGenerator, AsyncIterable, Optional, Tuple
+import zlib
+
+from app.utils.streams import aclose
+
+# Window bits of zlib.compressobj for each supported content coding.
+# HTTP "deflate" is the zlib format, not raw deflate.
+WBITS = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+
+
+def _parse_coding(item: str) -> Tuple[str, float]:
+    """Return the coding and quality of an Accept-Encoding item."""
+    coding, *params = (part.strip() for part in item.split(";"))
+    quality = 1.0
+    for param in params:
+        name, _, value = param.partition("=")
+        if name.strip().lower() == "q":
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0.0
+    return coding.lower(), quality
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    Pick the content coding of a response from its Accept-Encoding header.
+
+    Returns "gzip" or "deflate", the one with the highest quality and gzip on
+    ties, or None when the client accepts neither.
+    """
+    if not accept_encoding:
+        return None
+    qualities = dict(_parse_coding(item) for item in accept_encoding.split(","))
+    wildcard = qualities.get("*", 0.0)
+    best, best_quality = None, 0.0
+    for coding in WBITS:
+        quality = qualities.get(coding, wildcard)
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+async def compress_stream(
+    stream: AsyncIterable[bytes], encoding: str, level: int = 6
+) -> AsyncGenerator[bytes, None]:
+    """
+    Compress a stream of frames, flushing the compressor after each one.
+
+    Args:
+        stream: The frames to compress.
+        encoding: "gzip" or "deflate".
+        level: zlib compression level.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+    try:
+        async for frame in stream:
+            yield compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush(zlib.Z_FINISH)
+    finally:
+        await aclose(stream)
@@ -26,7 +26,7 @@ can be safely removed.
 from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 import inspect
-from typing import Any, AsyncGenerator, Callable, List, Union
+from typing import Any, AsyncGenerator, Callable, Iterable, List, Union
 
 from app.utils.output_types import OnChatModelStreamEvent, OnToolEndEvent
 from langchain_core.messages import AIMessage
@@ -43,32 +43,34 @@ class CustomChain:
         """Initialize the CustomChain with a callable function."""
         self.func = func
 
-    async def astream_events(self, *args: Any, **kwargs: Any) -> AsyncGenerator:
-        """
-        Asynchronously stream events from the wrapped function.
-        Applies Traceloop workflow decorator if Traceloop SDK is initialized.
-        """
-
+    def _traced_func(self) -> Callable:
+        """Return the wrapped function, traced if Traceloop SDK is initialized."""
         if hasattr(TracerWrapper, "instance"):
-            func = aworkflow()(self.func)
-        else:
-            func = self.func
+            return aworkflow()(self.func)
+        return self.func
 
-        async_gen = func(*args, **kwargs)
+    async def _aevents(self, *args: Any, **kwargs: Any) -> AsyncGenerator:
+        """Asynchronously iterate over the events of the wrapped function."""
+        async_gen = self._traced_func()(*args, **kwargs)
 
         # Traceloop "aworkflow" decorator returns a co-routine which should be awaited
         if inspect.iscoroutine(async_gen):
             async_gen = await async_gen
 
         async for event in async_gen:
-            yield event.model_dump()
+            yield event
 
-    def invoke(self, *args: Any, **kwargs: Any) -> AIMessage:
+    async def astream_events(self, *args: Any, **kwargs: Any) -> AsyncGenerator:
         """
-        Invoke the wrapped function and process its events.
-        Returns an AIMessage with content and relative tool calls.
+        Asynchronously stream events from the wrapped function.
+        Applies Traceloop workflow decorator if Traceloop SDK is initialized.
         """
-        events = self.func(*args, **kwargs)
+        async for event in self._aevents(*args, **kwargs):
+            yield event.model_dump()
+
+    @staticmethod
+    def _to_message(events: Iterable[Any]) -> AIMessage:
+        """Build an AIMessage with content and relative tool calls from events."""
         response_content = ""
         tool_calls = []
         for event in events:
@@ -82,6 +84,22 @@ class CustomChain:
             content=response_content, additional_kwargs={"tool_calls_data": tool_calls}
         )
 
+    def invoke(self, *args: Any, **kwargs: Any) -> AIMessage:
+        """
+        Invoke the wrapped function and process its events.
+        Returns an AIMessage with content and relative tool calls.
+        """
+        return self._to_message(self.func(*args, **kwargs))
+
+    async def ainvoke(self, *args: Any, **kwargs: Any) -> AIMessage:
+        """
+        Asynchronously invoke the wrapped function and process its events.
+        Returns an AIMessage with content and relative tool calls.
+        """
+        return self._to_message(
+            [event async for event in self._aevents(*args, **kwargs)]
+        )
+
     def batch(
         self,
         inputs: List[Input],
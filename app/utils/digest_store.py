@@ -0,0 +1,292 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Digests of the recent sessions of each user, maintained in the background.
+
+A digest holds a summary of a session and an embedding of that summary. When
+a turn ends, the agent records the conversation with `record`, which only
+queues it: a background thread folds the messages added since the last digest
+of the session into its summary, with one summarizer call, and embeds the new
+summary. Updates of a session queued while the thread is busy are merged, so
+a session that moves faster than its summarizer costs one call per update
+rather than one per turn.
+
+Digests are stored in SQLite, and only the `max_sessions` most recently
+updated sessions of a user are kept, so that reading the digests of a user
+takes the same time however long their history. Several server processes can
+share the database file: a digest is only written if the session was not
+updated meanwhile, and the update is otherwise redone on the newer digest.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+import logging
+import threading
+import time
+from typing import List, Optional, Sequence, Tuple
+
+from app.utils.doc_index import HashingEmbeddings, embed_array
+from app.utils.sqlite import ProcessConnection
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    HumanMessage,
+    get_buffer_string,
+)
+from langchain_core.runnables import Runnable
+import numpy as np
+
+
+@dataclass
+class SessionDigest:
+    """The digest of a session."""
+
+    session_id: str
+    summary: str
+    # Number of messages of the session folded into the summary
+    messages: int
+    updated_at: float
+    embedding: np.ndarray
+
+
+def conversation_text(messages: Sequence[BaseMessage]) -> str:
+    """Return the human and AI lines of messages, without tool traffic."""
+    lines = [
+        message
+        for message in messages
+        if isinstance(message, HumanMessage)
+        or (isinstance(message, AIMessage) and message.content)
+    ]
+    return get_buffer_string(lines)
+
+
+class DigestStore:
+    """Session digests in SQLite, updated by a background thread."""
+
+    def __init__(
+        self,
+        path: str,
+        summarizer: Runnable,
+        embeddings: Optional[Embeddings] = None,
+        max_sessions: int = 20,
+    ) -> None:
+        """
+        Initialize the store.
+
+        Args:
+            path: SQLite database file, or ":memory:" for a transient store.
+            summarizer: Runnable taking the previous `summary` of a session
+                and the `conversation` to fold into it, and returning the new
+                summary as a message or a string.
+            embeddings: Embeddings of the summaries and queries. Defaults to
+                `HashingEmbeddings`.
+            max_sessions: Number of sessions kept per user.
+        """
+        if max_sessions <= 0:
+            raise ValueError("max_sessions must be positive")
+        self.path = path
+        self.summarizer = summarizer
+        self.embeddings = embeddings or HashingEmbeddings()
+        self.max_sessions = max_sessions
+        self.updates = 0
+        self.merged = 0
+        self.failures = 0
+        self._pending: "OrderedDict[Tuple[str, str], List[BaseMessage]]" = OrderedDict()
+        self._busy = False
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._db = ProcessConnection(path)
+        with self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS digests ("
+                "user_id TEXT NOT NULL, session_id TEXT NOT NULL, "
+                "summary TEXT NOT NULL, messages INTEGER NOT NULL, "
+                "updated_at REAL NOT NULL, embedding BLOB NOT NULL, "
+                "PRIMARY KEY (user_id, session_id))"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS digests_recent "
+                "ON digests (user_id, updated_at)"
+            )
+
+    def record(
+        self, user_id: str, session_id: str, messages: Sequence[BaseMessage]
+    ) -> None:
+        """
+        Queue the digest update of a session without blocking.
+
+        Args:
+            user_id: The user of the session.
+            session_id: The session.
+            messages: The whole conversation of the session so far.
+        """
+        with self._condition:
+            key = (user_id, session_id)
+            if key in self._pending:
+                self.merged += 1
+            # The latest conversation holds the previous ones
+            self._pending[key] = list(messages)
+            self._ensure_worker()
+            self._condition.notify()
+
+    def _ensure_worker(self) -> None:
+        # The thread of the parent is not alive in a forked process
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._work, name="digest-store", daemon=True
+            )
+            self._thread.start()
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._busy = False
+                    self._condition.notify_all()
+                    self._condition.wait()
+                (user_id, session_id), messages = self._pending.popitem(last=False)
+                self._busy = True
+            try:
+                self._update(user_id, session_id, messages)
+            except Exception:
+                self.failures += 1
+                logging.exception("Failed to update the digest of a session")
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait for the queued updates and return whether they are done."""
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not self._pending and not self._busy, timeout
+            )
+
+    def _update(
+        self, user_id: str, session_id: str, messages: List[BaseMessage]
+    ) -> None:
+        """Fold the new messages of a session into its digest."""
+        for _ in range(3):
+            current = self.get(user_id, session_id)
+            # An edited conversation is digested again from its start
+            if current is None or current.messages > len(messages):
+                summary, start = "", 0
+            else:
+                summary, start = current.summary, current.messages
+            conversation = conversation_text(messages[start:])
+            if not conversation:
+                return
+            folded = self.summarizer.invoke(
+                {"summary": summary, "conversation": conversation}
+            )
+            summary = folded.content if isinstance(folded, BaseMessage) else folded
+            embedding = embed_array(self.embeddings, [summary])[0]
+            if self._write(user_id, session_id, current, summary, messages, embedding):
+                self.updates += 1
+                return
+        raise RuntimeError("The digest kept being updated by other processes")
+
+    def _write(
+        self,
+        user_id: str,
+        session_id: str,
+        current: Optional[SessionDigest],
+        summary: str,
+        messages: List[BaseMessage],
+        embedding: np.ndarray,
+    ) -> bool:
+        """Write a digest unless the session was updated since `current`."""
+        row = (summary, len(messages), time.time(), embedding.tobytes())
+        with self._lock, self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            stored = self._db.execute(
+                "SELECT updated_at FROM digests "
+                "WHERE user_id = ? AND session_id = ?",
+                (user_id, session_id),
+            ).fetchone()
+            stored_at = stored[0] if stored else None
+            if stored_at != (current.updated_at if current else None):
+                return False
+            self._db.execute(
+                "INSERT OR REPLACE INTO digests (user_id, session_id, summary, "
+                "messages, updated_at, embedding) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, session_id, *row),
+            )
+            # Only the most recent sessions of a user are kept
+            self._db.execute(
+                "DELETE FROM digests WHERE user_id = ? AND session_id NOT IN ("
+                "SELECT session_id FROM digests WHERE user_id = ? "
+                "ORDER BY updated_at DESC LIMIT ?)",
+                (user_id, user_id, self.max_sessions),
+            )
+            return True
+
+    def _digest(self, row: Tuple) -> SessionDigest:
+        session_id, summary, messages, updated_at, embedding = row
+        return SessionDigest(
+            session_id,
+            summary,
+            messages,
+            updated_at,
+            np.frombuffer(embedding, dtype=np.float32),
+        )
+
+    def get(self, user_id: str, session_id: str) -> Optional[SessionDigest]:
+        """Return the digest of a session, if any."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT session_id, summary, messages, updated_at, embedding "
+                "FROM digests WHERE user_id = ? AND session_id = ?",
+                (user_id, session_id),
+            ).fetchone()
+        return None if row is None else self._digest(row)
+
+    def recent(
+        self,
+        user_id: str,
+        query: Optional[str] = None,
+        k: int = 3,
+        exclude: Optional[str] = None,
+    ) -> List[SessionDigest]:
+        """
+        Return digests of the recent sessions of a user.
+
+        Args:
+            user_id: The user.
+            query: Text the digests are ranked by similarity with. By
+                default, the most recently updated sessions come first.
+            k: Maximum number of digests returned.
+            exclude: Session left out, e.g. the current one.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT session_id, summary, messages, updated_at, embedding "
+                "FROM digests WHERE user_id = ? "
+                "ORDER BY updated_at DESC LIMIT ?",
+                (user_id, self.max_sessions),
+            ).fetchall()
+        digests = [self._digest(row) for row in rows if row[0] != exclude]
+        if query and digests:
+            query_vector = embed_array(self.embeddings, [query])[0]
+            scores = [
+                (
+                    float(digest.embedding @ query_vector)
+                    if len(digest.embedding) == len(query_vector)
+                    else 0.0
+                )
+                for digest in digests
+            ]
+            # Sorting is stable: equally similar sessions stay newest first
+            order = sorted(range(len(digests)), key=lambda i: -scores[i])
+            digests = [digests[i] for i in order]
+        return digests[:k]
@@ -0,0 +1,546 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local hybrid search over the documents of a user.
+
+A `DocIndex` is a directory holding:
+
+- `chunks.sqlite`, the chunks of the documents, one row per chunk, and a
+  version bumped by every write;
+- `vectors.f32`, the embeddings of the chunks as a float32 matrix, row `i`
+  embedding chunk `i`, memory-mapped on load and appended to on add.
+
+The BM25 postings are not persisted: they are rebuilt in memory from the
+chunks on load, which takes seconds for tens of thousands of chunks, and kept
+up to date by adds. Deleted chunks are flagged and skipped until `compact`
+rewrites the index without them, which renumbers the rows and bumps a count
+of compactions. A query is answered in process: the BM25 and
+cosine rankings are computed with numpy over all the chunks and merged by
+reciprocal rank fusion, and only the texts of the results are read.
+
+The index refreshes when another process wrote to it, so several server
+workers can share a directory: only the chunks added meanwhile are read and
+tokenized, and the deleted flags are read again, unless the index was
+compacted meanwhile, which reloads it. Embeddings come from any LangChain `Embeddings`;
+`HashingEmbeddings` embeds locally, without a remote call per query.
+"""
+from array import array
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import dataclass
+import hashlib
+import math
+import os
+import re
+import threading
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+import zlib
+
+from app.utils.sqlite import ProcessConnection
+from langchain_core.embeddings import Embeddings
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"\w+")
+# Constant of reciprocal rank fusion: a chunk at rank r scores 1 / (r + 60)
+RRF_K = 60
+
+
+def tokenize(text: str) -> List[str]:
+    """Split a text into lowercase word tokens."""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Local embeddings hashing the words and word pairs of a text into a fixed
+    number of signed dimensions. They capture shared vocabulary rather than
+    meaning, at no cost per query; use a model for semantic similarity.
+    """
+
+    def __init__(self, dim: int = 128) -> None:
+        """
+        Initialize the embeddings.
+
+        Args:
+            dim: Number of dimensions of the vectors.
+        """
+        if dim <= 0:
+            raise ValueError("dim must be positive")
+        self.dim = dim
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """Embed texts into the rows of an L2-normalized float32 matrix."""
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+            for feature in features:
+                # crc32 rather than hash(), which differs between processes
+                digest = zlib.crc32(feature.encode())
+                sign = 1.0 if digest & 0x80000000 else -1.0
+                vectors[row, digest % self.dim] += sign
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed([text])[0].tolist()
+
+
+def embed_array(embeddings: Embeddings, texts: Sequence[str]) -> np.ndarray:
+    """Embed texts into the rows of an L2-normalized float32 matrix."""
+    if isinstance(embeddings, HashingEmbeddings):
+        return embeddings.embed(texts)
+    vectors = np.asarray(embeddings.embed_documents(list(texts)), dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+@dataclass
+class SearchResult:
+    """A chunk matching a query."""
+
+    doc_id: str
+    text: str
+    score: float
+
+
+class DocIndex:
+    """BM25 and dense vector search over chunks persisted in a directory."""
+
+    def __init__(
+        self,
+        directory: str,
+        embeddings: Optional[Embeddings] = None,
+        k1: float = 1.5,
+        b: float = 0.75,
+        candidates: int = 50,
+    ) -> None:
+        """
+        Initialize the index, creating the directory if needed.
+
+        Args:
+            directory: Directory of the index files.
+            embeddings: Embeddings of the chunks and queries. Defaults to
+                `HashingEmbeddings`. An index keeps the dimension it was
+                created with.
+            k1: BM25 term frequency saturation.
+            b: BM25 length normalization.
+            candidates: Number of chunks taken from each ranking for fusion.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.embeddings = embeddings or HashingEmbeddings()
+        self.k1 = k1
+        self.b = b
+        self.candidates = candidates
+        self.path = os.path.join(directory, "chunks.sqlite")
+        self._vectors_path = os.path.join(directory, "vectors.f32")
+        self._lock = threading.Lock()
+        self._db = ProcessConnection(self.path)
+        with self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                "row INTEGER PRIMARY KEY, doc_id TEXT NOT NULL, "
+                "text TEXT NOT NULL, deleted INTEGER NOT NULL DEFAULT 0)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS chunks_doc_id ON chunks (doc_id)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS meta ("
+                "key TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+        self._load()
+
+    def _meta(self, key: str) -> Optional[int]:
+        row = self._db.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return None if row is None else int(row[0])
+
+    def _set_meta(self, key: str, value: int) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+        )
+
+    def _load(self) -> None:
+        """Read the chunks and map the vectors written so far."""
+        self._version = self._meta("version") or 0
+        self._compactions = self._meta("compactions") or 0
+        self._doc_ids: List[str] = []
+        self._rows_of: Dict[str, List[int]] = defaultdict(list)
+        # Rows and term frequencies of the chunks holding each term
+        self._postings: Dict[str, Tuple[array, array]] = {}
+        self._lengths = np.zeros(0, dtype=np.float32)
+        self._live = np.zeros(0, dtype=bool)
+        self._read_new_chunks()
+
+    def _read_new_chunks(self) -> bool:
+        """
+        Index the chunks added since the last read and return whether their
+        rows follow the ones read so far.
+        """
+        self._dim = self._meta("dim")
+        start = len(self._doc_ids)
+        lengths = array("i")
+        live = []
+        for row, doc_id, text, deleted in self._db.execute(
+            "SELECT row, doc_id, text, deleted FROM chunks WHERE row >= ? "
+            "ORDER BY row",
+            (start,),
+        ):
+            if row != start + len(live):
+                return False
+            self._doc_ids.append(doc_id)
+            lengths.append(self._index_text(row, text))
+            live.append(not deleted)
+            if not deleted:
+                self._rows_of[doc_id].append(row)
+        self._lengths = np.concatenate(
+            [self._lengths, np.asarray(lengths, dtype=np.float32)]
+        )
+        self._live = np.concatenate([self._live, np.asarray(live, dtype=bool)])
+        self._invalidate()
+        self._map_vectors()
+        return True
+
+    def _index_text(self, row: int, text: str) -> int:
+        """Add the terms of a chunk to the postings and return its length."""
+        tokens = tokenize(text)
+        for term, count in Counter(tokens).items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = (array("i"), array("i"))
+            postings[0].append(row)
+            postings[1].append(count)
+        return len(tokens)
+
+    def _invalidate(self) -> None:
+        """Drop the BM25 weights computed for the chunks as they were."""
+        # Term weights depend on the live chunks, their number and lengths,
+        # and the deleted chunks are masked out of the cosine scores
+        self._weights: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._norms: Optional[np.ndarray] = None
+        self._deleted: Optional[np.ndarray] = None
+
+    def _map_vectors(self) -> None:
+        rows = len(self._doc_ids)
+        if rows == 0 or self._dim is None:
+            self._vectors = np.zeros((0, self._dim or 0), dtype=np.float32)
+            return
+        # The file may hold more rows, written by an add that failed
+        self._vectors = np.memmap(
+            self._vectors_path, dtype=np.float32, mode="r", shape=(rows, self._dim)
+        )
+
+    def _refresh(self) -> None:
+        """Apply the writes of other processes since the index was read."""
+        version = self._meta("version") or 0
+        if version == self._version:
+            return
+        # A compaction renumbered the rows read so far
+        if (self._meta("compactions") or 0) != self._compactions:
+            self._load()
+            return
+        if not self._read_new_chunks():
+            self._load()
+            return
+        deleted = [
+            row
+            for (row,) in self._db.execute(
+                "SELECT row FROM chunks WHERE deleted = 1 AND row < ?",
+                (len(self._doc_ids),),
+            )
+            if self._live[row]
+        ]
+        for row in deleted:
+            self._live[row] = False
+            rows = self._rows_of[self._doc_ids[row]]
+            rows.remove(row)
+            if not rows:
+                del self._rows_of[self._doc_ids[row]]
+        self._version = version
+
+    @contextmanager
+    def _writing(self) -> Iterator[None]:
+        """Run a write in a transaction holding the database lock."""
+        with self._lock:
+            try:
+                with self._db:
+                    # Holds the database lock until the new version is written,
+                    # in case other processes write to the same index
+                    self._db.execute("BEGIN IMMEDIATE")
+                    self._refresh()
+                    yield
+            except BaseException:
+                # The transaction was rolled back: drop the changes in memory
+                self._load()
+                raise
+
+    def _commit_version(self) -> None:
+        self._version += 1
+        self._set_meta("version", self._version)
+
+    def __len__(self) -> int:
+        """Return the number of chunks that can be found."""
+        with self._lock:
+            self._refresh()
+            return int(self._live.sum())
+
+    def doc_ids(self) -> List[str]:
+        """Return the documents in the index."""
+        with self._lock:
+            self._refresh()
+            return list(self._rows_of)
+
+    def add(self, doc_id: str, chunks: Sequence[str]) -> None:
+        """
+        Add the chunks of a document, replacing any previous version of it.
+        Embeds the chunks and performs blocking I/O, so call it from a worker
+        thread.
+
+        Args:
+            doc_id: Identity of the document.
+            chunks: The text chunks of the document.
+        """
+        chunks = [chunk for chunk in chunks if chunk.strip()]
+        # Embed outside of the lock, as it may be slow
+        vectors = embed_array(self.embeddings, chunks) if chunks else None
+        with self._writing():
+            self._delete(doc_id)
+            if vectors is not None:
+                self._append(doc_id, chunks, vectors)
+            self._commit_version()
+
+    def _append(self, doc_id: str, chunks: List[str], vectors: np.ndarray) -> None:
+        if self._dim is None:
+            self._dim = int(vectors.shape[1])
+            self._set_meta("dim", self._dim)
+        elif vectors.shape[1] != self._dim:
+            raise ValueError(
+                f"Embeddings have {vectors.shape[1]} dimensions, "
+                f"the index has {self._dim}"
+            )
+        start = len(self._doc_ids)
+        with open(self._vectors_path, "ab") as f:
+            # Drop the rows written by an add that failed, if any
+            f.truncate(start * self._dim * 4)
+            f.write(vectors.tobytes())
+        rows = range(start, start + len(chunks))
+        self._db.executemany(
+            "INSERT INTO chunks (row, doc_id, text) VALUES (?, ?, ?)",
+            [(row, doc_id, text) for row, text in zip(rows, chunks)],
+        )
+        lengths = [self._index_text(row, text) for row, text in zip(rows, chunks)]
+        self._doc_ids.extend([doc_id] * len(chunks))
+        self._rows_of[doc_id].extend(rows)
+        self._lengths = np.concatenate(
+            [self._lengths, np.asarray(lengths, dtype=np.float32)]
+        )
+        self._live = np.concatenate([self._live, np.ones(len(chunks), dtype=bool)])
+        self._invalidate()
+        self._map_vectors()
+
+    def delete(self, doc_id: str) -> bool:
+        """
+        Delete a document and return whether it was in the index. Performs
+        blocking I/O, so call it from a worker thread.
+        """
+        with self._writing():
+            deleted = self._delete(doc_id)
+            if deleted:
+                self._commit_version()
+        return deleted
+
+    def _delete(self, doc_id: str) -> bool:
+        rows = self._rows_of.pop(doc_id, None)
+        if not rows:
+            return False
+        self._db.execute("UPDATE chunks SET deleted = 1 WHERE doc_id = ?", (doc_id,))
+        self._live[rows] = False
+        self._invalidate()
+        return True
+
+    def compact(self) -> None:
+        """
+        Rewrite the index without its deleted chunks. Performs blocking I/O,
+        so call it from a worker thread.
+        """
+        with self._writing():
+            kept = np.flatnonzero(self._live)
+            if len(kept) == len(self._live):
+                return
+            vectors = np.array(self._vectors[kept])
+            self._db.execute("DELETE FROM chunks WHERE deleted = 1")
+            # Rows move down in ascending order, so never onto a kept row
+            self._db.executemany(
+                "UPDATE chunks SET row = ? WHERE row = ?",
+                [(new, int(old)) for new, old in enumerate(kept) if new != old],
+            )
+            temporary_path = f"{self._vectors_path}.tmp"
+            with open(temporary_path, "wb") as f:
+                f.write(vectors.tobytes())
+            os.replace(temporary_path, self._vectors_path)
+            self._set_meta("compactions", self._compactions + 1)
+            self._commit_version()
+            self._load()
+
+    def search(self, query: str, k: int = 5) -> List[SearchResult]:
+        """
+        Return the chunks best matching a query, best first.
+
+        Args:
+            query: The query.
+            k: Maximum number of chunks returned.
+        """
+        query_vector = embed_array(self.embeddings, [query])[0]
+        with self._lock:
+            self._refresh()
+            if k <= 0 or not self._live.any():
+                return []
+            candidates = max(self.candidates, k)
+            fused: Dict[int, float] = defaultdict(float)
+            for scores in (self._bm25(query), self._cosine(query_vector)):
+                for rank, row in enumerate(self._top(scores, candidates)):
+                    fused[row] += 1.0 / (RRF_K + rank + 1)
+            best = sorted(fused.items(), key=lambda item: -item[1])[:k]
+            texts = dict(
+                self._db.execute(
+                    "SELECT row, text FROM chunks WHERE row IN "
+                    f"({', '.join('?' * len(best))})",
+                    [row for row, _ in best],
+                ).fetchall()
+            )
+            return [
+                SearchResult(self._doc_ids[row], texts[row], score)
+                for row, score in best
+            ]
+
+    def _term_weights(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the live chunks holding a term and their BM25 term scores."""
+        weights = self._weights.get(term)
+        if weights is not None:
+            return weights
+        if self._norms is None:
+            average_length = float(self._lengths[self._live].mean())
+            self._norms = self.k1 * (
+                1 - self.b + self.b * self._lengths / max(average_length, 1.0)
+            )
+        rows_array, tfs_array = self._postings.get(term, (array("i"), array("i")))
+        rows = np.array(rows_array, dtype=np.int64)
+        tfs = np.array(tfs_array, dtype=np.float32)
+        live = self._live[rows]
+        rows, tfs = rows[live], tfs[live]
+        live_count = int(self._live.sum())
+        idf = math.log(1 + (live_count - len(rows) + 0.5) / (len(rows) + 0.5))
+        weights = (rows, idf * tfs * (self.k1 + 1) / (tfs + self._norms[rows]))
+        self._weights[term] = weights
+        return weights
+
+    def _bm25(self, query: str) -> np.ndarray:
+        """Score the chunks with BM25, unmatched and deleted ones at -inf."""
+        scores = np.zeros(len(self._doc_ids), dtype=np.float32)
+        for term in set(tokenize(query)):
+            rows, weights = self._term_weights(term)
+            scores[rows] += weights
+        scores[scores <= 0] = -np.inf
+        return scores
+
+    def _cosine(self, query_vector: np.ndarray) -> np.ndarray:
+        """Score the chunks by cosine similarity, deleted ones at -inf."""
+        if self._vectors.shape[1] != len(query_vector):
+            return np.full(len(self._doc_ids), -np.inf, dtype=np.float32)
+        scores = np.asarray(self._vectors @ query_vector, dtype=np.float32)
+        if self._deleted is None:
+            self._deleted = np.flatnonzero(~self._live)
+        scores[self._deleted] = -np.inf
+        return scores
+
+    @staticmethod
+    def _top(scores: np.ndarray, n: int) -> List[int]:
+        """Return the rows of the n best finite scores, best first."""
+        if n < len(scores):
+            rows = np.argpartition(scores, len(scores) - n)[-n:]
+        else:
+            rows = np.arange(len(scores))
+        rows = rows[np.isfinite(scores[rows])]
+        return rows[np.argsort(-scores[rows], kind="stable")].tolist()
+
+
+class DocIndexRegistry:
+    """The document indexes of users, in directories under a root."""
+
+    def __init__(
+        self,
+        root: str,
+        embeddings: Optional[Embeddings] = None,
+        max_open: int = 64,
+    ) -> None:
+        """
+        Initialize the registry.
+
+        Args:
+            root: Directory holding one index directory per user.
+            embeddings: Embeddings of the indexes. Defaults to
+                `HashingEmbeddings`.
+            max_open: Maximum number of indexes kept loaded in memory.
+        """
+        if max_open <= 0:
+            raise ValueError("max_open must be positive")
+        self.root = root
+        self.embeddings = embeddings or HashingEmbeddings()
+        self.max_open = max_open
+        # Indexes by user, pending while they are being loaded
+        self._indexes: "OrderedDict[str, Future[DocIndex]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def directory_of(self, user_id: str) -> str:
+        """Return the index directory of a user."""
+        # User ids are not safe to use as file names
+        return os.path.join(
+            self.root, hashlib.sha256(user_id.encode()).hexdigest()[:32]
+        )
+
+    def get(self, user_id: str) -> DocIndex:
+        """
+        Return the index of a user, loading or creating it if needed. Loading
+        an index tokenizes all its chunks, which takes seconds for tens of
+        thousands of them: it runs outside of the registry lock, so that only
+        the calls of that user wait for it.
+        """
+        with self._lock:
+            future = self._indexes.get(user_id)
+            loading = future is None
+            if future is None:
+                future = self._indexes[user_id] = Future()
+                # Evicted indexes are closed once the calls using them are done
+                if len(self._indexes) > self.max_open:
+                    self._indexes.popitem(last=False)
+            else:
+                self._indexes.move_to_end(user_id)
+        if loading:
+            try:
+                future.set_result(DocIndex(self.directory_of(user_id), self.embeddings))
+            except BaseException as e:
+                future.set_exception(e)
+                # The next call loads the index again
+                with self._lock:
+                    if self._indexes.get(user_id) is future:
+                        del self._indexes[user_id]
+        return future.result()
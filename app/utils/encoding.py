@@ -0,0 +1,134 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fast NDJSON encoding for the streaming event path.
+
+Events are encoded with orjson, a dependency of the server on CPython, when it
+is available. Pydantic models, such as the AIMessageChunk carried by every
+`on_chat_model_stream` event, are converted with a shallow field lookup that
+is cached per class instead of a recursive `model_dump()`: nested models are
+handed back to the encoder, which converts them the same way.
+
+The produced JSON carries the same fields as
+`json.dumps(event, default=default_serialization)`.
+"""
+import json
+from typing import Any, Callable, Dict, Optional, Tuple, Type
+
+from app.utils.output_types import EndEvent
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is not available on PyPy
+    orjson = None  # type: ignore[assignment]
+
+_MODEL_FIELDS: Dict[Type[BaseModel], Tuple[str, ...]] = {}
+
+
+def _model_fields(cls: Type[BaseModel]) -> Tuple[str, ...]:
+    """Return the field names of a pydantic model class, cached per class."""
+    fields = _MODEL_FIELDS.get(cls)
+    if fields is None:
+        fields = tuple(cls.model_fields)
+        _MODEL_FIELDS[cls] = fields
+    return fields
+
+
+def model_to_dict(obj: BaseModel) -> Dict[str, Any]:
+    """
+    Build a shallow dictionary of the fields of a pydantic model.
+    Extra fields of models allowing them are included, as in `model_dump()`.
+    """
+    data = {name: getattr(obj, name) for name in _model_fields(type(obj))}
+    if obj.__pydantic_extra__:
+        data.update(obj.__pydantic_extra__)
+    return data
+
+
+def fast_serialization(obj: Any) -> Any:
+    """
+    Default hook of the encoder, converting pydantic models to dictionaries.
+    Unsupported objects are encoded as null, like `default_serialization`.
+    """
+    if isinstance(obj, BaseModel):
+        return model_to_dict(obj)
+    return None
+
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS
+
+    def encode_event(event: Any) -> bytes:
+        """Encode an event as a single NDJSON line."""
+        return orjson.dumps(event, default=fast_serialization, option=_OPTIONS)
+
+else:
+
+    def encode_event(event: Any) -> bytes:
+        """Encode an event as a single NDJSON line."""
+        return (json.dumps(event, default=fast_serialization) + "\n").encode("utf-8")
+
+
+def metadata_event(
+    run_id: str, session_version: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    Build the metadata event opening every stream.
+
+    Args:
+        run_id: Identifier of the run, used to attach feedback.
+        session_version: Version of the stored session history, if the request
+            updated one.
+    """
+    data: Dict[str, Any] = {"run_id": run_id}
+    if session_version is not None:
+        data["session_version"] = session_version
+    return {"event": "metadata", "data": data}
+
+
+def encode_metadata(run_id: str, session_version: Optional[int] = None) -> bytes:
+    """Encode the metadata event opening every stream."""
+    return encode_event(metadata_event(run_id, session_version))
+
+
+class WireFormat:
+    """An encoding of the event stream, negotiated per request."""
+
+    def __init__(
+        self, name: str, media_type: str, encode_event: Callable[[Any], bytes]
+    ) -> None:
+        """
+        Initialize the format.
+
+        Args:
+            name: Short name of the format.
+            media_type: Content type of the responses in this format.
+            encode_event: Encodes an event as a single frame.
+        """
+        self.name = name
+        self.media_type = media_type
+        self.encode_event = encode_event
+        # The end event never changes, so it is encoded once
+        self.end_frame = encode_event(EndEvent())
+
+    def encode_metadata(
+        self, run_id: str, session_version: Optional[int] = None
+    ) -> bytes:
+        """Encode the metadata event opening every stream."""
+        return self.encode_event(metadata_event(run_id, session_version))
+
+
+NDJSON = WireFormat("ndjson", "text/event-stream", encode_event)
+END_FRAME = NDJSON.end_frame
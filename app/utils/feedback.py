@@ -0,0 +1,330 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Non-blocking sink for user feedback.
+
+Feedback entries are queued in memory and written in batches by a background
+task, with the blocking backend calls running in a worker thread. When the
+queue is full, or a batch cannot be written, entries are spilled to a local
+JSONL file and replayed later, backing off while the backend keeps failing.
+Spilled lines that cannot be parsed are moved to a `.corrupt` file next to it.
+"""
+import asyncio
+from collections import deque
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Protocol
+
+
+class FeedbackBackend(Protocol):
+    """Destination of feedback entries."""
+
+    def write_batch(self, entries: List[Dict[str, Any]]) -> None:
+        """Write a batch of entries, raising on failure."""
+
+
+class CloudLoggingFeedbackBackend:
+    """Writes feedback to Google Cloud Logging, one API call per batch."""
+
+    def __init__(self, get_logger: Callable[[], Any]) -> None:
+        """
+        Initialize the backend.
+
+        Args:
+            get_logger: Returns the Cloud Logging logger. It is called on the
+                first write, so the client is not created at import time.
+        """
+        self.get_logger = get_logger
+
+    def write_batch(self, entries: List[Dict[str, Any]]) -> None:
+        """Write the entries as structured log entries."""
+        with self.get_logger().batch() as batch:
+            for entry in entries:
+                batch.log_struct(entry, severity="INFO")
+
+
+class LocalFileFeedbackBackend:
+    """Appends feedback to a local JSONL file, standing in for Cloud Logging."""
+
+    def __init__(self, path: str) -> None:
+        """Initialize the backend with the path of the JSONL file."""
+        self.path = path
+
+    def write_batch(self, entries: List[Dict[str, Any]]) -> None:
+        """Append the entries to the file."""
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(entry) + "\n" for entry in entries)
+
+
+class FeedbackSink:
+    """A bounded queue of feedback entries flushed in the background."""
+
+    def __init__(
+        self,
+        backend: FeedbackBackend,
+        spill_path: str,
+        max_queue_size: int = 1000,
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+        max_replay_delay: float = 300.0,
+    ) -> None:
+        """
+        Initialize the sink.
+
+        Args:
+            backend: Where the entries are written.
+            spill_path: JSONL file receiving the entries that do not fit in the
+                queue or could not be written.
+            max_queue_size: Maximum number of entries held in memory.
+            batch_size: Maximum number of entries written per backend call.
+            flush_interval: Seconds between two flushes of a partial batch.
+            max_replay_delay: Maximum seconds between two replays of the spill
+                file by the background task while the backend fails.
+        """
+        self.backend = backend
+        self.spill_path = spill_path
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_replay_delay = max_replay_delay
+        self.written = 0
+        self.spilled = 0
+        self.failed_batches = 0
+        self.corrupt = 0
+        # Back-off of the background replays after failures
+        self._replay_delay = 0.0
+        self._replay_after = 0.0
+        self._queue: Deque[Dict[str, Any]] = deque()
+        # Entries beyond the queue capacity, waiting to be spilled
+        self._overflow: List[Dict[str, Any]] = []
+        self._spilling: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of entries waiting in memory."""
+        return len(self._queue)
+
+    def submit(self, entry: Dict[str, Any]) -> None:
+        """
+        Queue an entry without blocking. Must be called from the event loop.
+        Entries exceeding the queue capacity are spilled to disk from a worker
+        thread.
+        """
+        self._ensure_worker()
+        if len(self._queue) >= self.max_queue_size:
+            self._overflow.append(entry)
+            # The spill file may be locked by the replay of another process
+            if self._spilling is None or self._spilling.done():
+                self._spilling = asyncio.get_running_loop().create_task(
+                    self._spill_overflow()
+                )
+            return
+        self._queue.append(entry)
+        if len(self._queue) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self) -> None:
+        """Start the background flush task on the running event loop."""
+        self._stopping = False
+        self._ensure_worker()
+
+    async def stop(self) -> None:
+        """Stop the background task and flush every queued and spilled entry."""
+        self._stopping = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Write the queued entries, then replay the spilled ones."""
+        await self._write_queue()
+        await self._replay()
+
+    def stats(self) -> Dict[str, int]:
+        """Return the sink counters."""
+        return {
+            "queue_depth": len(self._queue),
+            "written": self.written,
+            "spilled": self.spilled,
+            "failed_batches": self.failed_batches,
+            "corrupt": self.corrupt,
+        }
+
+    def _ensure_worker(self) -> None:
+        """Start the worker if it is not running on the current event loop."""
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        """Flush the queue every flush_interval, or as soon as a batch is full."""
+        wakeup = self._wakeup
+        assert wakeup is not None
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+            if self._stopping:
+                break
+            try:
+                await self._write_queue()
+                if time.monotonic() >= self._replay_after:
+                    await self._replay()
+            except Exception as e:
+                logging.error("Failed to flush feedback: %s", e)
+
+    async def _write_queue(self) -> None:
+        """Write the queued entries in batches."""
+        while self._queue:
+            batch = [
+                self._queue.popleft()
+                for _ in range(min(self.batch_size, len(self._queue)))
+            ]
+            await self._write(batch)
+
+    async def _replay(self) -> None:
+        """Replay the spill file, if any, and schedule the next replay."""
+        if self._spilling is not None:
+            await self._spilling
+        if not os.path.exists(self.spill_path):
+            return
+        if await asyncio.to_thread(self._replay_spill):
+            self._replay_delay = 0.0
+        else:
+            self._replay_delay = min(
+                max(2 * self._replay_delay, self.flush_interval),
+                self.max_replay_delay,
+            )
+        self._replay_after = time.monotonic() + self._replay_delay
+
+    async def _write(self, batch: List[Dict[str, Any]]) -> None:
+        """Write a batch, spilling it to disk if the backend fails."""
+        try:
+            await asyncio.to_thread(self.backend.write_batch, batch)
+            self.written += len(batch)
+        except Exception as e:
+            self.failed_batches += 1
+            logging.error("Failed to write %d feedback entries: %s", len(batch), e)
+            await asyncio.to_thread(self._spill, batch)
+
+    async def _spill_overflow(self) -> None:
+        """Spill the overflowing entries, including those submitted meanwhile."""
+        while self._overflow:
+            entries, self._overflow = self._overflow, []
+            try:
+                await asyncio.to_thread(self._spill, entries)
+            except Exception as e:
+                logging.error(
+                    "Failed to spill %d feedback entries: %s", len(entries), e
+                )
+
+    @contextmanager
+    def _spill_lock(self) -> Iterator[None]:
+        """Hold the lock of the spill file, which server processes share."""
+        with open(f"{self.spill_path}.lock", "a", encoding="utf-8") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _spill(self, entries: List[Dict[str, Any]]) -> None:
+        """Append entries to the spill file."""
+        with self._spill_lock():
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(entry) + "\n" for entry in entries)
+        self.spilled += len(entries)
+
+    def _replay_spill(self) -> bool:
+        """
+        Write the spilled entries to the backend, keeping them on failure.
+
+        Returns:
+            Whether every spilled entry was written.
+        """
+        # Other processes neither spill nor replay meanwhile
+        with self._spill_lock():
+            if not os.path.exists(self.spill_path):
+                return True
+            # Whether the file no longer matches the entries left to write
+            changed = False
+            with open(self.spill_path, encoding="utf-8") as f:
+                # The batch being built, and the lines of its entries
+                batch: List[Dict[str, Any]] = []
+                lines: List[str] = []
+                for line in f:
+                    if not line.endswith("\n"):
+                        # Spilled by a process killed while writing
+                        line += "\n"
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        if line.strip():
+                            self._quarantine(line)
+                        changed = True
+                        continue
+                    batch.append(entry)
+                    lines.append(line)
+                    if len(batch) == self.batch_size:
+                        if not self._replay_batch(batch):
+                            break
+                        batch, lines, changed = [], [], True
+                else:
+                    if not batch or self._replay_batch(batch):
+                        os.remove(self.spill_path)
+                        return True
+                # The file is only rewritten once the batches are written, so
+                # an interrupted replay writes entries twice rather than
+                # losing them. It is left as is when nothing was written.
+                if changed:
+                    rest = f.read()
+                    if rest and not rest.endswith("\n"):
+                        rest += "\n"
+                    with open(f"{self.spill_path}.tmp", "w", encoding="utf-8") as out:
+                        out.writelines(lines)
+                        out.write(rest)
+                    os.replace(f"{self.spill_path}.tmp", self.spill_path)
+            return False
+
+    def _replay_batch(self, batch: List[Dict[str, Any]]) -> bool:
+        """Write a batch of spilled entries, returning whether it succeeded."""
+        try:
+            self.backend.write_batch(batch)
+        except Exception as e:
+            self.failed_batches += 1
+            logging.error("Failed to replay spilled feedback: %s", e)
+            return False
+        self.written += len(batch)
+        return True
+
+    def _quarantine(self, line: str) -> None:
+        """Move a spilled line that is not valid JSON out of the spill file."""
+        path = f"{self.spill_path}.corrupt"
+        logging.error("Moving corrupt spilled feedback to %s", path)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(line)
+        self.corrupt += 1
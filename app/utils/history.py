@@ -0,0 +1,234 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Token-budgeted history window with a rolling summary.
+
+Instead of the whole conversation, the model is sent its most recent turns
+within a token budget, preceded by a summary of the older ones. Older turns
+are folded into the summary in batches of at least `fold_tokens`, each batch
+updating the previous summary, so the input of a model call stays under about
+`max_tokens + fold_tokens` however long the conversation gets, and the
+summarizer only runs once per batch.
+
+The summary and the number of messages it covers are kept in the agent
+`memory`, which lasts for a run. Summaries are also cached in the process,
+keyed by a digest of the messages they cover, so the next turns of a
+conversation resume from them instead of summarizing it again.
+
+Token counts are estimated locally, at about four characters per token.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+import hashlib
+import json
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    HumanMessage,
+    SystemMessage,
+    get_buffer_string,
+)
+from langchain_core.runnables import Runnable, RunnableConfig
+
+# Tokens taken by the role and separators of a message
+MESSAGE_OVERHEAD_TOKENS = 4
+CHARS_PER_TOKEN = 4
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+
+def message_text(message: BaseMessage) -> str:
+    """Return the text of a message, including its tool calls."""
+    content = message.content
+    if isinstance(content, str):
+        text = content
+    else:
+        text = "".join(
+            part if isinstance(part, str) else str(part.get("text", ""))
+            for part in content
+        )
+    if isinstance(message, AIMessage) and message.tool_calls:
+        text += json.dumps(
+            [[call["name"], call["args"]] for call in message.tool_calls],
+            default=str,
+        )
+    return text
+
+
+def estimate_tokens(message: BaseMessage) -> int:
+    """Estimate the number of tokens of a message."""
+    return -(-len(message_text(message)) // CHARS_PER_TOKEN) + MESSAGE_OVERHEAD_TOKENS
+
+
+def _digest(previous: bytes, message: BaseMessage) -> bytes:
+    """Extend the digest of a conversation prefix with its next message."""
+    return hashlib.sha1(
+        previous + message.type.encode() + b"\0" + message_text(message).encode()
+    ).digest()
+
+
+@dataclass
+class _Plan:
+    """What to fold into the summary before a model call."""
+
+    summary: Optional[str]
+    summarized: int
+    start: int
+    to_fold: List[BaseMessage]
+    digest: bytes
+
+
+class HistoryManager:
+    """Builds the history sent to the model and maintains its summary."""
+
+    def __init__(
+        self,
+        summarizer: Runnable,
+        max_tokens: int = 4000,
+        fold_tokens: int = 1000,
+        cache_size: int = 1024,
+    ) -> None:
+        """
+        Initialize the history manager.
+
+        Args:
+            summarizer: Runnable taking the previous `summary` and the
+                `conversation` to fold into it, and returning the new summary
+                as a message or a string.
+            max_tokens: Token budget of the recent messages sent verbatim.
+                The current turn is always sent whole.
+            fold_tokens: Minimum size of the older messages folded into the
+                summary at once.
+            cache_size: Number of summaries cached in the process.
+        """
+        if max_tokens <= 0 or fold_tokens <= 0:
+            raise ValueError("max_tokens and fold_tokens must be positive")
+        self.summarizer = summarizer
+        self.max_tokens = max_tokens
+        self.fold_tokens = fold_tokens
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[bytes, Tuple[int, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def window_start(self, messages: Sequence[BaseMessage]) -> int:
+        """
+        Return the index of the oldest message within the token budget.
+
+        The window starts on a human message, so that tool results are never
+        separated from their calls.
+        """
+        turn_starts = [
+            i for i, message in enumerate(messages) if isinstance(message, HumanMessage)
+        ]
+        if not turn_starts:
+            return 0
+        tokens = 0
+        start = len(messages)
+        for i in range(len(messages) - 1, -1, -1):
+            tokens += estimate_tokens(messages[i])
+            if tokens > self.max_tokens:
+                break
+            start = i
+        kept = [i for i in turn_starts if i >= start]
+        return kept[0] if kept else turn_starts[-1]
+
+    def _plan(self, messages: Sequence[BaseMessage], memory: Dict[str, Any]) -> _Plan:
+        start = self.window_start(messages)
+        summary: Optional[str] = memory.get("summary")
+        summarized = memory.get("summarized", 0)
+        if summarized > start or (summarized and summary is None):
+            summary, summarized = None, 0
+
+        # Digests of the prefixes up to the window, to resume from a summary
+        # computed on an earlier turn of the conversation
+        digest = b""
+        for i, message in enumerate(messages[:start]):
+            digest = _digest(digest, message)
+            if i + 1 > summarized:
+                with self._lock:
+                    cached = self._cache.get(digest)
+                    if cached is not None:
+                        self._cache.move_to_end(digest)
+                if cached is not None:
+                    summarized, summary = cached
+
+        pending = messages[summarized:start]
+        if sum(estimate_tokens(message) for message in pending) < self.fold_tokens:
+            pending = []
+        return _Plan(summary, summarized, start, list(pending), digest)
+
+    def _finish(
+        self,
+        messages: Sequence[BaseMessage],
+        plan: _Plan,
+        folded: Optional[Any] = None,
+    ) -> Tuple[List[BaseMessage], Dict[str, Any]]:
+        summary, summarized = plan.summary, plan.summarized
+        if folded is not None:
+            summary = folded.content if isinstance(folded, BaseMessage) else folded
+            summarized = plan.start
+            with self._lock:
+                self._cache[plan.digest] = (summarized, summary)
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        window = list(messages[summarized:])
+        if summary:
+            window.insert(0, SystemMessage(content=SUMMARY_PREFIX + summary))
+        return window, {"summary": summary, "summarized": summarized}
+
+    def _summarizer_input(self, plan: _Plan) -> Dict[str, str]:
+        return {
+            "summary": plan.summary or "",
+            "conversation": get_buffer_string(plan.to_fold),
+        }
+
+    def window(
+        self,
+        messages: Sequence[BaseMessage],
+        memory: Dict[str, Any],
+        config: Optional[RunnableConfig] = None,
+    ) -> Tuple[List[BaseMessage], Dict[str, Any]]:
+        """
+        Build the history to send to the model, folding older turns into the
+        summary when they are due.
+
+        Args:
+            messages: The whole conversation.
+            memory: The agent memory, holding the current summary.
+            config: Config of the summarizer run.
+
+        Returns:
+            The messages to send, and the updated memory.
+        """
+        plan = self._plan(messages, memory)
+        folded = None
+        if plan.to_fold:
+            folded = self.summarizer.invoke(self._summarizer_input(plan), config)
+        return self._finish(messages, plan, folded)
+
+    async def awindow(
+        self,
+        messages: Sequence[BaseMessage],
+        memory: Dict[str, Any],
+        config: Optional[RunnableConfig] = None,
+    ) -> Tuple[List[BaseMessage], Dict[str, Any]]:
+        """Async version of `window`."""
+        plan = self._plan(messages, memory)
+        folded = None
+        if plan.to_fold:
+            folded = await self.summarizer.ainvoke(self._summarizer_input(plan), config)
+        return self._finish(messages, plan, folded)
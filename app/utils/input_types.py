@@ -14,22 +14,37 @@
 
 from typing import Annotated, Any, List, Literal, Optional, Union
 
-from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
-from pydantic import BaseModel, Field
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+from pydantic import BaseModel, Field, TypeAdapter
+
+
+# A chat message, parsed according to its type
+ChatMessage = Annotated[
+    Union[HumanMessage, AIMessage, ToolMessage], Field(discriminator="type")
+]
+
+# Validates lists of chat messages outside of InputChat
+MESSAGES_ADAPTER: TypeAdapter[List[BaseMessage]] = TypeAdapter(List[ChatMessage])
 
 
 class InputChat(BaseModel):
     """Represents the input for a chat session."""
 
-    messages: List[
-        Annotated[
-            Union[HumanMessage, AIMessage, ToolMessage], Field(discriminator="type")
-        ]
-    ] = Field(
+    messages: List[ChatMessage] = Field(
         ..., description="The chat messages representing the current conversation."
     )
     user_id: str = ""
     session_id: str = ""
+    session_version: Optional[int] = Field(
+        None,
+        description=(
+            "Version of the history stored on the server for the session. When "
+            "set, `messages` only holds the messages added since that version, "
+            "and 0 replaces the stored history with `messages`. When unset, "
+            "`messages` holds the whole conversation and nothing is stored."
+        ),
+        ge=0,
+    )
 
 
 class Input(BaseModel):
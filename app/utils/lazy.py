@@ -0,0 +1,97 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Deferred loading of chains.
+
+Chain modules authenticate with Google Cloud and build their Vertex AI clients
+at import time. Wrapping them in a LazyChain keeps that work out of the
+server import, so it can run after the server has started accepting
+connections.
+"""
+import hashlib
+import importlib
+import importlib.util
+import os
+import threading
+import time
+from typing import Any, Optional
+
+
+class LazyChain:
+    """A proxy importing a chain on first use."""
+
+    def __init__(self, import_path: str) -> None:
+        """
+        Initialize the proxy.
+
+        Args:
+            import_path: Location of the chain as `module` or `module:attribute`.
+                The attribute defaults to `chain`.
+        """
+        module_name, _, attribute = import_path.partition(":")
+        self.import_path = import_path
+        self.module_name = module_name
+        self.attribute = attribute or "chain"
+        self.load_seconds: Optional[float] = None
+        self._chain: Any = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        """Whether the chain has been imported."""
+        return self._chain is not None
+
+    def load(self) -> Any:
+        """
+        Import the chain module and return the chain.
+        Safe to call from several threads; the import runs once. A failed
+        import is retried on the next call.
+        """
+        if self._chain is None:
+            with self._lock:
+                if self._chain is None:
+                    start = time.perf_counter()
+                    module = importlib.import_module(self.module_name)
+                    self._chain = getattr(module, self.attribute)
+                    self.load_seconds = time.perf_counter() - start
+        return self._chain
+
+    def source_digest(self) -> str:
+        """
+        Return a hash of the sources of the chain package, without importing
+        the chain. The chain module and its siblings hold the model names,
+        parameters, prompts and tools of the chain, so the hash changes with
+        them.
+        """
+        spec = importlib.util.find_spec(self.module_name)
+        if spec is None or spec.origin is None:
+            raise ImportError(f"No module named {self.module_name!r}")
+        directory = os.path.dirname(spec.origin)
+        digest = hashlib.sha256()
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".py"):
+                digest.update(name.encode())
+                with open(os.path.join(directory, name), "rb") as f:
+                    digest.update(f.read())
+        return digest.hexdigest()[:16]
+
+    def __getattr__(self, name: str) -> Any:
+        # Only called for attributes missing on the proxy itself
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.loaded else "not loaded"
+        return f"LazyChain({self.import_path!r}, {state})"
@@ -0,0 +1,396 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Minimal Prometheus metrics for the serving path.
+
+Metrics are updated from the event loop, so they are plain counters without
+locks: a histogram observation is a bisect and an integer increment, and the
+cumulative bucket counts are only computed when the metrics are scraped.
+"""
+import asyncio
+import bisect
+import math
+import time
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+from app.utils.streams import aclose
+
+T = TypeVar("T")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Bucket bounds in seconds for latencies, from a few milliseconds to a minute
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+RATE_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500)
+# Bucket bounds for the number of model and tool calls of a request
+CALL_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30)
+
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def format_value(value: float) -> str:
+    """Format a sample value as expected by the text exposition format."""
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    """Format the labels of a sample, escaping their values."""
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'),
+        )
+        for name, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+class Metric:
+    """Base class of the metrics."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+
+    def samples(self) -> Iterable[Sample]:
+        """Return the samples of the metric."""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        """Render the metric in the Prometheus text exposition format."""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        lines.extend(
+            f"{name}{format_labels(labels)} {format_value(value)}"
+            for name, labels, value in self.samples()
+        )
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """A monotonically increasing value, optionally split by one label."""
+
+    type = "counter"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label: Optional[str] = None,
+        function: Optional[Callable[[], float]] = None,
+    ) -> None:
+        """
+        Initialize the counter.
+
+        Args:
+            name: Name of the metric.
+            documentation: Help text of the metric.
+            label: Name of the label splitting the counter, if any.
+            function: Reads the value from another object instead of the
+                counter being incremented.
+        """
+        super().__init__(name, documentation)
+        self.label = label
+        self.function = function
+        self.values: Dict[str, float] = {}
+
+    def inc(self, amount: float = 1, label_value: str = "") -> None:
+        """Increment the counter."""
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def samples(self) -> Iterable[Sample]:
+        if self.function is not None:
+            return [(self.name, {}, self.function())]
+        return [
+            (self.name, {self.label: key} if self.label else {}, value)
+            for key, value in sorted(self.values.items())
+        ]
+
+
+class Gauge(Metric):
+    """A value going up and down."""
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        function: Optional[Callable[[], float]] = None,
+    ) -> None:
+        """
+        Initialize the gauge.
+
+        Args:
+            name: Name of the metric.
+            documentation: Help text of the metric.
+            function: Reads the value from another object at scrape time.
+        """
+        super().__init__(name, documentation)
+        self.function = function
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        """Increase the gauge."""
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        """Decrease the gauge."""
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        """Set the gauge."""
+        self.value = value
+
+    def samples(self) -> Iterable[Sample]:
+        value = self.function() if self.function is not None else self.value
+        return [(self.name, {}, value)]
+
+
+class Histogram(Metric):
+    """Counts of observations in fixed buckets, plus their sum."""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        """
+        Initialize the histogram.
+
+        Args:
+            name: Name of the metric.
+            documentation: Help text of the metric.
+            buckets: Sorted upper bounds of the buckets; +Inf is implied.
+        """
+        super().__init__(name, documentation)
+        self.bounds = list(buckets)
+        # One count per bucket, the last one being +Inf; not cumulative
+        self.counts: List[int] = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """Record an observation."""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        """Number of observations."""
+        return sum(self.counts)
+
+    def samples(self) -> Iterable[Sample]:
+        samples: List[Sample] = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + [math.inf], self.counts):
+            cumulative += count
+            samples.append(
+                (f"{self.name}_bucket", {"le": format_value(bound)}, cumulative)
+            )
+        samples.append((f"{self.name}_sum", {}, self.sum))
+        samples.append((f"{self.name}_count", {}, cumulative))
+        return samples
+
+
+class Registry:
+    """A collection of metrics rendered together."""
+
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Any:
+        """Add a metric and return it."""
+        if metric.name in self.metrics:
+            raise ValueError(f"Duplicate metric {metric.name}")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        return "".join(metric.render() for metric in self.metrics.values())
+
+
+class StreamMetrics:
+    """Latency and throughput metrics of the chat streams."""
+
+    def __init__(self, registry: Registry) -> None:
+        """Create the streaming metrics in a registry."""
+        self.active_streams: Gauge = registry.register(
+            Gauge("chat_active_streams", "Chat streams being served.")
+        )
+        self.stream_duration: Histogram = registry.register(
+            Histogram(
+                "chat_stream_duration_seconds", "Total duration of the chat streams."
+            )
+        )
+        self.time_to_first_token: Histogram = registry.register(
+            Histogram(
+                "chat_time_to_first_token_seconds",
+                "Time from the request to the first model chunk.",
+            )
+        )
+        self.inter_token_gap: Histogram = registry.register(
+            Histogram(
+                "chat_inter_token_gap_seconds",
+                "Time between two consecutive model chunks.",
+            )
+        )
+        self.tokens_per_second: Histogram = registry.register(
+            Histogram(
+                "chat_tokens_per_second",
+                "Output tokens per second, from the first to the last model chunk.",
+                buckets=RATE_BUCKETS,
+            )
+        )
+        self.model_calls: Histogram = registry.register(
+            Histogram(
+                "chat_model_calls_per_request",
+                "Streamed model calls made to answer a request.",
+                buckets=CALL_BUCKETS,
+            )
+        )
+        self.tool_calls: Histogram = registry.register(
+            Histogram(
+                "chat_tool_calls_per_request",
+                "Tool calls made to answer a request.",
+                buckets=CALL_BUCKETS,
+            )
+        )
+        self.events: Counter = registry.register(
+            Counter("chat_stream_events_total", "Events streamed, by type.", "event")
+        )
+        self.cancellations: Counter = registry.register(
+            Counter(
+                "chat_stream_cancellations_total",
+                "Chat streams cancelled before their end, e.g. by a disconnect.",
+            )
+        )
+
+    async def measure(
+        self, stream: AsyncIterable[T], started_at: float
+    ) -> AsyncGenerator[T, None]:
+        """
+        Forward a response stream, counting it as active until it ends and
+        as cancelled if it is closed or cancelled before its end.
+
+        Args:
+            stream: The response stream.
+            started_at: time.perf_counter() at the start of the request.
+        """
+        self.active_streams.inc()
+        try:
+            async for item in stream:
+                yield item
+        except (asyncio.CancelledError, GeneratorExit):
+            self.cancellations.inc()
+            raise
+        finally:
+            self.active_streams.dec()
+            await aclose(stream)
+            self.stream_duration.observe(time.perf_counter() - started_at)
+
+    async def track(
+        self,
+        events: AsyncIterable[Dict[str, Any]],
+        started_at: float,
+        chunk_event: str = "on_chat_model_stream",
+        tool_event: str = "on_tool_start",
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        Forward chain events while measuring the model chunks, and count the
+        model calls, by the runs streaming chunks, and tool calls of the
+        request.
+
+        Args:
+            events: The chain events, before any coalescing.
+            started_at: time.perf_counter() at the start of the request.
+            chunk_event: Name of the events carrying model chunks.
+            tool_event: Name of the events starting a tool call.
+        """
+        first_chunk_at: Optional[float] = None
+        last_chunk_at = 0.0
+        chunks = 0
+        reported_tokens = 0
+        model_runs: Set[Any] = set()
+        tool_calls = 0
+        try:
+            async for event in events:
+                event_type = event.get("event", "")
+                self.events.inc(label_value=event_type)
+                if event_type == chunk_event:
+                    now = time.perf_counter()
+                    if first_chunk_at is None:
+                        first_chunk_at = now
+                        self.time_to_first_token.observe(now - started_at)
+                    else:
+                        self.inter_token_gap.observe(now - last_chunk_at)
+                    last_chunk_at = now
+                    chunks += 1
+                    model_runs.add(event.get("run_id"))
+                    usage = getattr(
+                        event.get("data", {}).get("chunk"), "usage_metadata", None
+                    )
+                    if usage:
+                        reported_tokens += usage.get("output_tokens", 0)
+                elif event_type == tool_event:
+                    tool_calls += 1
+                yield event
+        finally:
+            await aclose(events)
+        self.model_calls.observe(len(model_runs))
+        self.tool_calls.observe(tool_calls)
+        if first_chunk_at is not None and last_chunk_at > first_chunk_at:
+            # Providers without usage metadata stream about one token per chunk
+            tokens = reported_tokens or chunks
+            self.tokens_per_second.observe(tokens / (last_chunk_at - first_chunk_at))
@@ -0,0 +1,138 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""MessagePack encoding of the event stream.
+
+Clients opt in with `Accept: application/x-msgpack`. Every event is a
+MessagePack map preceded by its length as a 4-byte big-endian integer, so a
+frame can be decoded with a plain `unpackb` once it has been fully received.
+
+Events are slimmed down to the fields the UI reads: model chunks only keep
+their `content` and `additional_kwargs`, tool messages their `content`,
+`name`, `tool_call_id` and `status`. Events of other types are sent whole.
+
+The packer is ormsgpack, a dependency of the server on CPython, or msgpack
+elsewhere. Without either, `MSGPACK` is None and every response is NDJSON.
+"""
+import struct
+from typing import Any, Callable, Dict, Optional
+
+from app.utils.encoding import WireFormat, fast_serialization
+from langchain_core.messages import BaseMessage
+
+MEDIA_TYPE = "application/x-msgpack"
+
+_packb: Optional[Callable[[Any], bytes]]
+try:
+    import ormsgpack
+
+    def _packb(obj: Any) -> bytes:
+        return ormsgpack.packb(obj, default=fast_serialization)
+
+except ImportError:  # pragma: no cover - ormsgpack is not available on PyPy
+    try:
+        import msgpack
+
+        def _packb(obj: Any) -> bytes:
+            return msgpack.packb(obj, default=fast_serialization)
+
+    except ImportError:
+        _packb = None
+
+_LENGTH = struct.Struct(">I")
+
+
+def _field(obj: Any, name: str) -> Any:
+    """Read a field of an event part, which is a dict or a pydantic model."""
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def _slim_output(output: Any) -> Any:
+    """Keep the fields of a tool message read by the UI."""
+    if isinstance(output, BaseMessage) or (
+        isinstance(output, dict) and "tool_call_id" in output
+    ):
+        return {
+            name: _field(output, name)
+            for name in ("content", "name", "tool_call_id", "status")
+            if _field(output, name) is not None
+        }
+    return output
+
+
+def slim_event(event: Any) -> Any:
+    """Reduce an event to the fields consumed by the UI."""
+    name = _field(event, "event")
+    data = _field(event, "data") or {}
+    if name == "on_chat_model_stream":
+        chunk = _field(data, "chunk")
+        return {
+            "event": name,
+            "data": {
+                "chunk": {
+                    "content": _field(chunk, "content"),
+                    "additional_kwargs": _field(chunk, "additional_kwargs") or {},
+                }
+            },
+        }
+    if name in ("on_tool_start", "on_retriever_start"):
+        return {
+            "event": name,
+            "name": _field(event, "name"),
+            "data": {"input": _field(data, "input")},
+        }
+    if name in ("on_tool_end", "on_retriever_end"):
+        return {
+            "event": name,
+            "name": _field(event, "name"),
+            "data": {
+                "input": _field(data, "input"),
+                "output": _slim_output(_field(data, "output")),
+            },
+        }
+    return event
+
+
+def encode_msgpack_event(event: Any) -> bytes:
+    """Encode an event as a length-prefixed MessagePack frame."""
+    assert _packb is not None
+    payload = _packb(slim_event(event))
+    return _LENGTH.pack(len(payload)) + payload
+
+
+def accepts_msgpack(accept: Optional[str]) -> bool:
+    """Return whether an Accept header asks for MessagePack."""
+    if not accept:
+        return False
+    for item in accept.split(","):
+        media_type, *params = (part.strip() for part in item.split(";"))
+        if media_type.lower() != MEDIA_TYPE:
+            continue
+        qualities: Dict[str, str] = dict(
+            param.partition("=")[::2] for param in params if "=" in param
+        )
+        try:
+            return float(qualities.get("q", "1")) > 0
+        except ValueError:
+            return False
+    return False
+
+
+MSGPACK: Optional[WireFormat] = (
+    WireFormat("msgpack", MEDIA_TYPE, encode_msgpack_event)
+    if _packb is not None
+    else None
+)
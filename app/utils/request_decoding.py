@@ -0,0 +1,306 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fast decoding of chat requests.
+
+The body is parsed with orjson and each message is validated on its own,
+through the discriminated union of `InputChat`. Validated messages are cached
+under a rolling hash of the history up to them, so the messages of a
+conversation already seen, e.g. the previous turns of a session, are reused
+instead of being validated again.
+
+Cached messages are shared by the requests reusing them, so they are given an
+id when validated: LangGraph only assigns ids to messages without one, and
+otherwise leaves the input messages untouched. The messages of a delta of a
+stored session are hashed after the session and version they follow, so
+that identical deltas of different sessions or turns, e.g. "yes", are
+different messages with their own ids. The cache is bounded both by number
+of messages and by their approximate size, that of their JSON.
+"""
+from collections import OrderedDict
+import hashlib
+import json
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+from app.utils.encoding import orjson
+from app.utils.input_types import MESSAGES_ADAPTER, Input, InputChat
+from fastapi.exceptions import RequestValidationError
+from langchain_core.messages import BaseMessage
+from pydantic import ValidationError
+
+
+def _loads(body: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def _canonical(message: Dict[str, Any]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(message, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(message, sort_keys=True).encode("utf-8")
+
+
+def sanitize_message(message: Dict[str, Any]) -> Dict[str, Any]:
+    """Drop the leftover `tool_calls` the UI may attach to human messages."""
+    additional_kwargs = message.get("additional_kwargs")
+    if (
+        message.get("type") == "human"
+        and isinstance(additional_kwargs, dict)
+        and "tool_calls" in additional_kwargs
+    ):
+        additional_kwargs = dict(additional_kwargs)
+        additional_kwargs.pop("tool_calls")
+        message = {**message, "additional_kwargs": additional_kwargs}
+    return message
+
+
+def parse_body(body: bytes) -> Any:
+    """
+    Parse a JSON request body.
+
+    Raises:
+        RequestValidationError: With the error of FastAPI for invalid JSON.
+    """
+    try:
+        return _loads(body)
+    except ValueError as e:
+        raise RequestValidationError(
+            [_error("json_invalid", ("body", 0), "JSON decode error", {})]
+        ) from e
+
+
+def _error(
+    error_type: str, loc: Tuple[Any, ...], msg: str, value: Any
+) -> Dict[str, Any]:
+    return {"type": error_type, "loc": loc, "msg": msg, "input": value}
+
+
+class RequestDecoder:
+    """Decodes `/stream_events` bodies, reusing validated history prefixes."""
+
+    def __init__(self, maxsize: int = 4096, max_bytes: int = 64 * 2**20) -> None:
+        """
+        Initialize the decoder.
+
+        Args:
+            maxsize: Maximum number of validated messages kept for reuse.
+            max_bytes: Maximum total JSON size of the messages kept for reuse.
+                Larger messages are not kept.
+        """
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        # Validated messages and the size of their JSON, by prefix hash
+        self._messages: "OrderedDict[bytes, Tuple[BaseMessage, int]]" = OrderedDict()
+
+    def decode(self, body: bytes) -> Input:
+        """
+        Parse and validate a request body.
+
+        Raises:
+            RequestValidationError: With the same error format as FastAPI when
+                the body is not a valid `Input`.
+        """
+        return self.decode_payload(parse_body(body))
+
+    def decode_payload(
+        self, payload: Any, session_versions: Optional[Mapping[str, int]] = None
+    ) -> Input:
+        """
+        Validate an already parsed request body.
+
+        Args:
+            payload: The parsed body.
+            session_versions: Versions of the sessions whose deltas may omit
+                their `session_version`, by `user_id:session_id`.
+
+        Raises:
+            RequestValidationError: When the payload is not a valid `Input`.
+        """
+        if not isinstance(payload, dict) or not isinstance(payload.get("input"), dict):
+            # Let pydantic report what is wrong with the envelope
+            return self._validate_whole(payload)
+        fields = payload["input"]
+        raw_messages = fields.get("messages")
+        if not isinstance(raw_messages, list):
+            return self._validate_whole(payload)
+
+        try:
+            # The other fields are few and small: validate them the usual way
+            input_chat = InputChat.model_validate({**fields, "messages": []})
+        except ValidationError as e:
+            raise RequestValidationError(
+                [{**err, "loc": ("body", "input", *err["loc"])} for err in e.errors()]
+            ) from e
+        session_key = f"{input_chat.user_id}:{input_chat.session_id}"
+        if input_chat.session_version is None and session_versions:
+            version = session_versions.get(session_key)
+            if version is not None:
+                input_chat = input_chat.model_copy(update={"session_version": version})
+        history = b""
+        if input_chat.session_version:
+            # The messages follow the stored history of this version
+            history = f"{session_key}:{input_chat.session_version}".encode()
+        messages = self.validate_messages(raw_messages, history)
+        return Input.model_construct(
+            input=input_chat.model_copy(update={"messages": messages})
+        )
+
+    def validate_messages(
+        self, raw_messages: List[Any], history: bytes = b""
+    ) -> List[BaseMessage]:
+        """
+        Validate messages, reusing those of already seen history prefixes.
+
+        Args:
+            raw_messages: The parsed messages.
+            history: Identity of the stored history the messages are a delta
+                of, if any.
+        """
+        messages: List[Optional[BaseMessage]] = []
+        errors: List[Dict[str, Any]] = []
+        # Messages to validate, with their position, prefix hash and size
+        missing: List[Tuple[int, bytes, int, Dict[str, Any]]] = []
+        prefix = hashlib.sha256(history)
+        for i, raw in enumerate(raw_messages):
+            if not isinstance(raw, dict):
+                loc = ("body", "input", "messages", i)
+                errors.append(
+                    _error("model_type", loc, "Input should be an object", raw)
+                )
+                messages.append(None)
+                continue
+            canonical = _canonical(raw)
+            prefix.update(canonical)
+            key = prefix.digest()
+            message = self._get(key)
+            if message is None:
+                message_dict = sanitize_message(raw)
+                if message_dict.get("id") is None:
+                    # The id derives from the history, so it is stable across turns
+                    message_dict = {**message_dict, "id": key[:16].hex()}
+                missing.append((i, key, len(canonical), message_dict))
+            messages.append(message)
+
+        if missing:
+            # A single validator call for all the new messages
+            try:
+                validated = MESSAGES_ADAPTER.validate_python(
+                    [m for _, _, _, m in missing]
+                )
+            except ValidationError as e:
+                for err in e.errors():
+                    position, *loc = err["loc"]
+                    index = missing[int(position)][0]
+                    errors.append(
+                        {**err, "loc": ("body", "input", "messages", index, *loc)}
+                    )
+            else:
+                for (i, key, size, _), message in zip(missing, validated):
+                    self._put(key, message, size)
+                    messages[i] = message
+        if errors:
+            raise RequestValidationError(errors)
+        return messages  # type: ignore[return-value]
+
+    def stats(self) -> Dict[str, int]:
+        """Return the cache counters."""
+        return {
+            "messages": len(self._messages),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _get(self, key: bytes) -> Optional[BaseMessage]:
+        entry = self._messages.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._messages.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def _put(self, key: bytes, message: BaseMessage, size: int) -> None:
+        if size > self.max_bytes:
+            return
+        previous = self._messages.pop(key, None)
+        if previous is not None:
+            self.bytes -= previous[1]
+        self._messages[key] = (message, size)
+        self.bytes += size
+        while len(self._messages) > self.maxsize or self.bytes > self.max_bytes:
+            _, (_, evicted) = self._messages.popitem(last=False)
+            self.bytes -= evicted
+
+    @staticmethod
+    def _validate_whole(payload: Any) -> Input:
+        try:
+            return Input.model_validate(payload)
+        except ValidationError as e:
+            raise RequestValidationError(
+                [{**err, "loc": ("body", *err["loc"])} for err in e.errors()]
+            ) from e
+
+
+def inline_refs(schema: Dict[str, Any]) -> Dict[str, Any]:
+    """Inline the `$defs` references of a JSON schema without recursive types."""
+    definitions = schema.get("$defs", {})
+
+    def resolve(node: Any) -> Any:
+        if isinstance(node, dict):
+            ref = node.get("$ref")
+            if isinstance(ref, str) and ref.startswith("#/$defs/"):
+                return resolve(definitions[ref[len("#/$defs/") :]])
+            return {k: resolve(v) for k, v in node.items() if k != "$defs"}
+        if isinstance(node, list):
+            return [resolve(item) for item in node]
+        return node
+
+    return resolve(schema)
+
+
+# Documents the body of routes decoding `Input` themselves
+INPUT_OPENAPI_EXTRA = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "application/json": {"schema": inline_refs(Input.model_json_schema())}
+        },
+    }
+}
+
+# Documents the body of `/batch`, whose items are decoded one by one
+BATCH_OPENAPI_EXTRA = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "application/json": {
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "inputs": {
+                            "type": "array",
+                            "items": inline_refs(InputChat.model_json_schema()),
+                        }
+                    },
+                    "required": ["inputs"],
+                }
+            }
+        },
+    }
+}
@@ -0,0 +1,246 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Server-side chat histories.
+
+Clients of a stored session only send the messages added since the version
+they last synced, and the server rebuilds the conversation from its copy.
+Recently used histories are kept in memory as parsed messages; every history
+is also written to SQLite, one row per message, so that a turn only appends
+its new messages and sessions survive evictions and restarts.
+
+SQLite is the source of truth: the version of a session held in memory is
+checked against the database on every turn, inside a write transaction, so
+several server processes can share the database file. Sessions not updated
+for `ttl` seconds are deleted by the turns of other sessions, so that
+abandoned sessions do not grow the database forever; their clients then get
+a stale version error and send the whole conversation again.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+import json
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from app.utils.input_types import MESSAGES_ADAPTER
+from app.utils.sqlite import ProcessConnection
+from langchain_core.messages import BaseMessage
+
+
+class StaleSessionError(Exception):
+    """Raised when a delta is based on a version the server does not hold."""
+
+    def __init__(self, base_version: int, current_version: Optional[int]) -> None:
+        """
+        Initialize the exception.
+
+        Args:
+            base_version: The version the delta was based on.
+            current_version: The version stored on the server, if any.
+        """
+        super().__init__(
+            f"Session version {base_version} is stale, "
+            f"the server holds version {current_version}"
+        )
+        self.base_version = base_version
+        self.current_version = current_version
+
+
+@dataclass
+class Session:
+    """A stored chat history."""
+
+    version: int
+    messages: List[BaseMessage]
+
+
+class SessionStore:
+    """Chat histories in an in-memory LRU cache backed by SQLite."""
+
+    def __init__(
+        self,
+        path: str,
+        max_sessions: int = 1024,
+        ttl: Optional[float] = None,
+        prune_interval: float = 60.0,
+    ) -> None:
+        """
+        Initialize the store.
+
+        Args:
+            path: SQLite database file, or ":memory:" for a transient store.
+            max_sessions: Maximum number of histories kept in memory.
+            ttl: Seconds after their last update at which sessions are
+                deleted. None keeps them until they are deleted explicitly.
+            prune_interval: Minimum seconds between two deletions of the
+                expired sessions by this store.
+        """
+        if max_sessions <= 0:
+            raise ValueError("max_sessions must be positive")
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self._pruned_at = 0.0
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.path = path
+        # Sessions held in memory were read through the parent's connection
+        self._db = ProcessConnection(path, on_fork=self._sessions.clear)
+        with self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "key TEXT PRIMARY KEY, version INTEGER NOT NULL, "
+                "length INTEGER NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "key TEXT NOT NULL, position INTEGER NOT NULL, "
+                "message TEXT NOT NULL, PRIMARY KEY (key, position))"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_updated_at "
+                "ON sessions (updated_at)"
+            )
+
+    def apply(
+        self, key: str, base_version: int, messages: Sequence[BaseMessage]
+    ) -> Tuple[int, List[BaseMessage]]:
+        """
+        Update a session and return its new version and full history.
+        Performs blocking I/O, so call it from a worker thread.
+
+        Args:
+            key: Identity of the session.
+            base_version: Version the messages are a delta of. 0 replaces the
+                stored history, if any, with the messages.
+            messages: The messages to add.
+
+        Raises:
+            StaleSessionError: If the session is not at `base_version`.
+        """
+        with self._lock, self._db:
+            # Holds the database lock until the new version is written, in
+            # case other processes update the same session
+            self._db.execute("BEGIN IMMEDIATE")
+            session = self._get(key)
+            current_version = session.version if session is not None else None
+            if base_version == 0:
+                history = list(messages)
+                start = 0
+            elif session is not None and session.version == base_version:
+                history = [*session.messages, *messages]
+                start = len(session.messages)
+            else:
+                raise StaleSessionError(base_version, current_version)
+
+            version = (current_version or 0) + 1
+            if start == 0:
+                self._db.execute("DELETE FROM messages WHERE key = ?", (key,))
+            self._db.executemany(
+                "INSERT INTO messages (key, position, message) VALUES (?, ?, ?)",
+                [
+                    (key, start + i, json.dumps(message.model_dump(), default=str))
+                    for i, message in enumerate(messages)
+                ],
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO sessions (key, version, length, updated_at)"
+                " VALUES (?, ?, ?, ?)",
+                (key, version, len(history), time.time()),
+            )
+            self._remember(key, Session(version, history))
+            self._prune()
+            return version, list(history)
+
+    def delete(self, key: str) -> None:
+        """Forget a session."""
+        with self._lock:
+            self._sessions.pop(key, None)
+            with self._db:
+                self._db.execute("DELETE FROM messages WHERE key = ?", (key,))
+                self._db.execute("DELETE FROM sessions WHERE key = ?", (key,))
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the store counters."""
+        return {
+            "sessions_in_memory": len(self._sessions),
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+        }
+
+    def close(self) -> None:
+        """Close the database."""
+        with self._lock:
+            self._db.close()
+
+    def _get(self, key: str) -> Optional[Session]:
+        """Return a session from memory if it is current, or from the database."""
+        row = self._db.execute(
+            "SELECT version, length FROM sessions WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self._sessions.pop(key, None)
+            return None
+        version, length = row
+        session = self._sessions.get(key)
+        if session is not None and session.version == version:
+            self._sessions.move_to_end(key)
+            self.hits += 1
+            return session
+        self.misses += 1
+        rows = self._db.execute(
+            "SELECT message FROM messages WHERE key = ? AND position < ? "
+            "ORDER BY position",
+            (key, length),
+        ).fetchall()
+        session = Session(
+            version, MESSAGES_ADAPTER.validate_python([json.loads(r[0]) for r in rows])
+        )
+        self._remember(key, session)
+        return session
+
+    def _prune(self) -> None:
+        """Delete the expired sessions, within the write transaction."""
+        now = time.time()
+        if self.ttl is None or now - self._pruned_at < self.prune_interval:
+            return
+        self._pruned_at = now
+        expired = [
+            key
+            for (key,) in self._db.execute(
+                "SELECT key FROM sessions WHERE updated_at < ?", (now - self.ttl,)
+            )
+        ]
+        for key in expired:
+            self._sessions.pop(key, None)
+        self._db.executemany(
+            "DELETE FROM messages WHERE key = ?", [(key,) for key in expired]
+        )
+        self._db.executemany(
+            "DELETE FROM sessions WHERE key = ?", [(key,) for key in expired]
+        )
+        self.expired += len(expired)
+
+    def _remember(self, key: str, session: Session) -> None:
+        """Keep a session in memory, evicting the least recently used one."""
+        self._sessions[key] = session
+        self._sessions.move_to_end(key)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
@@ -0,0 +1,141 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Single-flight coalescing of identical in-flight streams.
+
+The first request for a key starts the upstream stream in a background task;
+identical requests arriving while it runs subscribe to it instead of starting
+their own. Every item is buffered, so late subscribers first receive the items
+produced before they joined.
+"""
+import asyncio
+from typing import (
+    AsyncGenerator,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Generic,
+    List,
+    Optional,
+    TypeVar,
+)
+
+from app.utils.streams import aclose
+
+T = TypeVar("T")
+
+
+class Flight(Generic[T]):
+    """An upstream stream shared by its subscribers."""
+
+    def __init__(self) -> None:
+        self.items: List[T] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        # Set, then replaced, whenever an item arrives or the stream ends
+        self.changed = asyncio.Event()
+
+    def notify(self) -> None:
+        """Wake up the subscribers waiting for the next item."""
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class SingleFlight(Generic[T]):
+    """Shares one upstream stream between identical concurrent requests."""
+
+    def __init__(self) -> None:
+        self.started = 0
+        self.joined = 0
+        self._flights: Dict[str, Flight[T]] = {}
+
+    @property
+    def in_flight(self) -> int:
+        """Number of upstream streams running."""
+        return len(self._flights)
+
+    async def subscribe(
+        self, key: str, factory: Callable[[], AsyncIterator[T]]
+    ) -> AsyncGenerator[T, None]:
+        """
+        Stream the items of the flight for `key`, starting it if needed.
+
+        The upstream is cancelled once all its subscribers have gone, and its
+        errors are raised to every subscriber.
+
+        Args:
+            key: Identity of the request.
+            factory: Creates the upstream stream; only called by the first
+                subscriber.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = Flight()
+            flight.task = asyncio.create_task(self._run(key, flight, factory))
+            self._flights[key] = flight
+            self.started += 1
+        else:
+            self.joined += 1
+
+        flight.subscribers += 1
+        position = 0
+        try:
+            while True:
+                changed = flight.changed
+                while position < len(flight.items):
+                    yield flight.items[position]
+                    position += 1
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                await changed.wait()
+        finally:
+            flight.subscribers -= 1
+            if not flight.subscribers and flight.task and not flight.task.done():
+                # Nobody is listening anymore: stop generating
+                flight.task.cancel()
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+    def stats(self) -> Dict[str, int]:
+        """Return the single-flight counters."""
+        return {
+            "in_flight": self.in_flight,
+            "started": self.started,
+            "joined": self.joined,
+        }
+
+    async def _run(
+        self, key: str, flight: Flight[T], factory: Callable[[], AsyncIterator[T]]
+    ) -> None:
+        """Buffer the upstream items and notify the subscribers."""
+        stream = factory()
+        try:
+            async for item in stream:
+                flight.items.append(item)
+                flight.notify()
+        except asyncio.CancelledError:
+            flight.error = asyncio.CancelledError()
+            raise
+        except Exception as e:
+            flight.error = e
+        finally:
+            await aclose(stream)
+            flight.done = True
+            flight.notify()
+            if self._flights.get(key) is flight:
+                del self._flights[key]
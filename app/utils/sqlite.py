@@ -0,0 +1,63 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""SQLite connections shared by the threads of a server process.
+
+Server workers are forked from a supervisor, and a SQLite connection must not
+be used across a fork: each process opens its own on first use.
+"""
+import os
+import sqlite3
+from typing import Any, Callable, Optional
+
+
+class ProcessConnection:
+    """
+    A SQLite connection of the current process, reopened after a fork. It is
+    used as the connection itself: attributes and the transaction context
+    manager are those of the connection of the calling process.
+    """
+
+    def __init__(self, path: str, on_fork: Optional[Callable[[], None]] = None) -> None:
+        """
+        Open the connection.
+
+        Args:
+            path: SQLite database file, or ":memory:".
+            on_fork: Called in a forked process before it opens its own
+                connection, e.g. to drop state read through the parent's.
+        """
+        self.path = path
+        self.on_fork = on_fork
+        self._pid = os.getpid()
+        # Calls run in worker threads, serialized by the lock of the owner
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+
+    def get(self) -> sqlite3.Connection:
+        """Return the connection of this process, opening it if needed."""
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            if self.on_fork is not None:
+                self.on_fork()
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        return self._connection
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.get(), name)
+
+    def __enter__(self) -> sqlite3.Connection:
+        return self.get().__enter__()
+
+    def __exit__(self, *exc_info: Any) -> Optional[bool]:
+        return self.get().__exit__(*exc_info)
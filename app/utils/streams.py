@@ -0,0 +1,29 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers for the async streams of the serving path.
+
+A wrapper generator closed at one of its `yield`s does not close the stream
+it iterates: that is only done when the stream is garbage collected. The
+wrappers of the serving path close their upstream explicitly, so that a
+disconnect stops the chain run right away.
+"""
+from typing import Any
+
+
+async def aclose(stream: Any) -> None:
+    """Close an async iterator, if it can be closed."""
+    close = getattr(stream, "aclose", None)
+    if close is not None:
+        await close()
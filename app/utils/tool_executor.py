@@ -0,0 +1,164 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Concurrent execution of the tool calls of a model response.
+
+`ConcurrentToolNode` is a drop-in replacement for LangGraph's `ToolNode`,
+keeping its input parsing, state injection and error handling, that runs the
+tool calls of a message concurrently under a concurrency cap, each within a
+deadline:
+
+- a call still waiting or running past the timeout of its tool, counted from
+  the start of the stage, is cancelled and answered with an error tool
+  message, so a slow tool costs the stage its timeout rather than its own
+  latency;
+- when a call fails with an error that is not handled, or the node itself is
+  cancelled, e.g. because the client disconnected, the other calls are
+  cancelled instead of being left running.
+
+Sync runs use a thread pool of `max_concurrency` threads. A thread cannot be
+interrupted: a timed out sync call is answered right away, while its thread
+finishes in the background.
+
+The node overrides private methods of `ToolNode`, so `pyproject.toml` pins
+LangGraph to the minor version it was tested with.
+"""
+import asyncio
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
+
+from langchain_core.messages import ToolCall, ToolMessage
+from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables.config import ContextThreadPoolExecutor, get_config_list
+from langchain_core.tools import BaseTool
+from langgraph.prebuilt import ToolNode
+from langgraph.types import Command
+
+TIMEOUT_ERROR_TEMPLATE = "Error: {name} timed out after {timeout:g}s."
+
+
+class ConcurrentToolNode(ToolNode):
+    """A `ToolNode` with a concurrency cap, per-tool timeouts and cancellation."""
+
+    def __init__(
+        self,
+        tools: Sequence[Union[BaseTool, Callable]],
+        *,
+        max_concurrency: int = 8,
+        timeout: Optional[float] = 30.0,
+        timeouts: Optional[Dict[str, float]] = None,
+        **kwargs: Any,
+    ) -> None:
+        """
+        Initialize the tool node.
+
+        Args:
+            tools: The tools that can be called.
+            max_concurrency: Maximum number of tool calls running at once.
+            timeout: Default deadline of a tool call in seconds. None waits
+                indefinitely.
+            timeouts: Deadlines of specific tools, by tool name.
+            **kwargs: Other arguments of `ToolNode`, e.g. `handle_tool_errors`.
+        """
+        if max_concurrency <= 0:
+            raise ValueError("max_concurrency must be positive")
+        super().__init__(tools, **kwargs)
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.timeouts = dict(timeouts or {})
+
+    def timeout_of(self, name: str) -> Optional[float]:
+        """Return the deadline of the calls of a tool."""
+        return self.timeouts.get(name, self.timeout)
+
+    def _timed_out(self, call: ToolCall, timeout: float) -> ToolMessage:
+        """Answer a call that ran past its deadline, or raise if unhandled."""
+        if not self.handle_tool_errors:
+            raise TimeoutError(f"{call['name']} timed out after {timeout:g}s")
+        return ToolMessage(
+            TIMEOUT_ERROR_TEMPLATE.format(name=call["name"], timeout=timeout),
+            name=call["name"],
+            tool_call_id=call["id"],
+            status="error",
+        )
+
+    def _combine(self, outputs: List[Any], input_type: str) -> Any:
+        """Build the node output from the outputs of the calls, like `ToolNode`."""
+        if not any(isinstance(output, Command) for output in outputs):
+            return outputs if input_type == "list" else {self.messages_key: outputs}
+        combined: List[Any] = []
+        for output in outputs:
+            if isinstance(output, Command):
+                combined.append(output)
+            elif input_type == "list":
+                combined.append([output])
+            else:
+                combined.append({self.messages_key: [output]})
+        return combined
+
+    def _func(self, input: Any, config: RunnableConfig, *, store: Any) -> Any:
+        tool_calls, input_type = self._parse_input(input, store)
+        config_list = get_config_list(config, len(tool_calls))
+        executor = ContextThreadPoolExecutor(max_workers=self.max_concurrency)
+        try:
+            futures = [
+                executor.submit(self._run_one, call, input_type, call_config)
+                for call, call_config in zip(tool_calls, config_list)
+            ]
+            # Deadlines run from the start of the stage, queueing included
+            submitted_at = time.monotonic()
+            outputs = []
+            for call, future in zip(tool_calls, futures):
+                timeout = self.timeout_of(call["name"])
+                remaining = (
+                    None
+                    if timeout is None
+                    else max(0.0, submitted_at + timeout - time.monotonic())
+                )
+                try:
+                    outputs.append(future.result(timeout=remaining))
+                except FutureTimeoutError:
+                    future.cancel()
+                    outputs.append(self._timed_out(call, timeout or 0.0))
+        finally:
+            # Unstarted calls are dropped and running ones are not waited for
+            executor.shutdown(wait=False, cancel_futures=True)
+        return self._combine(outputs, input_type)
+
+    async def _afunc(self, input: Any, config: RunnableConfig, *, store: Any) -> Any:
+        tool_calls, input_type = self._parse_input(input, store)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def run_one(call: ToolCall) -> Any:
+            async with semaphore:
+                return await self._arun_one(call, input_type, config)
+
+        async def run(call: ToolCall) -> Any:
+            timeout = self.timeout_of(call["name"])
+            try:
+                return await asyncio.wait_for(run_one(call), timeout)
+            except asyncio.TimeoutError:
+                return self._timed_out(call, timeout or 0.0)
+
+        tasks = [asyncio.create_task(run(call)) for call in tool_calls]
+        try:
+            outputs = await asyncio.gather(*tasks)
+        finally:
+            # On an unhandled error or a cancellation of the node, stop the
+            # calls still running rather than leaving them behind
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return self._combine(list(outputs), input_type)
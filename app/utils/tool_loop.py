@@ -0,0 +1,77 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bounded tool loops for the agent graphs.
+
+An agent node calls the model with its tools bound, and the graph runs the
+tools it calls before calling it again, until the model answers without
+calling any. After `max_tool_rounds` rounds of tool calls, the model is called
+one last time without tools, so that it answers with what it has gathered:
+a user message costs at most `max_tool_rounds + 1` model calls, instead of
+looping until the recursion limit of the graph.
+
+The model and tool calls of a run are counted in the graph state.
+"""
+from typing import Any, Dict, Optional, Sequence
+
+from langchain_core.messages import AIMessage, BaseMessage
+from langgraph.graph import END
+
+
+def tool_calls_of(message: Optional[BaseMessage]) -> list:
+    """Return the tool calls requested by a message."""
+    if not isinstance(message, AIMessage):
+        return []
+    return message.tool_calls
+
+
+class ToolLoop:
+    """The iteration budget of an agent loop, and its routing."""
+
+    def __init__(self, max_tool_rounds: int = 3, tools_node: str = "tools") -> None:
+        """
+        Initialize the tool loop.
+
+        Args:
+            max_tool_rounds: Maximum number of rounds of tool calls per run.
+                0 never lets the model call tools.
+            tools_node: Name of the graph node running the tools.
+        """
+        if max_tool_rounds < 0:
+            raise ValueError("max_tool_rounds must not be negative")
+        self.max_tool_rounds = max_tool_rounds
+        self.tools_node = tools_node
+
+    def tools_allowed(self, llm_calls: int) -> bool:
+        """Return whether the next model call may call tools."""
+        # Every model call of the run so far led to a round of tool calls
+        return llm_calls < self.max_tool_rounds
+
+    def count(
+        self, llm_calls: int, tool_calls: int, responses: Sequence[Any]
+    ) -> Dict[str, int]:
+        """Return the state update counting a model call and its tool calls."""
+        return {
+            "llm_calls": llm_calls + 1,
+            "tool_calls": tool_calls
+            + sum(len(tool_calls_of(response)) for response in responses),
+        }
+
+    def route(self, messages: Sequence[BaseMessage], llm_calls: int) -> str:
+        """Route a model response to the tools, or to the end of the run."""
+        last_message = messages[-1] if messages else None
+        # Rounds of tool calls made so far, this one included
+        if tool_calls_of(last_message) and llm_calls <= self.max_tool_rounds:
+            return self.tools_node
+        return END
@@ -17,12 +17,24 @@ from typing import Any
 
 
 class MessageEditing:
-    """Provides methods for editing, refreshing, and deleting chat messages."""
+    """Provides methods for editing, refreshing, and deleting chat messages.
+
+    Editing the history invalidates the copy stored on the server, so the next
+    turn sends the whole conversation again.
+    """
+
+    @staticmethod
+    def reset_session_sync(st: Any) -> None:
+        """Forget the server-side history of the current session."""
+        st.session_state.get("session_sync", {}).pop(
+            st.session_state["session_id"], None
+        )
 
     @staticmethod
     def edit_message(st: Any, button_idx: int, message_type: str) -> None:
         """Edit a message in the chat history."""
         button_id = f"edit_box_{button_idx}"
+        MessageEditing.reset_session_sync(st)
         if message_type == "human":
             messages = st.session_state.user_chats[st.session_state["session_id"]][
                 "messages"
@@ -39,6 +51,7 @@ class MessageEditing:
     @staticmethod
     def refresh_message(st: Any, button_idx: int, content: str) -> None:
         """Refresh a message in the chat history."""
+        MessageEditing.reset_session_sync(st)
         messages = st.session_state.user_chats[st.session_state["session_id"]][
             "messages"
         ]
@@ -50,6 +63,7 @@ class MessageEditing:
     @staticmethod
     def delete_message(st: Any, button_idx: int) -> None:
         """Delete a message from the chat history."""
+        MessageEditing.reset_session_sync(st)
         messages = st.session_state.user_chats[st.session_state["session_id"]][
             "messages"
         ]
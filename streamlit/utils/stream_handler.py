@@ -14,7 +14,7 @@
 # pylint: disable=W0621,W0613,W3101,E0611
 
 import json
-from typing import Any, Dict, Generator, List, Optional
+from typing import Any, Callable, Dict, Generator, Iterable, List, Optional
 from urllib.parse import urljoin
 
 import google.auth
@@ -26,6 +26,37 @@ import requests
 import streamlit as st
 from utils.multimodal_utils import format_content
 
+MSGPACK_MEDIA_TYPE = "application/x-msgpack"
+
+unpackb: Optional[Callable[[bytes], Any]]
+try:
+    from msgpack import unpackb
+except ImportError:
+    try:
+        from ormsgpack import unpackb
+    except ImportError:
+        unpackb = None
+
+
+def iter_msgpack_frames(
+    chunks: Iterable[bytes],
+) -> Generator[Dict[str, Any], None, None]:
+    """Decode a stream of MessagePack events, each prefixed by its length."""
+    assert unpackb is not None
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= 4:
+            end = 4 + int.from_bytes(buffer[:4], "big")
+            if len(buffer) < end:
+                break
+            yield unpackb(bytes(buffer[4:end]))
+            del buffer[:end]
+
+
+class StaleSessionError(Exception):
+    """Raised when the server no longer holds the synced session history."""
+
 
 @st.cache_resource()
 class Client:
@@ -36,6 +67,8 @@ class Client:
         self.url = urljoin(url, "stream_events")
         self.authenticate_request = authenticate_request
         self.creds, _ = google.auth.default()
+        # Keeps connections to the server alive across turns
+        self.session = requests.Session()
 
         if self.authenticate_request:
             self.id_token = self.get_id_token(self.url)
@@ -81,19 +114,35 @@ class Client:
         }
         if self.authenticate_request:
             headers["Authorization"] = f"Bearer {self.id_token}"
-        requests.post(url, data=json.dumps(feedback_dict), headers=headers)
+        self.session.post(url, data=json.dumps(feedback_dict), headers=headers)
 
     def stream_events(
         self, data: Dict[str, Any]
     ) -> Generator[Dict[str, Any], None, None]:
         """Stream events from the server, yielding parsed event data."""
-        headers = {"Content-Type": "application/json", "Accept": "text/event-stream"}
+        headers = {
+            "Content-Type": "application/json",
+            # The compact MessagePack format is used when it can be decoded
+            "Accept": (
+                "text/event-stream"
+                if unpackb is None
+                else f"{MSGPACK_MEDIA_TYPE}, text/event-stream;q=0.5"
+            ),
+            "Accept-Encoding": "gzip, deflate",
+        }
         if self.authenticate_request:
             headers["Authorization"] = f"Bearer {self.id_token}"
-        with requests.post(
+        with self.session.post(
             self.url, json={"input": data}, headers=headers, stream=True
         ) as response:
-            for line in response.iter_lines():
+            if response.status_code == 409:
+                raise StaleSessionError(response.text)
+            if response.headers.get("Content-Type", "").startswith(MSGPACK_MEDIA_TYPE):
+                yield from iter_msgpack_frames(response.iter_content(chunk_size=None))
+                return
+            # Compressed frames are decoded by urllib3; reading the response
+            # chunk by chunk lets each frame through as soon as it arrives.
+            for line in response.iter_lines(chunk_size=None):
                 if line:
                     try:
                         event = json.loads(line.decode("utf-8"))
@@ -136,20 +185,43 @@ class EventProcessor:
         self.tool_calls: List[Dict[str, Any]] = []
         self.additional_kwargs: Dict[str, Any] = {}
         self.current_run_id: Optional[str] = None
+        self.sent_messages = 0
 
     def process_events(self) -> None:
-        """Process events from the stream, handling each event type appropriately."""
-        messages = self.st.session_state.user_chats[
-            self.st.session_state["session_id"]
-        ]["messages"]
-        stream = self.client.stream_events(
-            data={
-                "messages": messages,
-                "user_id": self.st.session_state["user_id"],
-                "session_id": self.st.session_state["session_id"],
-            }
-        )
+        """Process events from the stream, handling each event type appropriately.
 
+        The server stores the history of the session, so once a turn has been
+        synced only the messages added since then are sent, along with the
+        version returned by the server for that turn.
+        """
+        session_id = self.st.session_state["session_id"]
+        messages = self.st.session_state.user_chats[session_id]["messages"]
+        sync = self.st.session_state.setdefault("session_sync", {}).get(session_id)
+        try:
+            self.consume(self.client.stream_events(self.request_data(messages, sync)))
+        except StaleSessionError:
+            # The server lost track of the session: send the whole history
+            self.consume(self.client.stream_events(self.request_data(messages, None)))
+
+    def request_data(
+        self, messages: List[Dict[str, Any]], sync: Optional[Dict[str, int]]
+    ) -> Dict[str, Any]:
+        """Build the request for the messages not synced with the server yet."""
+        self.sent_messages = len(messages)
+        if sync is None:
+            messages_to_send, session_version = messages, 0
+        else:
+            messages_to_send = messages[sync["synced"] :]
+            session_version = sync["version"]
+        return {
+            "messages": messages_to_send,
+            "user_id": self.st.session_state["user_id"],
+            "session_id": self.st.session_state["session_id"],
+            "session_version": session_version,
+        }
+
+    def consume(self, stream: Generator[Dict[str, Any], None, None]) -> None:
+        """Dispatch the events of a stream to their handlers."""
         event_handlers = {
             "metadata": self.handle_metadata,
             "end": self.handle_end,
@@ -167,8 +239,17 @@ class EventProcessor:
                 handler(event)
 
     def handle_metadata(self, event: Dict[str, Any]) -> None:
-        """Handle metadata events."""
+        """Handle metadata events, recording the synced session version."""
         self.current_run_id = event["data"].get("run_id")
+        session_id = self.st.session_state["session_id"]
+        session_version = event["data"].get("session_version")
+        if session_version is None:
+            self.st.session_state.session_sync.pop(session_id, None)
+        else:
+            self.st.session_state.session_sync[session_id] = {
+                "version": session_version,
+                "synced": self.sent_messages,
+            }
 
     def handle_tool_start(self, event: Dict[str, Any]) -> None:
         """Handle the start of a tool or retriever execution."""
@@ -224,9 +305,19 @@ class EventProcessor:
         self.stream_handler.new_status(msg)
 
     def handle_chat_model_stream(self, event: Dict[str, Any]) -> None:
-        """Handle incoming tokens from the chat model stream."""
+        """Handle incoming tokens from the chat model stream.
+
+        The server may coalesce several chunks into one event, in which case the
+        content holds the merged tokens. Merged multimodal chunks carry a list of
+        content blocks, whose text parts are concatenated.
+        """
         data = event["data"]
         content = data["chunk"]["content"]
+        if isinstance(content, list):
+            content = "".join(
+                part if isinstance(part, str) else part.get("text", "")
+                for part in content
+            )
         self.additional_kwargs = {
             **self.additional_kwargs,
             **data["chunk"]["additional_kwargs"],
@@ -0,0 +1,89 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of concurrent sessions on sync and async agent nodes.
+
+Runs concurrent `astream_events` sessions, as the server does, on a one-node
+LangGraph agent whose model answers after a fixed latency. A sync node calling
+`invoke` is run by LangGraph in the default thread pool, which bounds the
+sessions progressing at once to its size; an async node awaiting `ainvoke`
+only takes the event loop while it is not waiting on the model.
+
+Run from the repository root:
+    poetry run python -m tests.benchmarks.bench_agent_node
+"""
+import asyncio
+import os
+import time
+from typing import Dict
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.runnables import RunnableConfig
+from langgraph.graph import MessagesState, StateGraph
+from langgraph.graph.state import CompiledStateGraph
+
+from tests.benchmarks.fake_llm import FakeChatModel
+
+LATENCY = 0.1
+
+
+def build_agent(use_async: bool) -> CompiledStateGraph:
+    """Build a one-node agent on a model with a fixed latency."""
+    llm = FakeChatModel(
+        responses=[AIMessage(content="An answer of a few tokens.")], latency=LATENCY
+    )
+
+    def agent(state: MessagesState, config: RunnableConfig) -> Dict[str, BaseMessage]:
+        return {"messages": llm.invoke(state["messages"], config)}
+
+    async def aagent(
+        state: MessagesState, config: RunnableConfig
+    ) -> Dict[str, BaseMessage]:
+        return {"messages": await llm.ainvoke(state["messages"], config)}
+
+    workflow = StateGraph(MessagesState)
+    workflow.add_node("agent", aagent if use_async else agent)
+    workflow.set_entry_point("agent")
+    return workflow.compile()
+
+
+async def run_sessions(agent: CompiledStateGraph, sessions: int) -> float:
+    """Stream `sessions` concurrent runs and return the elapsed time."""
+
+    async def session() -> None:
+        async for _ in agent.astream_events(
+            {"messages": [HumanMessage(content="Hello!")]}, version="v2"
+        ):
+            pass
+
+    start = time.perf_counter()
+    await asyncio.gather(*(session() for _ in range(sessions)))
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    """Print the elapsed time of growing numbers of concurrent sessions."""
+    print(
+        f"Model latency {LATENCY * 1e3:.0f} ms, default thread pool of "
+        f"{min(32, (os.cpu_count() or 1) + 4)} threads"
+    )
+    print(f"{'sessions':<10}{'sync node (s)':>15}{'async node (s)':>16}")
+    for sessions in [1, 10, 50, 100]:
+        sync_s = asyncio.run(run_sessions(build_agent(use_async=False), sessions))
+        async_s = asyncio.run(run_sessions(build_agent(use_async=True), sessions))
+        print(f"{sessions:<10}{sync_s:>15.2f}{async_s:>16.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmark of handing a chat history to the chain.
+
+Compares the input the server used to build, `InputChat.model_dump()`, whose
+message dicts the graph state coerces back into messages, with the validated
+message objects passed as they are. Each run goes through a LangGraph agent on
+the fake chat model answering with a single token, so that the cost measured
+is mostly the one of the input.
+
+Run from the repository root:
+    poetry run python -m tests.benchmarks.bench_chain_input
+"""
+import asyncio
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, Tuple
+
+from app.utils.input_types import InputChat
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.graph.state import CompiledStateGraph
+
+from tests.benchmarks.fake_chain import build_agent
+
+NUMBER = 50
+
+
+def conversation(turns: int) -> InputChat:
+    """Build a validated conversation of `turns` human/AI exchanges."""
+    messages = []
+    for i in range(turns):
+        messages.append(
+            HumanMessage(content=f"Question {i}: what should I write about? " * 4)
+        )
+        messages.append(AIMessage(content=f"Answer {i}. " * 40))
+    messages.append(HumanMessage(content="And today?"))
+    return InputChat(user_id="user", session_id="session", messages=messages)
+
+
+def dumped(input_chat: InputChat) -> Dict[str, Any]:
+    """The chain input built with a dump of the validated input."""
+    return input_chat.model_dump()
+
+
+def objects(input_chat: InputChat) -> Dict[str, Any]:
+    """The chain input holding the validated message objects."""
+    return {
+        "messages": list(input_chat.messages),
+        "user_id": input_chat.user_id,
+        "session_id": input_chat.session_id,
+    }
+
+
+def measure(
+    agent: CompiledStateGraph,
+    build: Callable[[InputChat], Dict[str, Any]],
+    input_chat: InputChat,
+) -> Tuple[float, float]:
+    """Return the mean time (ms) and peak allocations (KiB) of a run."""
+
+    async def run() -> None:
+        await agent.ainvoke(build(input_chat))
+
+    asyncio.run(run())  # Warm up
+    start = time.perf_counter()
+    for _ in range(NUMBER):
+        asyncio.run(run())
+    elapsed = (time.perf_counter() - start) / NUMBER * 1e3
+
+    tracemalloc.start()
+    asyncio.run(run())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 1024
+
+
+def main() -> None:
+    """Print the per-run cost of each chain input."""
+    print(
+        f"{'history':<16}{'dump (ms)':>11}{'objects (ms)':>14}"
+        f"{'dump peak (KiB)':>17}{'objects peak (KiB)':>20}"
+    )
+    for turns in [25, 50, 100]:
+        input_chat = conversation(turns)
+        dump_ms, dump_kib = measure(
+            build_agent(tool_rounds=0, answer_tokens=1), dumped, input_chat
+        )
+        object_ms, object_kib = measure(
+            build_agent(tool_rounds=0, answer_tokens=1), objects, input_chat
+        )
+        name = f"{len(input_chat.messages)} messages"
+        print(
+            f"{name:<16}{dump_ms:>11.3f}{object_ms:>14.3f}"
+            f"{dump_kib:>17.1f}{object_kib:>20.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
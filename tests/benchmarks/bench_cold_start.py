@@ -0,0 +1,143 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cold-start benchmark of the FastAPI server.
+
+Records, in fresh processes:
+    - the import time of `app.server`;
+    - the time from process start to the first served HTTP request;
+    - the time until `/ready` reports the warm-up as complete;
+    - the time until a first `/stream_events` response has been fully streamed.
+
+Run from the repository root:
+    poetry run python -m tests.benchmarks.bench_cold_start [--chain MODULE]
+
+The chain defaults to the fake agent in tests/benchmarks/fake_chain.py, so no
+Vertex AI call is made; pass `--chain app.patterns.mirror_agent.chain` to
+measure the real chain.
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, Optional
+import urllib.error
+import urllib.request
+
+IMPORT_SNIPPET = (
+    "import time; start = time.perf_counter(); import app.server; "
+    "print(time.perf_counter() - start)"
+)
+
+
+def free_port() -> int:
+    """Return a free local TCP port."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def request(
+    url: str, data: Optional[dict] = None, timeout: float = 60
+) -> Optional[int]:
+    """Send a request, returning its status or None if the server is not up."""
+    body = json.dumps(data).encode() if data is not None else None
+    req = urllib.request.Request(
+        url, data=body, headers={"Content-Type": "application/json"}
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except (urllib.error.URLError, ConnectionError):
+        return None
+
+
+def wait_for(url: str, accept: set, start: float, deadline: float) -> float:
+    """Poll a URL until it answers with an accepted status."""
+    while time.perf_counter() - start < deadline:
+        if request(url, timeout=5) in accept:
+            return time.perf_counter() - start
+        time.sleep(0.01)
+    raise TimeoutError(f"{url} not ready after {deadline}s")
+
+
+def measure(env: Dict[str, str], deadline: float) -> Dict[str, float]:
+    """Measure a single cold start."""
+    results = {}
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    results["import_app_server_s"] = float(output.stdout.strip().splitlines()[-1])
+
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.server:app", "--port", str(port)],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        results["first_served_request_s"] = wait_for(
+            f"{base_url}/ready", {200, 503}, start, deadline
+        )
+        results["ready_s"] = wait_for(f"{base_url}/ready", {200}, start, deadline)
+        request(
+            f"{base_url}/stream_events",
+            {"input": {"messages": [{"type": "human", "content": "Hello!"}]}},
+        )
+        results["first_stream_completed_s"] = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+
+def main() -> None:
+    """Run the benchmark and print the mean of each measurement."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chain", default="tests.benchmarks.fake_chain")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--deadline", type=float, default=120)
+    parser.add_argument("--output", help="Write the results to a JSON file")
+    args = parser.parse_args()
+
+    env = {**os.environ, "CHAIN_MODULE": args.chain}
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [os.getcwd(), env.get("PYTHONPATH")])
+    )
+    runs = [measure(env, args.deadline) for _ in range(args.runs)]
+    summary = {key: sum(run[key] for run in runs) / len(runs) for key in runs[0]}
+
+    print(f"Cold start of app.server with chain {args.chain} ({args.runs} runs)")
+    for key, value in summary.items():
+        print(f"{key:<28}{value:>8.2f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"chain": args.chain, "runs": runs, "mean": summary}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of a reflection tool over the recent sessions of a user.
+
+Plays the turns of `--sessions` sessions of `--turns` turns, recording each
+turn in the `DigestStore` of `app/utils/digest_store.py`, whose summarizer is
+the fake chat model with a `--latency` second latency. Then compares a tool
+call that re-reads the raw history of the sessions and summarizes it, with
+one model call, to one reading the precomputed digests: the latency of the
+call, the tokens of model input it costs, and the summarizer calls made in
+the background while the turns were played.
+
+Run from the repository root:
+    poetry run python -m tests.benchmarks.bench_digest_store
+"""
+import argparse
+import statistics
+import tempfile
+import time
+from typing import List
+
+from app.utils.digest_store import DigestStore, conversation_text
+from app.utils.history import estimate_tokens
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.prompts import ChatPromptTemplate
+
+from tests.benchmarks.fake_llm import FakeChatModel
+
+SUMMARY = " ".join(["The user reflected on work, family and their goals."] * 8)
+QUESTION = " ".join(["I keep wondering whether I chose the right career path."] * 4)
+ANSWER = " ".join(["What would the right path feel like for you, day to day?"] * 6)
+
+summary_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", "Extend the summary of the conversation with its new lines."),
+        ("human", "Current summary:\n{summary}\n\nNew lines:\n{conversation}"),
+    ]
+)
+
+
+def session(turns: int) -> List[BaseMessage]:
+    """Build the messages of a session."""
+    return [
+        message
+        for _ in range(turns)
+        for message in (HumanMessage(content=QUESTION), AIMessage(content=ANSWER))
+    ]
+
+
+def main() -> None:
+    """Print the cost of a reflection tool call with and without digests."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    llm = FakeChatModel(responses=[AIMessage(content=SUMMARY)], latency=args.latency)
+    summarizer = summary_prompt | llm
+    sessions = [session(args.turns) for _ in range(args.sessions)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = DigestStore(f"{directory}/digests.sqlite", summarizer)
+        record_s = []
+        for i, messages in enumerate(sessions):
+            for turn in range(1, args.turns + 1):
+                start = time.perf_counter()
+                store.record("user", f"session-{i}", messages[: 2 * turn])
+                record_s.append(time.perf_counter() - start)
+                # Turns arrive about as fast as the summarizer runs
+                time.sleep(args.latency / 2)
+        store.flush()
+        background_calls = llm.calls
+
+        raw = conversation_text([m for messages in sessions for m in messages])
+        start = time.perf_counter()
+        summarizer.invoke({"summary": "", "conversation": raw})
+        raw_ms = (time.perf_counter() - start) * 1000
+        raw_tokens = estimate_tokens(HumanMessage(content=raw))
+
+        latencies = []
+        for _ in range(200):
+            start = time.perf_counter()
+            digests = store.recent("user", "career path", k=3)
+            latencies.append((time.perf_counter() - start) * 1000)
+        digest_text = "\n\n".join(digest.summary for digest in digests)
+        digest_tokens = estimate_tokens(HumanMessage(content=digest_text))
+
+    turns = args.sessions * args.turns
+    print(f"{turns} turns, mean record() {statistics.mean(record_s) * 1e6:.0f} us")
+    print(f"{'tool call':<24}{'latency (ms)':>14}{'tokens':>9}{'background calls':>18}")
+    print(f"{'re-summarize history':<24}{raw_ms:>14.1f}{raw_tokens:>9}{0:>18}")
+    print(
+        f"{'digest store':<24}{statistics.median(latencies):>14.2f}"
+        f"{digest_tokens:>9}{background_calls:>18}"
+    )
+
+
+if __name__ == "__main__":
+    main()
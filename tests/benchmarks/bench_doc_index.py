@@ -0,0 +1,110 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of the per-user document index.
+
+Builds indexes of `app/utils/doc_index.py` of growing numbers of chunks of
+about 150 words drawn from a Zipf-distributed vocabulary, then measures the
+time to reopen an index from disk, the latency percentiles of hybrid queries
+of 3 to 8 words, the time to replace and to delete a 10-chunk document, and
+the time another instance of the index, as held by another server worker,
+takes to apply that replacement.
+
+Run from the repository root:
+    poetry run python -m tests.benchmarks.bench_doc_index [--chunks 10000 50000]
+"""
+import argparse
+import statistics
+import tempfile
+import time
+from typing import List
+
+from app.utils.doc_index import DocIndex
+import numpy as np
+
+VOCABULARY = 20000
+CHUNK_WORDS = 150
+DOC_CHUNKS = 10
+
+
+def words(rng: np.random.Generator, count: int) -> str:
+    """Draw a text of Zipf-distributed words."""
+    ranks = np.minimum(rng.zipf(1.2, count), VOCABULARY)
+    return " ".join(f"w{rank}" for rank in ranks)
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Return a percentile of the values."""
+    return statistics.quantiles(values, n=100)[int(q) - 1]
+
+
+def main() -> None:
+    """Print the load, query and update times of indexes of each size."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunks", type=int, nargs="+", default=[10000, 50000])
+    parser.add_argument("--queries", type=int, default=500)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(
+        f"{'chunks':>8}{'build (s)':>11}{'reopen (s)':>12}{'query p50 (ms)':>16}"
+        f"{'query p95 (ms)':>16}{'replace (ms)':>14}{'delete (ms)':>13}"
+        f"{'refresh (ms)':>14}"
+    )
+    for count in args.chunks:
+        with tempfile.TemporaryDirectory() as directory:
+            index = DocIndex(directory)
+            start = time.perf_counter()
+            for doc in range(count // DOC_CHUNKS):
+                index.add(
+                    f"doc-{doc}",
+                    [words(rng, CHUNK_WORDS) for _ in range(DOC_CHUNKS)],
+                )
+            build_s = time.perf_counter() - start
+
+            writer = index
+            start = time.perf_counter()
+            index = DocIndex(directory)
+            reopen_s = time.perf_counter() - start
+
+            queries = [words(rng, int(rng.integers(3, 9))) for _ in range(args.queries)]
+            index.search(queries[0])
+            latencies = []
+            for query in queries:
+                start = time.perf_counter()
+                index.search(query, k=4)
+                latencies.append((time.perf_counter() - start) * 1000)
+
+            chunks = [words(rng, CHUNK_WORDS) for _ in range(DOC_CHUNKS)]
+            start = time.perf_counter()
+            index.add("doc-0", chunks)
+            replace_ms = (time.perf_counter() - start) * 1000
+            writer.add("doc-2", chunks)
+            start = time.perf_counter()
+            len(index)
+            refresh_ms = (time.perf_counter() - start) * 1000
+            start = time.perf_counter()
+            index.delete("doc-1")
+            delete_ms = (time.perf_counter() - start) * 1000
+
+            print(
+                f"{count:>8}{build_s:>11.1f}{reopen_s:>12.2f}"
+                f"{percentile(latencies, 50):>16.2f}"
+                f"{percentile(latencies, 95):>16.2f}"
+                f"{replace_ms:>14.1f}{delete_ms:>13.1f}{refresh_ms:>14.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
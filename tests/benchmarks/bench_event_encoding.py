@@ -0,0 +1,105 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmark of the per-event encoding cost of the streaming path.
+
+Compares `json.dumps(event, default=default_serialization)` with
+`app.utils.encoding.encode_event` on the event types forwarded to the UI.
+
+Run from the repository root:
+    poetry run python -m tests.benchmarks.bench_event_encoding
+"""
+import json
+import timeit
+from typing import Any, Callable, Dict
+
+from app.utils.encoding import encode_event
+from app.utils.input_types import default_serialization
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessageChunk, ToolMessage
+
+NUMBER = 20_000
+
+EVENT_METADATA = {
+    "tags": [],
+    "metadata": {"langgraph_step": 1, "langgraph_node": "mirror_agent"},
+    "run_id": "1f7c0a9e-5d8e-4a43-9d43-5a1c4e0b9f11",
+    "parent_ids": ["7d0b1d43-2b8b-4f2d-8f0c-1d2e3f4a5b6c"],
+}
+
+EVENTS: Dict[str, Dict[str, Any]] = {
+    "on_chat_model_stream": {
+        "event": "on_chat_model_stream",
+        "name": "ChatVertexAI",
+        "data": {"chunk": AIMessageChunk(content="Hello, how are you today?")},
+        **EVENT_METADATA,
+    },
+    "on_tool_start": {
+        "event": "on_tool_start",
+        "name": "retrieve_user_docs",
+        "data": {"input": {"query": "journal entries about work"}},
+        **EVENT_METADATA,
+    },
+    "on_tool_end": {
+        "event": "on_tool_end",
+        "name": "retrieve_user_docs",
+        "data": {
+            "input": {"query": "journal entries about work"},
+            "output": ToolMessage(
+                content="Retrieved docs for query: journal entries about work",
+                tool_call_id="call-1",
+                name="retrieve_user_docs",
+            ),
+        },
+        **EVENT_METADATA,
+    },
+    "on_retriever_end": {
+        "event": "on_retriever_end",
+        "name": "VectorStoreRetriever",
+        "data": {
+            "input": {"query": "journal"},
+            "output": [
+                Document(page_content="Entry " * 50, metadata={"id": i})
+                for i in range(5)
+            ],
+        },
+        **EVENT_METADATA,
+    },
+}
+
+
+def baseline(event: Dict[str, Any]) -> bytes:
+    """The encoding used before the dedicated encoder layer."""
+    return (json.dumps(event, default=default_serialization) + "\n").encode("utf-8")
+
+
+def per_event_us(encoder: Callable[[Dict[str, Any]], bytes], event: Any) -> float:
+    """Return the mean encode time of an event in microseconds."""
+    return timeit.timeit(lambda: encoder(event), number=NUMBER) / NUMBER * 1e6
+
+
+def main() -> None:
+    """Print the per-event encode cost before and after."""
+    print(
+        f"{'event':<24}{'json.dumps (us)':>18}{'encode_event (us)':>20}{'speedup':>10}"
+    )
+    for name, event in EVENTS.items():
+        assert json.loads(baseline(event)) == json.loads(encode_event(event))
+        before = per_event_us(baseline, event)
+        after = per_event_us(encode_event, event)
+        print(f"{name:<24}{before:>18.2f}{after:>20.2f}{before / after:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of events produced vs. forwarded per request.
+
+Runs a LangGraph agent loop on a fake chat model and counts the events
+yielded by `astream_events`, with and without the `include_types` filter
+requested by the server, against the events forwarded to the UI.
+
+Run from the repository root:
+    poetry run python -m tests.benchmarks.bench_event_filtering
+"""
+import asyncio
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+from langchain_core.messages import HumanMessage
+from langgraph.graph.state import CompiledStateGraph
+
+from tests.benchmarks.fake_chain import build_agent
+
+TOOL_ROUNDS = 10
+REQUESTS = 20
+
+SUPPORTED_EVENTS = frozenset(
+    {
+        "on_tool_start",
+        "on_tool_end",
+        "on_retriever_start",
+        "on_retriever_end",
+        "on_chat_model_stream",
+    }
+)
+SUPPORTED_RUN_TYPES = ["chat_model", "tool", "retriever"]
+
+
+async def run(
+    chain: CompiledStateGraph, include_types: Optional[List[str]]
+) -> Dict[str, Any]:
+    """Stream REQUESTS requests and count produced and forwarded events."""
+    produced = forwarded = 0
+    kwargs = {"include_types": include_types} if include_types else {}
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        input_dict = {"messages": [HumanMessage(content="Who am I?")]}
+        async for data in chain.astream_events(input_dict, version="v2", **kwargs):
+            produced += 1
+            if data["event"] in SUPPORTED_EVENTS:
+                forwarded += 1
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "produced": produced / REQUESTS,
+        "forwarded": forwarded / REQUESTS,
+        "ms": elapsed / REQUESTS * 1000,
+        "peak_kib": peak / 1024,
+    }
+
+
+async def main() -> None:
+    """Print events produced vs. forwarded per request for both modes."""
+    chain = build_agent(tool_rounds=TOOL_ROUNDS)
+    print(f"Agent loop with {TOOL_ROUNDS} tool rounds, averaged over {REQUESTS} runs")
+    print(
+        f"{'mode':<26}{'produced':>10}{'forwarded':>11}"
+        f"{'ms/request':>12}{'peak KiB':>10}"
+    )
+    for mode, include_types in (
+        ("all events", None),
+        ("include_types", SUPPORTED_RUN_TYPES),
+    ):
+        stats = await run(chain, include_types)
+        print(
+            f"{mode:<26}{stats['produced']:>10.0f}{stats['forwarded']:>11.0f}"
+            f"{stats['ms']:>12.1f}{stats['peak_kib']:>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
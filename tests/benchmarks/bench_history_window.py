@@ -0,0 +1,64 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of the model input size over the turns of a long session.
+
+Replays a session turn by turn, as the server runs the chain, and reports the
+estimated input tokens of the model call of each turn when the whole history
+is sent and with the history window of `app/utils/history.py`, along with the
+number of summarizer calls. The summarizer is a stub returning a summary of
+fixed size, so only the history handling is measured.
+
+Run from the repository root:
+    poetry run python -m tests.benchmarks.bench_history_window
+"""
+from typing import Any, Dict, List
+
+from app.utils.history import HistoryManager, estimate_tokens
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.runnables import RunnableLambda
+
+SUMMARY = "The user talked about their writing, their goals and doubts. " * 10
+
+
+def main() -> None:
+    """Print the input tokens of every tenth turn."""
+    calls = 0
+
+    def summarize(_: Dict[str, Any]) -> str:
+        nonlocal calls
+        calls += 1
+        return SUMMARY
+
+    manager = HistoryManager(RunnableLambda(summarize))
+    messages: List[BaseMessage] = []
+    print(
+        f"{'turn':<8}{'full history':>14}{'window':>10}"
+        f"{'summarized':>12}{'summaries':>11}"
+    )
+    for turn in range(1, 201):
+        messages.append(HumanMessage(content=f"Turn {turn}. " + "I wonder " * 30))
+        window, memory = manager.window(messages, {})
+        if turn % 20 == 0:
+            full = sum(estimate_tokens(m) for m in messages)
+            sent = sum(estimate_tokens(m) for m in window)
+            print(
+                f"{turn:<8}{full:>14}{sent:>10}"
+                f"{memory['summarized']:>12}{calls:>11}"
+            )
+        messages.append(AIMessage(content="What makes you wonder? " * 40))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmark of the decode cost of `/stream_events` bodies.
+
+Compares `Input.model_validate_json`, which FastAPI ran on every request, with
+`RequestDecoder.decode`, both on a history seen for the first time and on the
+next turn of the same conversation, whose prefix has already been validated.
+
+Run from the repository root:
+    poetry run python -m tests.benchmarks.bench_request_decoding
+"""
+import base64
+import json
+import time
+import timeit
+from typing import Any, Callable, Dict, List
+
+from app.utils.input_types import Input
+from app.utils.request_decoding import RequestDecoder
+
+NUMBER = 50
+
+
+def history(turns: int, multimodal: bool) -> List[Dict[str, Any]]:
+    """Build a conversation of `turns` human/AI exchanges."""
+    image = base64.b64encode(bytes(range(256)) * 256).decode()
+    messages: List[Dict[str, Any]] = []
+    for i in range(turns):
+        content: Any = f"Question {i}: what should I write about today? " * 4
+        if multimodal and i % 5 == 0:
+            content = [
+                {"type": "text", "text": content},
+                {"type": "image_url", "image_url": f"data:image/png;base64,{image}"},
+            ]
+        messages.append({"type": "human", "content": content})
+        messages.append({"type": "ai", "content": f"Answer {i}. " * 40})
+    return messages
+
+
+def per_request_ms(decode: Callable[[bytes], Any], body: bytes) -> float:
+    """Return the mean decode time of a body in milliseconds."""
+    return timeit.timeit(lambda: decode(body), number=NUMBER) / NUMBER * 1e3
+
+
+def next_turn_ms(previous: bytes, body: bytes) -> float:
+    """
+    Return the mean decode time of a body in milliseconds, by a decoder that
+    has decoded the previous turn of the conversation.
+    """
+    total = 0.0
+    for _ in range(NUMBER):
+        decoder = RequestDecoder()
+        decoder.decode(previous)
+        start = time.perf_counter()
+        decoder.decode(body)
+        total += time.perf_counter() - start
+    return total / NUMBER * 1e3
+
+
+def main() -> None:
+    """Print the per-request decode cost of each path."""
+    print(
+        f"{'history':<24}{'pydantic (ms)':>15}{'first turn (ms)':>17}"
+        f"{'next turn (ms)':>16}{'speedup':>10}"
+    )
+    for turns, multimodal in [(5, False), (25, False), (50, False), (50, True)]:
+        messages = history(turns, multimodal)
+        previous = json.dumps({"input": {"messages": messages[:-2]}}).encode()
+        body = json.dumps({"input": {"messages": messages}}).encode()
+
+        baseline = per_request_ms(Input.model_validate_json, body)
+        first = per_request_ms(lambda b: RequestDecoder().decode(b), body)
+        warm = next_turn_ms(previous, body)
+        name = f"{len(messages)} messages{' + images' if multimodal else ''}"
+        print(
+            f"{name:<24}{baseline:>15.3f}{first:>17.3f}"
+            f"{warm:>16.3f}{baseline / warm:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
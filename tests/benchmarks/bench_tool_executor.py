@@ -0,0 +1,103 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of a tool stage running several retrievals.
+
+Times the tool node of an agent on a message calling a retrieval tool several
+times, with latencies of 50 to 200 ms, when the calls run one after the other,
+with LangGraph's `ToolNode` and with the `ConcurrentToolNode` of
+`app/utils/tool_executor.py`; then when one of the retrievals stalls for
+`--stall` seconds, where the concurrent node answers it after its timeout.
+
+Run from the repository root:
+    poetry run python -m tests.benchmarks.bench_tool_executor
+"""
+import argparse
+import asyncio
+import time
+from typing import Any, Dict, List
+
+from app.utils.tool_executor import ConcurrentToolNode
+from langchain_core.messages import AIMessage
+from langchain_core.tools import tool
+from langgraph.prebuilt import ToolNode
+
+LATENCIES = [0.05, 0.1, 0.15, 0.2]
+
+
+@tool
+async def retrieve(query: str, latency: float) -> str:
+    """Retrieve documents after a latency."""
+    await asyncio.sleep(latency)
+    return f"Documents for {query}"
+
+
+def tool_calls(latencies: List[float]) -> Dict[str, Any]:
+    """Build a state whose last message calls the retrieval tool."""
+    return {
+        "messages": [
+            AIMessage(
+                content="",
+                tool_calls=[
+                    {
+                        "name": "retrieve",
+                        "args": {"query": f"q{i}", "latency": latency},
+                        "id": f"call-{i}",
+                    }
+                    for i, latency in enumerate(latencies)
+                ],
+            )
+        ]
+    }
+
+
+async def sequential(latencies: List[float]) -> None:
+    """Run the calls one after the other."""
+    for call in tool_calls(latencies)["messages"][-1].tool_calls:
+        await retrieve.ainvoke({**call, "type": "tool_call"})
+
+
+async def timed(run: Any) -> float:
+    """Return the duration of a coroutine."""
+    start = time.perf_counter()
+    await run
+    return time.perf_counter() - start
+
+
+async def main() -> None:
+    """Print the duration of the tool stage for each execution."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stall", type=float, default=5.0)
+    parser.add_argument("--timeout", type=float, default=0.5)
+    args = parser.parse_args()
+
+    stalled = LATENCIES + [args.stall]
+    tool_node = ToolNode([retrieve])
+    concurrent_node = ConcurrentToolNode([retrieve], timeout=args.timeout)
+    print(f"{'execution':<28}{'4 retrievals (s)':>18}{'1 stalled (s)':>16}")
+    rows = {
+        "sequential": sequential,
+        "ToolNode": lambda latencies: tool_node.ainvoke(tool_calls(latencies)),
+        f"ConcurrentToolNode ({args.timeout:g}s)": lambda latencies: (
+            concurrent_node.ainvoke(tool_calls(latencies))
+        ),
+    }
+    for name, run in rows.items():
+        normal_s = await timed(run(LATENCIES))
+        stalled_s = await timed(run(stalled))
+        print(f"{name:<28}{normal_s:>18.2f}{stalled_s:>16.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,136 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Regression benchmark of the model round trips per user message.
+
+Runs an agent graph shaped like the mirror agent on the fake chat model, for
+a model that keeps calling tools, as one forced to with `tool_choice="any"`
+does, and for one answering after a single tool call. The unbounded loop runs
+the tools and calls the model again for as long as it calls tools, until the
+recursion limit of the graph; the bounded loop of `app/utils/tool_loop.py`
+calls it without tools once its budget is spent.
+
+Run from the repository root:
+    poetry run python -m tests.benchmarks.bench_tool_loop [--max-tool-rounds 3]
+"""
+import argparse
+import time
+from typing import Annotated, Any, Dict, List, Optional
+
+from app.utils.tool_loop import ToolLoop, tool_calls_of
+from langchain_core.messages import AIMessage, AnyMessage, HumanMessage
+from langgraph.errors import GraphRecursionError
+from langgraph.graph import END, StateGraph, add_messages
+from langgraph.graph.state import CompiledStateGraph
+from langgraph.prebuilt import ToolNode
+from pydantic import BaseModel
+
+from tests.benchmarks.fake_chain import retrieve_user_docs
+from tests.benchmarks.fake_llm import FakeChatModel, tool_call
+
+LATENCY = 0.01
+
+
+class State(BaseModel):
+    messages: Annotated[List[AnyMessage], add_messages] = []
+    llm_calls: int = 0
+    tool_calls: int = 0
+
+
+def build_agent(
+    responses: List[AIMessage], loop: Optional[ToolLoop]
+) -> CompiledStateGraph:
+    """Build the agent graph, with a bounded tool loop unless `loop` is None."""
+    llm = FakeChatModel(responses=responses, latency=LATENCY)
+    final_llm = FakeChatModel(
+        responses=[AIMessage(content="A final answer.")], latency=LATENCY
+    )
+    counter = loop or ToolLoop()
+
+    def agent(state: State) -> Dict[str, Any]:
+        use_tools = loop is None or loop.tools_allowed(state.llm_calls)
+        response = (llm if use_tools else final_llm).invoke(state.messages)
+        return {
+            "messages": [response],
+            **counter.count(state.llm_calls, state.tool_calls, [response]),
+        }
+
+    def route(state: State) -> str:
+        if loop is None:
+            return "tools" if tool_calls_of(state.messages[-1]) else END
+        return loop.route(state.messages, state.llm_calls)
+
+    workflow = StateGraph(State)
+    workflow.add_node("agent", agent)
+    workflow.add_node("tools", ToolNode([retrieve_user_docs]))
+    workflow.set_entry_point("agent")
+    workflow.add_conditional_edges("agent", route, ["tools", END])
+    workflow.add_edge("tools", "agent")
+    return workflow.compile()
+
+
+def measure(agent: CompiledStateGraph) -> Dict[str, Any]:
+    """Run a user message through the agent and count its round trips."""
+    llm_calls = tool_calls = 0
+    outcome = "answered"
+    start = time.perf_counter()
+    try:
+        for update in agent.stream(
+            {"messages": [HumanMessage(content="Who am I?")]}, stream_mode="values"
+        ):
+            llm_calls = update.get("llm_calls", llm_calls)
+            tool_calls = update.get("tool_calls", tool_calls)
+    except GraphRecursionError:
+        outcome = "recursion limit"
+    return {
+        "llm_calls": llm_calls,
+        "tool_calls": tool_calls,
+        "seconds": time.perf_counter() - start,
+        "outcome": outcome,
+    }
+
+
+def main() -> None:
+    """Print the round trips of each model and loop."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--max-tool-rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    models = {
+        "always calls tools": [tool_call("retrieve_user_docs", {"query": "me"})],
+        "answers after a call": [
+            tool_call("retrieve_user_docs", {"query": "me"}),
+            AIMessage(content="An answer."),
+        ],
+    }
+    loops = {
+        "unbounded": None,
+        f"bounded ({args.max_tool_rounds})": ToolLoop(args.max_tool_rounds),
+    }
+    print(
+        f"{'model':<22}{'loop':<14}{'LLM calls':>10}{'tool calls':>12}"
+        f"{'time (s)':>10}  outcome"
+    )
+    for model_name, responses in models.items():
+        for loop_name, loop in loops.items():
+            result = measure(build_agent(responses, loop))
+            print(
+                f"{model_name:<22}{loop_name:<14}{result['llm_calls']:>10}"
+                f"{result['tool_calls']:>12}{result['seconds']:>10.2f}"
+                f"  {result['outcome']}"
+            )
+
+
+if __name__ == "__main__":
+    main()
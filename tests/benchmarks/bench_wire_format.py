@@ -0,0 +1,65 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmark of the NDJSON and MessagePack event stream formats.
+
+For each event type forwarded to the UI, prints the frame size and the
+client-side decode time of an event in both formats. MessagePack frames are
+decoded with the unpacker of the Streamlit client.
+
+Run from the repository root:
+    poetry run python -m tests.benchmarks.bench_wire_format
+"""
+import json
+import timeit
+from typing import Any, Callable
+
+from app.utils.encoding import NDJSON
+from app.utils.msgpack_encoding import MSGPACK
+
+from tests.benchmarks.bench_event_encoding import EVENTS
+
+try:
+    from msgpack import unpackb
+except ImportError:
+    from ormsgpack import unpackb
+
+NUMBER = 20_000
+
+
+def per_event_us(decode: Callable[[bytes], Any], frame: bytes) -> float:
+    """Return the mean decode time of a frame in microseconds."""
+    return timeit.timeit(lambda: decode(frame), number=NUMBER) / NUMBER * 1e6
+
+
+def main() -> None:
+    """Print the size and decode cost of each event in both formats."""
+    assert MSGPACK is not None, "no MessagePack packer installed"
+    print(
+        f"{'event':<24}{'ndjson (B)':>12}{'msgpack (B)':>13}"
+        f"{'ndjson (us)':>13}{'msgpack (us)':>14}"
+    )
+    for name, event in EVENTS.items():
+        ndjson_frame = NDJSON.encode_event(event)
+        msgpack_frame = MSGPACK.encode_event(event)
+        ndjson_us = per_event_us(lambda f: json.loads(f.decode("utf-8")), ndjson_frame)
+        msgpack_us = per_event_us(lambda f: unpackb(f[4:]), msgpack_frame)
+        print(
+            f"{name:<24}{len(ndjson_frame):>12}{len(msgpack_frame):>13}"
+            f"{ndjson_us:>13.2f}{msgpack_us:>14.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Throughput benchmark of the server for growing worker counts.
+
+Serves the fake agent with `python -m app.serve --workers N` and sends
+concurrent `/stream_events` requests, reporting the completed requests per
+second and their latency percentiles. By default the fake model blocks the
+event loop for its whole latency, as a synchronous `invoke` in a graph node
+does, so that a single process serves one request at a time; pass
+`--no-blocking` to compare with a model awaited on the event loop.
+
+Run from the repository root:
+    poetry run python -m tests.benchmarks.bench_workers [--workers 1 2 4]
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict
+
+from tests.benchmarks.bench_cold_start import free_port, request, wait_for
+
+BODY = {"input": {"messages": [{"type": "human", "content": "Hello!"}]}}
+
+
+def timed_request(url: str) -> float:
+    """Send a request and return its latency, failing on an error status."""
+    start = time.perf_counter()
+    status = request(url, BODY)
+    if status != 200:
+        raise RuntimeError(f"{url} answered {status}")
+    return time.perf_counter() - start
+
+
+def measure(
+    env: Dict[str, str], workers: int, concurrency: int, requests: int
+) -> Dict[str, float]:
+    """Measure the throughput of a server running `workers` processes."""
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "app.serve",
+            "--host",
+            "127.0.0.1",
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+        ],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for(f"{base_url}/ready", {200}, time.perf_counter(), 120)
+        url = f"{base_url}/stream_events"
+        with ThreadPoolExecutor(concurrency) as pool:
+            list(pool.map(timed_request, [url] * concurrency))  # Warm up
+            start = time.perf_counter()
+            latencies = list(pool.map(timed_request, [url] * requests))
+            elapsed = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        "requests_per_s": requests / elapsed,
+        "p50_ms": quantiles[49] * 1e3,
+        "p95_ms": quantiles[94] * 1e3,
+    }
+
+
+def main() -> None:
+    """Run the benchmark and print a row per worker count."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--blocking", action=argparse.BooleanOptionalAction)
+    parser.set_defaults(blocking=True)
+    args = parser.parse_args()
+
+    env = {
+        **os.environ,
+        "CHAIN_MODULE": "tests.benchmarks.fake_chain",
+        "FAKE_LLM_TOOL_ROUNDS": "0",
+        "FAKE_LLM_LATENCY": str(args.latency),
+        "FAKE_LLM_BLOCKING": str(args.blocking).lower(),
+        # The requests are identical: run each of them
+        "SINGLE_FLIGHT": "false",
+    }
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [os.getcwd(), env.get("PYTHONPATH")])
+    )
+
+    mode = "blocking" if args.blocking else "async"
+    print(
+        f"{mode} model, {args.latency * 1e3:.0f} ms per call, "
+        f"{args.concurrency} concurrent clients, {os.cpu_count()} CPUs"
+    )
+    print(f"{'workers':<10}{'req/s':>10}{'p50 (ms)':>12}{'p95 (ms)':>12}")
+    for workers in args.workers:
+        result = measure(env, workers, args.concurrency, args.requests)
+        print(
+            f"{workers:<10}{result['requests_per_s']:>10.1f}"
+            f"{result['p50_ms']:>12.1f}{result['p95_ms']:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
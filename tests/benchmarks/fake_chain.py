@@ -0,0 +1,96 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A LangGraph agent on the fake chat model, servable by the FastAPI server.
+
+Start the server on it with:
+    CHAIN_MODULE=tests.benchmarks.fake_chain poetry run uvicorn app.server:app
+
+The agent is configured through environment variables:
+    FAKE_LLM_TOOL_ROUNDS: tool calls made before answering (default 1)
+    FAKE_LLM_ANSWER_TOKENS: words in the final answer (default 50)
+    FAKE_LLM_LATENCY: seconds before the first token of each call (default 0)
+    FAKE_LLM_TOKEN_DELAY: seconds between tokens (default 0)
+    FAKE_LLM_BLOCKING: call the model synchronously, blocking the event loop
+        as a synchronous graph node does (default false)
+"""
+import os
+from typing import Dict
+
+from app.utils.tool_executor import ConcurrentToolNode
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.runnables import RunnableConfig
+from langchain_core.tools import tool
+from langgraph.graph import END, MessagesState, StateGraph
+from langgraph.graph.state import CompiledStateGraph
+
+from tests.benchmarks.fake_llm import FakeChatModel, tool_call
+
+
+@tool
+def retrieve_user_docs(query: str) -> str:
+    """Retrieve relevant user documents based on the query."""
+    return f"Retrieved docs for query: {query}"
+
+
+def build_agent(
+    tool_rounds: int = 1,
+    answer_tokens: int = 50,
+    latency: float = 0.0,
+    token_delay: float = 0.0,
+    blocking: bool = False,
+) -> CompiledStateGraph:
+    """
+    Build an agent graph calling a tool `tool_rounds` times before answering.
+
+    With `blocking`, the agent node calls `invoke` from the event loop, so that
+    the model latency stalls every other request served by the process.
+    """
+    llm = FakeChatModel(
+        responses=[
+            tool_call("retrieve_user_docs", {"query": f"q{i}"}, f"call-{i}")
+            for i in range(tool_rounds)
+        ]
+        + [AIMessage(content=" ".join(["token"] * answer_tokens))],
+        latency=latency,
+        token_delay=token_delay,
+    )
+
+    async def agent(
+        state: MessagesState, config: RunnableConfig
+    ) -> Dict[str, BaseMessage]:
+        if blocking:
+            return {"messages": llm.invoke(state["messages"], config)}
+        return {"messages": await llm.ainvoke(state["messages"], config)}
+
+    def route(state: MessagesState) -> str:
+        last_message = state["messages"][-1]
+        return "tools" if getattr(last_message, "tool_calls", None) else END
+
+    workflow = StateGraph(MessagesState)
+    workflow.add_node("agent", agent)
+    workflow.add_node("tools", ConcurrentToolNode([retrieve_user_docs]))
+    workflow.set_entry_point("agent")
+    workflow.add_conditional_edges("agent", route)
+    workflow.add_edge("tools", "agent")
+    return workflow.compile()
+
+
+chain = build_agent(
+    tool_rounds=int(os.environ.get("FAKE_LLM_TOOL_ROUNDS", "1")),
+    answer_tokens=int(os.environ.get("FAKE_LLM_ANSWER_TOKENS", "50")),
+    latency=float(os.environ.get("FAKE_LLM_LATENCY", "0")),
+    token_delay=float(os.environ.get("FAKE_LLM_TOKEN_DELAY", "0")),
+    blocking=os.environ.get("FAKE_LLM_BLOCKING", "false").lower() == "true",
+)
@@ -0,0 +1,114 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A fake tool-calling chat model used by the benchmarks in place of Vertex AI."""
+import asyncio
+import json
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional, Sequence
+
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    A chat model replaying scripted responses, cycling through them.
+    Content is streamed word by word, and tool calls are sent with the last chunk.
+    """
+
+    responses: List[AIMessage]
+    latency: float = 0.0
+    token_delay: float = 0.0
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs: Any) -> Runnable:
+        """Tools are ignored: the scripted responses decide the tool calls."""
+        return self
+
+    def _next_response(self) -> AIMessage:
+        response = self.responses[self.calls % len(self.responses)]
+        self.calls += 1
+        # A copy, as the model sets the id of the message it returns
+        return response.model_copy()
+
+    def _chunks(self, response: AIMessage) -> List[AIMessageChunk]:
+        words = response.content.split(" ") if response.content else []
+        chunks = [
+            AIMessageChunk(content=word if i == 0 else f" {word}")
+            for i, word in enumerate(words)
+        ]
+        tool_call_chunks = [
+            {
+                "name": call["name"],
+                "args": json.dumps(call["args"]),
+                "id": call["id"],
+                "index": i,
+            }
+            for i, call in enumerate(response.tool_calls)
+        ]
+        if tool_call_chunks or not chunks:
+            chunks.append(AIMessageChunk(content="", tool_call_chunks=tool_call_chunks))
+        return chunks
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._next_response())])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.latency)
+        for chunk in self._chunks(self._next_response()):
+            time.sleep(self.token_delay)
+            yield ChatGenerationChunk(message=chunk)
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.latency)
+        for chunk in self._chunks(self._next_response()):
+            await asyncio.sleep(self.token_delay)
+            yield ChatGenerationChunk(message=chunk)
+
+
+def tool_call(name: str, args: dict, call_id: str = "call-1") -> AIMessage:
+    """Build a scripted response calling a tool."""
+    return AIMessage(
+        content="", tool_calls=[{"name": name, "args": args, "id": call_id}]
+    )
@@ -16,8 +16,36 @@
 import json
 import os
 import time
+from typing import Any, Dict, Generator, Iterable
 
 from locust import HttpUser, between, task
+import msgpack
+
+# Set WIRE_FORMAT=msgpack to load test the MessagePack event stream
+WIRE_FORMAT = os.environ.get("WIRE_FORMAT", "ndjson")
+MSGPACK_MEDIA_TYPE = "application/x-msgpack"
+
+
+def iter_msgpack_frames(
+    chunks: Iterable[bytes],
+) -> Generator[Dict[str, Any], None, None]:
+    """Decode a stream of MessagePack events, each prefixed by its length."""
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= 4:
+            end = 4 + int.from_bytes(buffer[:4], "big")
+            if len(buffer) < end:
+                break
+            yield msgpack.unpackb(bytes(buffer[4:end]))
+            del buffer[:end]
+
+
+def iter_ndjson_events(lines: Iterable[bytes]) -> Generator[Dict[str, Any], None, None]:
+    """Decode a stream of NDJSON events."""
+    for line in lines:
+        if line:
+            yield json.loads(line)
 
 
 class ChatStreamUser(HttpUser):
@@ -29,6 +57,8 @@ class ChatStreamUser(HttpUser):
     def chat_stream(self) -> None:
         """Simulates a chat stream interaction."""
         headers = {"Content-Type": "application/json"}
+        if WIRE_FORMAT == "msgpack":
+            headers["Accept"] = MSGPACK_MEDIA_TYPE
         if os.environ.get("_ID_TOKEN"):
             headers["Authorization"] = f'Bearer {os.environ["_ID_TOKEN"]}'
 
@@ -55,12 +85,17 @@ class ChatStreamUser(HttpUser):
             stream=True,
         ) as response:
             if response.status_code == 200:
+                if response.headers.get("Content-Type", "").startswith(
+                    MSGPACK_MEDIA_TYPE
+                ):
+                    stream = iter_msgpack_frames(response.iter_content(None))
+                else:
+                    stream = iter_ndjson_events(response.iter_lines())
                 events = []
-                for line in response.iter_lines():
-                    if line:
-                        events.append(json.loads(line))
-                        if events[-1]["event"] == "end":
-                            break
+                for event in stream:
+                    events.append(event)
+                    if event["event"] == "end":
+                        break
 
                 end_time = time.time()
                 total_time = end_time - start_time
@@ -0,0 +1,242 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=W0621
+
+import importlib
+import time
+from types import ModuleType
+from typing import Any, List, Optional, Tuple
+from unittest.mock import MagicMock, patch
+
+from app.utils.digest_store import DigestStore
+from app.utils.tool_loop import ToolLoop
+from google.auth.credentials import Credentials
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+import pytest
+
+from tests.benchmarks.fake_llm import FakeChatModel, tool_call
+
+CONFIG: RunnableConfig = {"configurable": {"user_id": "alice", "session_id": "s1"}}
+
+
+class RecordingChatModel(FakeChatModel):
+    """A fake model recording whether it is called synchronously or not."""
+
+    modes: List[str] = []
+
+    def invoke(self, *args: Any, **kwargs: Any) -> Any:
+        self.modes.append("sync")
+        return super().invoke(*args, **kwargs)
+
+    async def ainvoke(self, *args: Any, **kwargs: Any) -> Any:
+        self.modes.append("async")
+        return await super().ainvoke(*args, **kwargs)
+
+
+@pytest.fixture(scope="module")
+def chain_module() -> ModuleType:
+    """Import the mirror agent, which initializes Vertex AI on import."""
+    with (
+        patch(
+            "google.auth.default",
+            return_value=(MagicMock(spec=Credentials), "mock-project-id"),
+        ),
+        patch("vertexai.init"),
+    ):
+        return importlib.import_module("app.patterns.mirror_agent.chain")
+
+
+@pytest.fixture
+def searches(
+    chain_module: ModuleType, monkeypatch: pytest.MonkeyPatch
+) -> List[Tuple[Optional[str], str]]:
+    """Record the document searches of the agent."""
+    calls: List[Tuple[Optional[str], str]] = []
+
+    def search_user_docs(user_id: Optional[str], query: str) -> str:
+        calls.append((user_id, query))
+        return "A journal entry about hiking."
+
+    monkeypatch.setattr(chain_module, "search_user_docs", search_user_docs)
+    return calls
+
+
+def use_models(
+    chain_module: ModuleType,
+    monkeypatch: pytest.MonkeyPatch,
+    responses: List[AIMessage],
+    max_tool_rounds: int = 2,
+) -> Tuple[RecordingChatModel, RecordingChatModel]:
+    """Replace the models of the agent, returning the tool and final models."""
+    llm = RecordingChatModel(responses=responses)
+    final_llm = RecordingChatModel(responses=[AIMessage(content="Final answer.")])
+    monkeypatch.setattr(
+        chain_module, "mirror_agent", chain_module.mirror_system_prompt | llm
+    )
+    monkeypatch.setattr(
+        chain_module,
+        "mirror_agent_final",
+        chain_module.mirror_system_prompt | final_llm,
+    )
+    monkeypatch.setattr(
+        chain_module, "tool_loop", ToolLoop(max_tool_rounds=max_tool_rounds)
+    )
+    monkeypatch.setattr(chain_module, "interaction_digests", MagicMock())
+    return llm, final_llm
+
+
+def test_tool_rounds_are_capped_by_a_final_answer(
+    chain_module: ModuleType,
+    monkeypatch: pytest.MonkeyPatch,
+    searches: List[Tuple[Optional[str], str]],
+) -> None:
+    """Test that the model answers without tools once the rounds are spent."""
+    llm, final_llm = use_models(
+        chain_module,
+        monkeypatch,
+        [tool_call("retrieve_user_docs", {"query": "hiking"})],
+    )
+    result = chain_module.chain.invoke(
+        {"messages": [HumanMessage(content="What do I enjoy?")]}, CONFIG
+    )
+    assert (llm.calls, final_llm.calls) == (2, 1)
+    assert (result["llm_calls"], result["tool_calls"]) == (3, 2)
+    assert result["messages"][-1].content == "Final answer."
+    assert not result["messages"][-1].tool_calls
+    # The user of the run reaches the tool through the run config
+    assert searches == [("alice", "hiking"), ("alice", "hiking")]
+
+
+def test_agent_answers_without_tools(
+    chain_module: ModuleType,
+    monkeypatch: pytest.MonkeyPatch,
+    searches: List[Tuple[Optional[str], str]],
+) -> None:
+    """Test that an answer without tool calls ends the run."""
+    llm, final_llm = use_models(
+        chain_module, monkeypatch, [AIMessage(content="Tell me more.")]
+    )
+    result = chain_module.chain.invoke(
+        {"messages": [HumanMessage(content="Hello!")]}, CONFIG
+    )
+    assert (llm.calls, final_llm.calls) == (1, 0)
+    assert [m.content for m in result["messages"]] == ["Hello!", "Tell me more."]
+    assert searches == []
+
+
+@pytest.mark.asyncio
+async def test_agent_node_is_awaited_when_run_asynchronously(
+    chain_module: ModuleType,
+    monkeypatch: pytest.MonkeyPatch,
+    searches: List[Tuple[Optional[str], str]],
+) -> None:
+    """Test that the graph runs the coroutine of the agent node on ainvoke."""
+    llm, final_llm = use_models(
+        chain_module,
+        monkeypatch,
+        [tool_call("retrieve_user_docs", {"query": "hiking"})],
+        max_tool_rounds=1,
+    )
+    result = await chain_module.chain.ainvoke(
+        {"messages": [HumanMessage(content="What do I enjoy?")]}, CONFIG
+    )
+    assert llm.modes == final_llm.modes == ["async"]
+    assert result["messages"][-1].content == "Final answer."
+    assert searches == [("alice", "hiking")]
+
+    chain_module.chain.invoke({"messages": [HumanMessage(content="Again")]}, CONFIG)
+    assert llm.modes == final_llm.modes == ["async", "sync"]
+
+
+@pytest.mark.asyncio
+async def test_slow_tool_calls_time_out(
+    chain_module: ModuleType, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that the model gets an error for a tool call past its deadline."""
+
+    def search_user_docs(user_id: Optional[str], query: str) -> str:
+        time.sleep(0.5)
+        return "Too late."
+
+    monkeypatch.setattr(chain_module, "search_user_docs", search_user_docs)
+    monkeypatch.setattr(chain_module.chain.nodes["tools"].bound, "timeout", 0.05)
+    use_models(
+        chain_module,
+        monkeypatch,
+        [tool_call("retrieve_user_docs", {"query": "hiking"})],
+        max_tool_rounds=1,
+    )
+    start = time.perf_counter()
+    result = await chain_module.chain.ainvoke(
+        {"messages": [HumanMessage(content="What do I enjoy?")]}, CONFIG
+    )
+    assert time.perf_counter() - start < 0.4
+    tool_messages = [m for m in result["messages"] if isinstance(m, ToolMessage)]
+    assert len(tool_messages) == 1
+    assert tool_messages[0].status == "error"
+    assert "timed out" in tool_messages[0].content
+    assert result["messages"][-1].content == "Final answer."
+
+
+def test_finished_turn_records_the_session_digest(
+    chain_module: ModuleType,
+    monkeypatch: pytest.MonkeyPatch,
+    searches: List[Tuple[Optional[str], str]],
+) -> None:
+    """Test that the digest of the session is updated once the agent answers."""
+    use_models(
+        chain_module,
+        monkeypatch,
+        [tool_call("retrieve_user_docs", {"query": "hiking"})],
+        max_tool_rounds=1,
+    )
+    result = chain_module.chain.invoke(
+        {"messages": [HumanMessage(content="What do I enjoy?")]}, CONFIG
+    )
+    # Not after the response calling a tool, only after the final answer
+    chain_module.interaction_digests.record.assert_called_once_with(
+        "alice", "s1", result["messages"]
+    )
+
+    chain_module.interaction_digests.reset_mock()
+    chain_module.chain.invoke(
+        {"messages": [HumanMessage(content="Hello!")]},
+        {"configurable": {"user_id": "alice"}},
+    )
+    chain_module.interaction_digests.record.assert_not_called()
+
+
+def test_reflection_excludes_the_current_session(
+    chain_module: ModuleType, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that the digests of the other sessions of the user are returned."""
+    store = DigestStore(":memory:", RunnableLambda(lambda _: "Talked about hiking."))
+    for user_id, session_id in [("alice", "s1"), ("alice", "s2"), ("bob", "s3")]:
+        store.record(user_id, session_id, [HumanMessage(content="I like hiking.")])
+    assert store.flush(timeout=5)
+    monkeypatch.setattr(chain_module, "interaction_digests", store)
+
+    reflection = chain_module.reflect_on_recent_interactions.invoke(
+        {"context": "hiking"}, CONFIG
+    )
+    assert "Session s2" in reflection
+    assert "Session s1" not in reflection
+    assert "Session s3" not in reflection
+    assert "Talked about hiking." in reflection
+
+    assert chain_module.reflect_on_recent_interactions.invoke(
+        {"context": "hiking"}, {"configurable": {}}
+    ) == ("No earlier interactions with the user are available.")
@@ -0,0 +1,144 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, List, Optional
+import urllib.error
+import urllib.request
+
+from app.serve import Supervisor
+import pytest
+
+
+async def app(scope: dict, receive: Callable, send: Callable) -> None:
+    """An ASGI application answering with the pid of its worker."""
+    if scope["type"] != "http":
+        return
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": str(os.getpid()).encode()})
+
+
+def fetch(url: str) -> Optional[str]:
+    """Return the body of a response, None if the server is not up."""
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            return response.read().decode()
+    except (urllib.error.URLError, ConnectionError):
+        return None
+
+
+def worker_pid(url: str) -> Optional[int]:
+    """Return the pid of the worker answering a request, None if not up."""
+    body = fetch(url)
+    return None if body is None else int(body)
+
+
+def start_supervisor(app_path: str, *args: str, **env: str) -> tuple:
+    """Start a supervisor of one worker on a free port, return it and its URL."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    command: List[str] = [
+        sys.executable,
+        "-m",
+        "app.serve",
+        "--app",
+        app_path,
+        "--host",
+        "127.0.0.1",
+        "--port",
+        str(port),
+        "--workers",
+        "1",
+        "--graceful-timeout",
+        "5",
+        *args,
+    ]
+    supervisor = subprocess.Popen(
+        command,
+        env={**os.environ, "PYTHONPATH": os.getcwd(), **env},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return supervisor, f"http://127.0.0.1:{port}/"
+
+
+def wait_until(predicate: Callable[[], Any], timeout: float = 30) -> Any:
+    """Poll a predicate until it returns a truthy value."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        value = predicate()
+        if value:
+            return value
+        time.sleep(0.05)
+    raise TimeoutError("Condition not met")
+
+
+def test_workers_must_be_positive() -> None:
+    """Test that a supervisor needs at least one worker."""
+    with pytest.raises(ValueError):
+        Supervisor("app.server:app", socket.socket(), workers=0)
+
+
+def test_reload_replaces_workers_and_stop_exits() -> None:
+    """Test that SIGHUP replaces the workers and SIGTERM stops the supervisor."""
+    supervisor, url = start_supervisor("tests.unit.test_serve:app", "--no-preload")
+    try:
+        first_pid = wait_until(lambda: worker_pid(url))
+        assert first_pid != supervisor.pid
+
+        supervisor.send_signal(signal.SIGHUP)
+        wait_until(lambda: worker_pid(url) not in (None, first_pid))
+
+        supervisor.send_signal(signal.SIGTERM)
+        assert supervisor.wait(timeout=10) == 0
+        assert worker_pid(url) is None
+    finally:
+        supervisor.kill()
+        supervisor.wait()
+
+
+def test_reload_imports_the_changed_server(tmp_path: Path) -> None:
+    """Test that a reload of a preloaded server serves its new code."""
+    module = tmp_path / "reloaded_app.py"
+    source = """
+async def app(scope, receive, send):
+    if scope["type"] != "http":
+        return
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": VERSION.encode()})
+"""
+    module.write_text(f"VERSION = 'old'\n{source}")
+    supervisor, url = start_supervisor(
+        "reloaded_app:app",
+        PYTHONPATH=f"{os.getcwd()}{os.pathsep}{tmp_path}",
+        PYTHONDONTWRITEBYTECODE="1",
+    )
+    try:
+        assert wait_until(lambda: fetch(url)) == "old"
+        module.write_text(f"VERSION = 'new'\n{source}")
+        supervisor.send_signal(signal.SIGHUP)
+        wait_until(lambda: fetch(url) == "new")
+        # The supervisor kept its process and stops as usual
+        supervisor.send_signal(signal.SIGTERM)
+        assert supervisor.wait(timeout=10) == 0
+    finally:
+        supervisor.kill()
+        supervisor.wait()
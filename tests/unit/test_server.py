@@ -11,20 +11,20 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-# pylint: disable=W0707, C0415
+# pylint: disable=W0707, C0415, W0613, W0621
 
 import importlib.util
 import json
 import logging
 import os
-from typing import Any, Generator
+from typing import Any, AsyncGenerator, Generator
 from unittest.mock import MagicMock, patch
 
 from app.utils.input_types import InputChat
 from google.auth import exceptions as google_auth_exceptions
 from google.auth.credentials import Credentials
 from httpx import AsyncClient
-from langchain_core.messages import HumanMessage
+from langchain_core.messages import AIMessageChunk, HumanMessage
 import pytest
 
 # Set up logging
@@ -68,10 +68,11 @@ def sample_input_chat() -> InputChat:
 
 
 @pytest.fixture(autouse=True)
-def mock_dependencies() -> Generator[None, None, None]:
+def mock_dependencies(mock_google_auth_default: None) -> Generator[None, None, None]:
     """
     Mock Vertex AI dependencies for testing.
     Patches VertexAIEmbeddings (if defined) and ChatVertexAI.
+    Depends on the mocked credentials, as importing the chain initializes Vertex AI.
     """
     patches = []
     try:
@@ -174,3 +175,658 @@ async def test_stream_chat_events() -> None:
         assert events[2]["event"] == "on_chat_model_stream"
         assert events[2]["data"]["content"] == "Additional response"
         assert events[3]["event"] == "end"
+
+
+@pytest.mark.asyncio
+async def test_stream_chat_events_replays_cached_response() -> None:
+    """
+    Test that an identical conversation is answered from the response cache
+    without calling the chain a second time.
+    """
+    from app.server import app
+    from app.utils.cache import ResponseCache
+
+    input_data = {
+        "input": {
+            "user_id": "test-user",
+            "session_id": "test-session",
+            "messages": [{"type": "human", "content": "What is the meaning of life?"}],
+        }
+    }
+    mock_events = [
+        {"event": "on_chain_start", "data": {}},
+        {"event": "on_chat_model_stream", "data": {"content": "42"}},
+    ]
+
+    with patch("app.server.chain") as mock_chain, patch(
+        "app.server.response_cache", ResponseCache(maxsize=4)
+    ) as cache, patch("app.server.Traceloop.set_association_properties"):
+        mock_chain.astream_events.side_effect = lambda *args, **kwargs: AsyncIterator(
+            mock_events
+        )
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            first = await ac.post("/stream_events", json=input_data)
+            second = await ac.post("/stream_events", json=input_data)
+
+        assert mock_chain.astream_events.call_count == 1
+        assert cache.stats()["hits"] == 1
+
+        # Answers may hold private data of the user, so users never share them
+        input_data["input"]["user_id"] = "other-user"
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            await ac.post("/stream_events", json=input_data)
+        assert mock_chain.astream_events.call_count == 2
+
+    first_events = [json.loads(line) for line in first.iter_lines()]
+    second_events = [json.loads(line) for line in second.iter_lines()]
+    assert [e["event"] for e in second_events] == [
+        "metadata",
+        "on_chat_model_stream",
+        "end",
+    ]
+    assert first_events[1:] == second_events[1:]
+
+
+@pytest.mark.asyncio
+async def test_stream_chat_events_negotiates_compression() -> None:
+    """Test that the event stream is compressed with the accepted coding."""
+    from app.server import app
+
+    input_data = {
+        "input": {
+            "user_id": "test-user",
+            "session_id": "test-session",
+            "messages": [{"type": "human", "content": "What is the meaning of life?"}],
+        }
+    }
+    mock_events = [{"event": "on_chat_model_stream", "data": {"content": "42"}}]
+
+    with patch("app.server.chain") as mock_chain:
+        mock_chain.astream_events.side_effect = lambda *args, **kwargs: AsyncIterator(
+            mock_events
+        )
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            compressed = await ac.post(
+                "/stream_events", json=input_data, headers={"Accept-Encoding": "gzip"}
+            )
+            plain = await ac.post(
+                "/stream_events",
+                json=input_data,
+                headers={"Accept-Encoding": "identity"},
+            )
+
+    assert compressed.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in compressed.headers["vary"]
+    assert "content-encoding" not in plain.headers
+    for response in (compressed, plain):
+        events = [json.loads(line) for line in response.iter_lines()]
+        assert [e["event"] for e in events] == [
+            "metadata",
+            "on_chat_model_stream",
+            "end",
+        ]
+
+
+@pytest.mark.asyncio
+async def test_stream_chat_events_msgpack() -> None:
+    """Test that clients asking for MessagePack get length-prefixed frames."""
+    from app.server import app
+    from app.utils.msgpack_encoding import MSGPACK
+
+    if MSGPACK is None:
+        pytest.skip("no MessagePack packer installed")
+    try:
+        from ormsgpack import unpackb
+    except ImportError:
+        from msgpack import unpackb
+
+    input_data = {
+        "input": {
+            "user_id": "test-user",
+            "session_id": "test-session",
+            "messages": [{"type": "human", "content": "What is the meaning of life?"}],
+        }
+    }
+    mock_events = [
+        {
+            "event": "on_chat_model_stream",
+            "run_id": "run",
+            "data": {"chunk": AIMessageChunk(content="42")},
+        }
+    ]
+
+    with patch("app.server.chain") as mock_chain:
+        mock_chain.astream_events.side_effect = lambda *args, **kwargs: AsyncIterator(
+            mock_events
+        )
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            response = await ac.post(
+                "/stream_events",
+                json=input_data,
+                headers={"Accept": "application/x-msgpack"},
+            )
+
+    assert response.headers["content-type"] == "application/x-msgpack"
+    body, events = response.content, []
+    while body:
+        end = 4 + int.from_bytes(body[:4], "big")
+        events.append(unpackb(body[4:end]))
+        body = body[end:]
+    assert [e["event"] for e in events] == ["metadata", "on_chat_model_stream", "end"]
+    assert events[1]["data"] == {"chunk": {"content": "42", "additional_kwargs": {}}}
+
+
+@pytest.mark.asyncio
+async def test_stream_chat_events_filters_events() -> None:
+    """
+    Test that only the run types consumed by the UI are requested from the
+    chain, with the user in the run config, and that events outside
+    SUPPORTED_EVENTS are not forwarded.
+    """
+    from app.server import SUPPORTED_RUN_TYPES, app
+
+    input_data = {
+        "input": {
+            "user_id": "test-user",
+            "session_id": "test-session",
+            "messages": [{"type": "human", "content": "Hello, AI!"}],
+        }
+    }
+    mock_events = [
+        {"event": "on_chat_model_start", "data": {}},
+        {"event": "on_tool_start", "name": "search", "data": {"input": {}}},
+        {"event": "on_chat_model_end", "data": {}},
+    ]
+
+    with patch("app.server.chain") as mock_chain, patch(
+        "app.server.Traceloop.set_association_properties"
+    ):
+        mock_chain.astream_events.return_value = AsyncIterator(mock_events)
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            response = await ac.post("/stream_events", json=input_data)
+
+        _, kwargs = mock_chain.astream_events.call_args
+        assert kwargs["include_types"] == SUPPORTED_RUN_TYPES
+        # Tools find the user of the request in the run config
+        assert kwargs["config"]["configurable"] == {
+            "user_id": "test-user",
+            "session_id": "test-session",
+        }
+
+    events = [json.loads(line)["event"] for line in response.iter_lines()]
+    assert events == ["metadata", "on_tool_start", "end"]
+
+
+@pytest.mark.asyncio
+async def test_stream_chat_events_custom_chain() -> None:
+    """
+    Test that a chain built with `custom_chain`, as by the custom RAG pattern,
+    is streamed and receives the run config.
+    """
+    from app.server import app
+    from app.utils.decorators import custom_chain
+    from app.utils.lazy import LazyChain
+    from app.utils.output_types import OnChatModelStreamEvent
+
+    configs = []
+
+    @custom_chain
+    async def chain(input: dict, **kwargs: Any) -> AsyncGenerator[Any, None]:
+        configs.append(kwargs["config"])
+        chunk = AIMessageChunk(content=input["messages"][-1].content)
+        yield OnChatModelStreamEvent(data={"chunk": chunk})
+
+    lazy_chain = LazyChain("custom")
+    lazy_chain._chain = chain
+    input_data = {
+        "input": {
+            "user_id": "test-user",
+            "session_id": "test-session",
+            "messages": [{"type": "human", "content": "Custom chain"}],
+        }
+    }
+    with patch("app.server.chain", lazy_chain), patch(
+        "app.server.Traceloop.set_association_properties"
+    ):
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            response = await ac.post("/stream_events", json=input_data)
+
+    events = [json.loads(line) for line in response.iter_lines()]
+    assert [event["event"] for event in events] == [
+        "metadata",
+        "on_chat_model_stream",
+        "end",
+    ]
+    assert events[1]["data"]["chunk"]["content"] == "Custom chain"
+    assert configs[0]["configurable"]["user_id"] == "test-user"
+
+
+def test_ready_reports_warm_status() -> None:
+    """
+    Test that the server accepts requests while warming up, and that /ready
+    reports 503 until the warm-up has completed.
+    """
+    import threading
+    import time
+
+    from app.server import app
+    from app.utils.lazy import LazyChain
+    from fastapi.testclient import TestClient
+
+    release = threading.Event()
+    with patch("app.server.warm_up", side_effect=lambda: release.wait(5)), patch(
+        "app.server.chain", LazyChain("app.utils.output_types:EndEvent")
+    ):
+        with TestClient(app) as client:
+            response = client.get("/ready")
+            assert response.status_code == 503
+            assert response.json()["status"] == "starting"
+
+            release.set()
+            for _ in range(100):
+                response = client.get("/ready")
+                if response.status_code == 200:
+                    break
+                time.sleep(0.05)
+            assert response.status_code == 200
+            assert response.json()["status"] == "ready"
+
+
+@pytest.mark.asyncio
+async def test_collect_feedback_is_written_in_background(tmp_path: Any) -> None:
+    """
+    Test that feedback is queued by the endpoint and written by the sink.
+    """
+    from app.server import app
+    from app.utils.feedback import FeedbackSink, LocalFileFeedbackBackend
+
+    output = tmp_path / "feedback.jsonl"
+    sink = FeedbackSink(
+        LocalFileFeedbackBackend(str(output)),
+        spill_path=str(tmp_path / "spill.jsonl"),
+        flush_interval=60,
+    )
+    feedback = {"score": 1.0, "text": "Great!", "run_id": "run"}
+
+    with patch("app.server.feedback_sink", sink):
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            response = await ac.post("/feedback", json=feedback)
+        assert response.status_code == 200
+        assert sink.queue_depth == 1
+        await sink.stop()
+
+    assert json.loads(output.read_text()) == {**feedback, "log_type": "feedback"}
+
+
+@pytest.mark.asyncio
+async def test_stream_chat_events_rejects_when_saturated(
+    sample_input_chat: InputChat,
+) -> None:
+    """
+    Test that a request is rejected with Retry-After once the queue is full.
+    """
+    from app.server import app
+    from app.utils.admission import AdmissionController
+
+    admission = AdmissionController(max_concurrent=1, max_queue=0)
+    permit = await admission.acquire("other-user")
+    data = {"input": sample_input_chat.model_dump(), "config": {}}
+
+    with patch("app.server.admission", admission):
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            response = await ac.post("/stream_events", json=data)
+            assert response.status_code == 429
+            assert int(response.headers["Retry-After"]) >= 1
+
+            stats = await ac.get("/stats")
+            assert stats.json()["admission"]["rejected_queue_full"] == 1
+    permit.release()
+
+
+def test_metrics_endpoint() -> None:
+    """
+    Test that the metrics are exposed in the Prometheus text format.
+    """
+    from app.server import app
+    from fastapi.testclient import TestClient
+
+    client = TestClient(app)
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "# TYPE chat_time_to_first_token_seconds histogram" in response.text
+    assert "feedback_queue_depth 0" in response.text
+
+
+@pytest.mark.asyncio
+async def test_closing_stream_cancels_chain_run() -> None:
+    """
+    Test that closing the response stream closes the chain run at once and
+    records the cancellation.
+    """
+    from app.server import stream_chain_frames, stream_metrics
+
+    closed = []
+
+    async def astream_events(*args: Any, **kwargs: Any) -> AsyncGenerator[Any, None]:
+        try:
+            for i in range(10):
+                yield {
+                    "event": "on_chat_model_stream",
+                    "run_id": str(i),
+                    "data": {"chunk": {"content": str(i)}},
+                }
+        finally:
+            closed.append(True)
+
+    with patch("app.server.chain") as mock_chain:
+        mock_chain.astream_events = astream_events
+        cancellations = stream_metrics.cancellations.values.get("", 0)
+        stream = stream_metrics.measure(stream_chain_frames({}, 0.0), 0.0)
+        await stream.__anext__()
+        await stream.aclose()
+
+    assert closed == [True]
+    assert stream_metrics.cancellations.values[""] == cancellations + 1
+
+
+@pytest.mark.asyncio
+async def test_stream_chat_events_rebuilds_session_history() -> None:
+    """
+    Test that a client of a stored session only sends the new messages, and
+    that deltas based on a stale version are rejected.
+    """
+    from app.server import app
+    from app.utils.session_store import SessionStore
+
+    def chat(messages: list, session_version: int) -> dict:
+        return {
+            "input": {
+                "user_id": "test-user",
+                "session_id": "test-session",
+                "session_version": session_version,
+                "messages": messages,
+            }
+        }
+
+    with patch("app.server.chain") as mock_chain, patch(
+        "app.server.session_store", SessionStore(":memory:")
+    ), patch("app.server.single_flight", None):
+        mock_chain.astream_events.side_effect = lambda *args, **kwargs: AsyncIterator(
+            []
+        )
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            first = await ac.post(
+                "/stream_events", json=chat([{"type": "human", "content": "Hi"}], 0)
+            )
+            version = json.loads(first.text.splitlines()[0])["data"]["session_version"]
+            delta = [
+                {"type": "ai", "content": "Hello"},
+                {"type": "human", "content": "How are you?"},
+            ]
+            second = await ac.post("/stream_events", json=chat(delta, version))
+            stale = await ac.post("/stream_events", json=chat(delta, version))
+
+    assert json.loads(second.text.splitlines()[0])["data"]["session_version"] == 2
+    chain_input = mock_chain.astream_events.call_args_list[1].args[0]
+    assert [m.content for m in chain_input["messages"]] == [
+        "Hi",
+        "Hello",
+        "How are you?",
+    ]
+    assert stale.status_code == 409
+    assert stale.json()["session_version"] == 2
+
+
+def test_websocket_turns_reuse_session_state() -> None:
+    """
+    Test that turns on a connection stream the usual events, and that the
+    following turns of a session only send their new messages.
+    """
+    from app.server import app
+    from app.utils.session_store import SessionStore
+    from starlette.testclient import TestClient
+
+    def turn(messages: list, **fields: Any) -> dict:
+        return {
+            "type": "turn",
+            "input": {
+                "user_id": "test-user",
+                "session_id": "test-session",
+                "messages": messages,
+                **fields,
+            },
+        }
+
+    def receive_turn(websocket: Any) -> list:
+        events = [websocket.receive_json()]
+        while events[-1]["event"] not in ("end", "error"):
+            events.append(websocket.receive_json())
+        return events
+
+    mock_events = [{"event": "on_chat_model_stream", "data": {"content": "42"}}]
+    with patch("app.server.chain") as mock_chain, patch(
+        "app.server.session_store", SessionStore(":memory:")
+    ), patch("app.server.single_flight", None):
+        mock_chain.astream_events.side_effect = lambda *args, **kwargs: AsyncIterator(
+            mock_events
+        )
+        with TestClient(app).websocket_connect("/ws") as websocket:
+            websocket.send_json(
+                turn([{"type": "human", "content": "Hi"}], session_version=0)
+            )
+            first = receive_turn(websocket)
+            websocket.send_json(
+                turn(
+                    [
+                        {"type": "ai", "content": "Hello"},
+                        {"type": "human", "content": "How are you?"},
+                    ]
+                )
+            )
+            second = receive_turn(websocket)
+            websocket.send_json({"type": "unknown"})
+            error = websocket.receive_json()
+
+    assert [e["event"] for e in first] == ["metadata", "on_chat_model_stream", "end"]
+    assert second[0]["data"]["session_version"] == 2
+    chain_input = mock_chain.astream_events.call_args_list[1].args[0]
+    assert [m.content for m in chain_input["messages"]] == [
+        "Hi",
+        "Hello",
+        "How are you?",
+    ]
+    assert error["event"] == "error"
+    assert error["data"]["status"] == 422
+
+
+def test_websocket_cancel_stops_the_turn() -> None:
+    """Test that a cancel message closes the chain run of the running turn."""
+    import asyncio
+
+    from app.server import app
+    from starlette.testclient import TestClient
+
+    closed = []
+
+    async def astream_events(*args: Any, **kwargs: Any) -> AsyncGenerator[Any, None]:
+        try:
+            yield {"event": "on_chat_model_stream", "data": {"content": "4"}}
+            await asyncio.sleep(60)
+            yield {"event": "on_chat_model_stream", "data": {"content": "2"}}
+        finally:
+            closed.append(True)
+
+    with patch("app.server.chain") as mock_chain, patch(
+        "app.server.single_flight", None
+    ):
+        mock_chain.astream_events = astream_events
+        with TestClient(app).websocket_connect("/ws") as websocket:
+            websocket.send_json(
+                {
+                    "type": "turn",
+                    "input": {"messages": [{"type": "human", "content": "Hi"}]},
+                }
+            )
+            assert websocket.receive_json()["event"] == "metadata"
+            assert websocket.receive_json()["event"] == "on_chat_model_stream"
+            websocket.send_json({"type": "cancel"})
+            assert websocket.receive_json() == {"event": "cancelled"}
+
+    assert closed == [True]
+
+
+def test_websocket_closes_on_binary_messages() -> None:
+    """
+    Test that /ws answers invalid text messages with an error event and
+    closes the connection on binary messages.
+    """
+    from app.server import app
+    from fastapi.testclient import TestClient
+    from starlette.websockets import WebSocketDisconnect
+
+    with TestClient(app).websocket_connect("/ws") as websocket:
+        websocket.send_text("not json")
+        assert websocket.receive_json()["data"]["status"] == 422
+        websocket.send_bytes(b'{"type": "cancel"}')
+        with pytest.raises(WebSocketDisconnect) as e:
+            websocket.receive_json()
+        assert e.value.code == 1003
+
+
+@pytest.mark.asyncio
+async def test_batch_streams_results_by_index() -> None:
+    """
+    Test that /batch answers every conversation, reporting invalid ones
+    without failing the others.
+    """
+    from app.server import app
+    from langchain_core.messages import AIMessage
+
+    async def ainvoke(input_dict: dict, *args: Any, **kwargs: Any) -> dict:
+        question = input_dict["messages"][-1].content
+        return {"messages": [*input_dict["messages"], AIMessage(content=question)]}
+
+    inputs = [
+        {"messages": [{"type": "human", "content": "first"}]},
+        {"messages": [{"type": "unknown", "content": "invalid"}]},
+        {"messages": [{"type": "human", "content": "third"}]},
+    ]
+    with patch("app.server.chain") as mock_chain:
+        mock_chain.ainvoke = ainvoke
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            response = await ac.post("/batch", json={"inputs": inputs})
+            invalid = await ac.post("/batch", json={"inputs": "none"})
+
+    assert response.status_code == 200
+    results = {r["index"]: r for r in map(json.loads, response.iter_lines())}
+    assert results[0]["output"]["content"] == "first"
+    assert results[1]["error"]["status"] == 422
+    assert results[2]["output"]["content"] == "third"
+    assert invalid.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_batch_retries_rejected_items() -> None:
+    """
+    Test that a batch item rejected by admission control is retried, and that
+    its deadline only starts once it is admitted.
+    """
+    import asyncio
+
+    from app.server import app
+    from app.utils.admission import AdmissionController
+    from langchain_core.messages import AIMessage
+
+    async def ainvoke(input_dict: dict, *args: Any, **kwargs: Any) -> dict:
+        return {"messages": [AIMessage(content="answer")]}
+
+    admission = AdmissionController(max_concurrent=1, max_queue=0)
+    permit = await admission.acquire("other-user")
+    asyncio.get_running_loop().call_later(0.2, permit.release)
+    inputs = [{"messages": [{"type": "human", "content": "Hi"}]}]
+    with patch("app.server.chain") as mock_chain, patch(
+        "app.server.admission", admission
+    ), patch("app.server.BATCH_ITEM_TIMEOUT_SECONDS", 0.5):
+        mock_chain.ainvoke = ainvoke
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            # Rejected at once, admitted after the suggested delay of 1s
+            response = await ac.post("/batch", json={"inputs": inputs})
+            (result,) = map(json.loads, response.iter_lines())
+            assert result["output"]["content"] == "answer"
+
+            permit = await admission.acquire("other-user")
+            with patch("app.server.BATCH_ADMISSION_RETRIES", 0):
+                response = await ac.post("/batch", json={"inputs": inputs})
+            (result,) = map(json.loads, response.iter_lines())
+            assert result["error"]["status"] == 429
+            permit.release()
+
+
+@pytest.mark.asyncio
+async def test_batch_runs_custom_chains() -> None:
+    """Test that /batch answers with chains built with `custom_chain`."""
+    from app.server import app
+    from app.utils.decorators import custom_chain
+    from app.utils.lazy import LazyChain
+    from app.utils.output_types import OnChatModelStreamEvent
+
+    @custom_chain
+    async def chain(input: dict, **kwargs: Any) -> AsyncGenerator[Any, None]:
+        for word in input["messages"][-1].content.split():
+            chunk = AIMessageChunk(content=word.upper())
+            yield OnChatModelStreamEvent(data={"chunk": chunk})
+
+    lazy_chain = LazyChain("custom")
+    lazy_chain._chain = chain
+    inputs = [{"messages": [{"type": "human", "content": "custom chain"}]}]
+    with patch("app.server.chain", lazy_chain):
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            response = await ac.post("/batch", json={"inputs": inputs})
+
+    (result,) = map(json.loads, response.iter_lines())
+    assert result["output"]["content"] == "CUSTOMCHAIN"
+
+
+@pytest.mark.asyncio
+async def test_start_turn_releases_the_permit_on_failures() -> None:
+    """
+    Test that a turn cancelled, or failing, while its session is applied
+    gives its admission slot back.
+    """
+    import asyncio
+    import sqlite3
+    import threading
+
+    from app.server import start_turn
+    from app.utils.admission import AdmissionController
+
+    admission = AdmissionController(max_concurrent=2)
+    applying = threading.Event()
+    done = threading.Event()
+
+    def blocking_apply(*args: Any) -> Any:
+        applying.set()
+        done.wait(5)
+        raise sqlite3.OperationalError("database is locked")
+
+    input_chat = InputChat(
+        user_id="test-user",
+        session_id="test-session",
+        session_version=0,
+        messages=[HumanMessage(content="Hello")],
+    )
+    with patch("app.server.admission", admission), patch(
+        "app.server.session_store.apply", blocking_apply
+    ):
+        turn = asyncio.create_task(start_turn(input_chat))
+        await asyncio.to_thread(applying.wait, 5)
+        turn.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await turn
+        assert admission.active == 0
+
+        done.set()
+        with pytest.raises(sqlite3.OperationalError):
+            await start_turn(input_chat)
+        assert admission.active == 0
@@ -0,0 +1,172 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from typing import AsyncGenerator, List
+
+from app.utils.admission import (
+    BATCH,
+    INTERACTIVE,
+    AdmissionController,
+    AdmissionRejected,
+    release_when_done,
+)
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_rejects_when_queue_is_full() -> None:
+    """Test that requests beyond the queue capacity are rejected at once."""
+    controller = AdmissionController(max_concurrent=1, max_queue=1)
+    permit = await controller.acquire("a")
+    waiter = asyncio.create_task(controller.acquire("b"))
+    await asyncio.sleep(0)
+    with pytest.raises(AdmissionRejected) as e:
+        await controller.acquire("c")
+    assert e.value.retry_after >= 1
+    assert controller.stats()["rejected_queue_full"] == 1
+
+    permit.release()
+    (await waiter).release()
+    assert controller.stats()["active"] == 0
+
+
+@pytest.mark.asyncio
+async def test_times_out_waiting() -> None:
+    """Test that a request waiting longer than the timeout is rejected."""
+    controller = AdmissionController(max_concurrent=1, queue_timeout=0.01)
+    permit = await controller.acquire("a")
+    with pytest.raises(AdmissionRejected):
+        await controller.acquire("b")
+    assert controller.stats()["queued"] == 0
+    assert controller.stats()["rejected_timeout"] == 1
+    permit.release()
+
+
+@pytest.mark.asyncio
+async def test_admits_users_round_robin() -> None:
+    """Test that a user with many queued requests does not starve others."""
+    controller = AdmissionController(max_concurrent=1)
+    first = await controller.acquire("heavy")
+    order: List[str] = []
+
+    async def request(user_id: str) -> None:
+        permit = await controller.acquire(user_id)
+        order.append(user_id)
+        await asyncio.sleep(0)
+        permit.release()
+
+    tasks = [asyncio.create_task(request("heavy")) for _ in range(3)]
+    await asyncio.sleep(0)
+    tasks.append(asyncio.create_task(request("light")))
+    await asyncio.sleep(0)
+    first.release()
+    await asyncio.gather(*tasks)
+    assert order == ["heavy", "light", "heavy", "heavy"]
+
+
+@pytest.mark.asyncio
+async def test_limits_requests_per_user() -> None:
+    """Test that free slots go to other users once a user is at its limit."""
+    controller = AdmissionController(max_concurrent=2, max_per_user=1)
+    permit = await controller.acquire("a")
+    waiter = asyncio.create_task(controller.acquire("a"))
+    await asyncio.sleep(0)
+    assert controller.stats()["queued"] == 1
+    other = await controller.acquire("b")
+    assert controller.stats()["active"] == 2
+
+    permit.release()
+    other.release()
+    (await waiter).release()
+
+
+@pytest.mark.asyncio
+async def test_classes_are_dequeued_by_weight() -> None:
+    """Test that waiting classes share freed slots in proportion to weight."""
+    controller = AdmissionController(
+        max_concurrent=1, weights={INTERACTIVE: 3, BATCH: 1}
+    )
+    permit = await controller.acquire("a")
+    order: List[str] = []
+
+    async def wait(priority: str) -> None:
+        admitted = await controller.acquire("u", priority)
+        order.append(priority)
+        await asyncio.sleep(0)
+        admitted.release()
+
+    tasks = [asyncio.create_task(wait(BATCH)) for _ in range(4)]
+    tasks += [asyncio.create_task(wait(INTERACTIVE)) for _ in range(6)]
+    await asyncio.sleep(0)
+    permit.release()
+    await asyncio.gather(*tasks)
+    # 3 interactive requests for 1 batch request while both classes wait
+    assert order[:8].count(INTERACTIVE) == 6
+    assert order[:8].count(BATCH) == 2
+
+
+@pytest.mark.asyncio
+async def test_reserved_slots_are_kept_for_their_class() -> None:
+    """Test that batch requests cannot take the interactive floor."""
+    controller = AdmissionController(max_concurrent=2, reserved={INTERACTIVE: 1})
+    batch = await controller.acquire("a", BATCH)
+    waiting_batch = asyncio.create_task(controller.acquire("b", BATCH))
+    await asyncio.sleep(0)
+    assert not waiting_batch.done()
+
+    interactive = await controller.acquire("c", INTERACTIVE)
+    assert controller.stats()["classes"][INTERACTIVE]["active"] == 1
+    interactive.release()
+    batch.release()
+    (await waiting_batch).release()
+
+
+@pytest.mark.asyncio
+async def test_full_queue_evicts_lower_classes() -> None:
+    """Test that an interactive request takes the queue place of a batch one."""
+    controller = AdmissionController(max_concurrent=1, max_queue=1)
+    permit = await controller.acquire("a")
+    waiting_batch = asyncio.create_task(controller.acquire("b", BATCH))
+    await asyncio.sleep(0)
+    waiting_interactive = asyncio.create_task(controller.acquire("c"))
+    await asyncio.sleep(0)
+
+    with pytest.raises(AdmissionRejected):
+        await waiting_batch
+    assert controller.stats()["rejected_preempted"] == 1
+    # Batch requests cannot evict interactive ones
+    with pytest.raises(AdmissionRejected):
+        await controller.acquire("d", BATCH)
+
+    permit.release()
+    (await waiting_interactive).release()
+    assert controller.stats()["queued"] == 0
+
+
+@pytest.mark.asyncio
+async def test_release_when_done_releases_once() -> None:
+    """Test that the permit is released when the stream is closed early."""
+    controller = AdmissionController(max_concurrent=1)
+    permit = await controller.acquire("a")
+
+    async def stream() -> AsyncGenerator[int, None]:
+        for i in range(3):
+            yield i
+
+    wrapped = release_when_done(stream(), permit)
+    assert await wrapped.__anext__() == 0
+    await wrapped.aclose()
+    permit.release()
+    assert controller.stats()["active"] == 0
@@ -0,0 +1,77 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from typing import List
+
+from app.utils.batch import run_batch
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_results_are_yielded_as_they_complete() -> None:
+    """Test that results come back in completion order, with bounded concurrency."""
+    running: List[int] = []
+    peak = 0
+
+    async def run(delay: float) -> float:
+        nonlocal peak
+        running.append(1)
+        peak = max(peak, len(running))
+        await asyncio.sleep(delay)
+        running.pop()
+        return delay
+
+    results = [r async for r in run_batch([0.1, 0.01, 0.02, 0.0], run, 2)]
+    assert [r.index for r in results] == [1, 2, 3, 0]
+    assert [r.output for r in results] == [0.01, 0.02, 0.0, 0.1]
+    assert peak == 2
+
+
+@pytest.mark.asyncio
+async def test_failed_and_timed_out_items_do_not_fail_the_batch() -> None:
+    """Test that errors and timeouts are reported per item."""
+
+    async def run(item: str) -> str:
+        if item == "fail":
+            raise ValueError(item)
+        if item == "slow":
+            await asyncio.sleep(10)
+        return item
+
+    results = {
+        r.index: r async for r in run_batch(["ok", "fail", "slow"], run, 3, 0.05)
+    }
+    assert results[0].output == "ok"
+    assert isinstance(results[1].error, ValueError)
+    assert isinstance(results[2].error, asyncio.TimeoutError)
+
+
+@pytest.mark.asyncio
+async def test_closing_the_results_cancels_running_items() -> None:
+    """Test that items still running are cancelled when the consumer leaves."""
+    cancelled = []
+
+    async def run(item: int) -> int:
+        try:
+            await asyncio.sleep(item)
+        except asyncio.CancelledError:
+            cancelled.append(item)
+            raise
+        return item
+
+    results = run_batch([0, 10, 10], run, 3)
+    assert (await results.__anext__()).index == 0
+    await results.aclose()
+    assert cancelled == [10, 10]
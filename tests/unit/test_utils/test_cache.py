@@ -0,0 +1,86 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from app.utils.cache import ResponseCache, make_cache_key
+from langchain_core.messages import AIMessage, HumanMessage
+import pytest
+
+
+class FakeClock:
+    """A manually advanced clock."""
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_make_cache_key_ignores_ids_and_metadata() -> None:
+    """Test that volatile message fields do not change the key."""
+    first = [
+        HumanMessage(content="Hi", id="a"),
+        AIMessage(content="Hello", response_metadata={"latency": 1}),
+    ]
+    second = [HumanMessage(content="Hi", id="b"), AIMessage(content="Hello")]
+    assert make_cache_key(first, "chain") == make_cache_key(second, "chain")
+
+
+def test_make_cache_key_distinguishes_inputs() -> None:
+    """Test that content, namespace and user change the key."""
+    messages = [HumanMessage(content="Hi")]
+    key = make_cache_key(messages, "chain")
+    assert key != make_cache_key([HumanMessage(content="Hey")], "chain")
+    assert key != make_cache_key(messages, "other-chain")
+    assert key != make_cache_key(messages, "chain", user_id="user")
+
+
+def test_cache_hit_and_miss_counters() -> None:
+    """Test that lookups are counted."""
+    cache = ResponseCache(maxsize=2)
+    assert cache.get("key") is None
+    cache.put("key", [b"frame\n"])
+    assert cache.get("key") == [b"frame\n"]
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_cache_evicts_least_recently_used() -> None:
+    """Test that the least recently used entry is evicted first."""
+    cache = ResponseCache(maxsize=2)
+    cache.put("a", [b"a"])
+    cache.put("b", [b"b"])
+    cache.get("a")
+    cache.put("c", [b"c"])
+    assert cache.get("b") is None
+    assert cache.get("a") == [b"a"]
+    assert cache.evictions == 1
+
+
+def test_cache_expires_entries() -> None:
+    """Test that entries are dropped once their TTL has elapsed."""
+    clock = FakeClock()
+    cache = ResponseCache(maxsize=2, ttl=10, clock=clock)
+    cache.put("key", [b"frame"])
+    clock.now = 9
+    assert cache.get("key") == [b"frame"]
+    clock.now = 10
+    assert cache.get("key") is None
+    assert len(cache) == 0
+
+
+def test_cache_rejects_non_positive_size() -> None:
+    """Test that a cache must be able to hold at least one entry."""
+    with pytest.raises(ValueError):
+        ResponseCache(maxsize=0)
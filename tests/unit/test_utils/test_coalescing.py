@@ -0,0 +1,124 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from typing import Any, AsyncGenerator, Dict, List
+
+from app.utils.coalescing import coalesce_chunk_events, merge_chunk_events
+from langchain_core.messages import AIMessageChunk
+import pytest
+
+
+def chunk_event(content: str, run_id: str = "run") -> Dict[str, Any]:
+    """Build an on_chat_model_stream event."""
+    return {
+        "event": "on_chat_model_stream",
+        "run_id": run_id,
+        "data": {"chunk": AIMessageChunk(content=content)},
+    }
+
+
+async def stream(
+    events: List[Dict[str, Any]], delay: float = 0.0
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """Yield the events, sleeping before each one."""
+    for event in events:
+        await asyncio.sleep(delay)
+        yield event
+
+
+async def collect(events: AsyncGenerator[Dict[str, Any], None]) -> List[Any]:
+    """Consume a stream of events."""
+    return [event async for event in events]
+
+
+def contents(events: List[Dict[str, Any]]) -> List[Any]:
+    """Return the chunk content of each event, or its type."""
+    return [
+        (
+            event["data"]["chunk"].content
+            if event["event"] == "on_chat_model_stream"
+            else event["event"]
+        )
+        for event in events
+    ]
+
+
+def test_merge_chunk_events() -> None:
+    """Test that message chunks and dumped chunks are merged."""
+    merged = merge_chunk_events(chunk_event("Hel"), chunk_event("lo"))
+    assert merged is not None
+    assert merged["data"]["chunk"].content == "Hello"
+
+    dumped = {
+        "event": "on_chat_model_stream",
+        "data": {"chunk": {"content": "a", "additional_kwargs": {"x": 1}}},
+    }
+    merged = merge_chunk_events(dumped, dumped)
+    assert merged is not None
+    assert merged["data"]["chunk"]["content"] == "aa"
+    assert merged["data"]["chunk"]["additional_kwargs"] == {"x": 1}
+
+
+def test_merge_chunk_events_rejects_other_runs() -> None:
+    """Test that chunks of different model runs are not merged."""
+    assert merge_chunk_events(chunk_event("a"), chunk_event("b", "other")) is None
+
+
+@pytest.mark.asyncio
+async def test_coalesce_merges_consecutive_chunks() -> None:
+    """Test that chunks are merged up to the size limit."""
+    events = [chunk_event(c) for c in "abcde"]
+    result = await collect(
+        coalesce_chunk_events(stream(events), max_delay=10, max_chunks=2)
+    )
+    assert contents(result) == ["ab", "cd", "e"]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_flushes_before_other_events() -> None:
+    """Test that tool events flush the pending frame and keep their order."""
+    tool_event = {"event": "on_tool_start", "data": {"input": {}}}
+    events = [chunk_event("a"), chunk_event("b"), tool_event, chunk_event("c")]
+    result = await collect(coalesce_chunk_events(stream(events), max_delay=10))
+    assert contents(result) == ["ab", "on_tool_start", "c"]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_flushes_after_max_delay() -> None:
+    """Test that a slow upstream does not hold back buffered chunks."""
+    events = [chunk_event("a"), chunk_event("b")]
+    frames = coalesce_chunk_events(stream(events, delay=0.2), max_delay=0.01)
+    first = await asyncio.wait_for(frames.__anext__(), timeout=0.35)
+    assert first["data"]["chunk"].content == "a"
+    assert contents(await collect(frames)) == ["b"]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_closes_upstream() -> None:
+    """Test that closing the coalesced stream closes the upstream iterator."""
+    closed = asyncio.Event()
+
+    async def upstream() -> AsyncGenerator[Dict[str, Any], None]:
+        try:
+            while True:
+                yield chunk_event("a")
+                await asyncio.sleep(1)
+        finally:
+            closed.set()
+
+    frames = coalesce_chunk_events(upstream(), max_delay=0.01)
+    await frames.__anext__()
+    await frames.aclose()
+    assert closed.is_set()
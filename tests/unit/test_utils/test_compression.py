@@ -0,0 +1,57 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import AsyncGenerator, List, Optional
+import zlib
+
+from app.utils.compression import WBITS, compress_stream, negotiate_encoding
+import pytest
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, expected",
+    [
+        (None, None),
+        ("identity", None),
+        ("gzip, deflate, br", "gzip"),
+        ("deflate", "deflate"),
+        ("gzip;q=0.5, deflate", "deflate"),
+        ("gzip;q=0, deflate;q=0", None),
+        ("*", "gzip"),
+        ("*;q=1, gzip;q=0", "deflate"),
+    ],
+)
+def test_negotiate_encoding(
+    accept_encoding: Optional[str], expected: Optional[str]
+) -> None:
+    """Test the choice of the content coding from Accept-Encoding."""
+    assert negotiate_encoding(accept_encoding) == expected
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("encoding", ["gzip", "deflate"])
+async def test_every_frame_is_decodable_when_received(encoding: str) -> None:
+    """Test that each compressed chunk decodes to its whole frame."""
+    frames = [b'{"event": "on_chat_model_stream", "data": %d}\n' % i for i in range(5)]
+
+    async def stream() -> AsyncGenerator[bytes, None]:
+        for frame in frames:
+            yield frame
+
+    decompressor = zlib.decompressobj(WBITS[encoding])
+    received: List[bytes] = []
+    async for chunk in compress_stream(stream(), encoding):
+        received.append(decompressor.decompress(chunk))
+    assert received == [*frames, b""]
+    assert decompressor.eof
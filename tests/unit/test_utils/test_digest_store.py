@@ -0,0 +1,149 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pathlib import Path
+import threading
+import time
+from typing import Dict, List
+
+from app.utils.digest_store import DigestStore
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.runnables import RunnableLambda
+import pytest
+
+
+class Summarizer:
+    """Appends the conversation to the summary and records its inputs."""
+
+    def __init__(self, delay: float = 0.0) -> None:
+        self.inputs: List[Dict[str, str]] = []
+        self.delay = delay
+
+    def __call__(self, inputs: Dict[str, str]) -> AIMessage:
+        self.inputs.append(inputs)
+        time.sleep(self.delay)
+        return AIMessage(content=f"{inputs['summary']}|{inputs['conversation']}")
+
+
+def turns(*texts: str) -> List[BaseMessage]:
+    """Build a conversation alternating user messages and answers."""
+    return [
+        message
+        for text in texts
+        for message in (HumanMessage(content=text), AIMessage(content="ok"))
+    ]
+
+
+def make_store(path: Path, summarizer: Summarizer, **kwargs: int) -> DigestStore:
+    """Build a store in a temporary directory."""
+    return DigestStore(
+        str(path / "digests.sqlite"), RunnableLambda(summarizer), **kwargs
+    )
+
+
+def test_only_new_messages_are_summarized(tmp_path: Path) -> None:
+    """Test that each update folds the turns added since the last digest."""
+    summarizer = Summarizer()
+    store = make_store(tmp_path, summarizer)
+    store.record("user", "s1", turns("I like hiking."))
+    assert store.flush(timeout=5)
+    store.record("user", "s1", turns("I like hiking.", "And my dog."))
+    assert store.flush(timeout=5)
+
+    assert [i["conversation"] for i in summarizer.inputs] == [
+        "Human: I like hiking.\nAI: ok",
+        "Human: And my dog.\nAI: ok",
+    ]
+    digest = store.get("user", "s1")
+    assert digest is not None
+    assert digest.messages == 4
+    assert digest.summary == "|Human: I like hiking.\nAI: ok|Human: And my dog.\nAI: ok"
+
+
+def test_tool_traffic_is_left_out(tmp_path: Path) -> None:
+    """Test that tool calls and results do not reach the summarizer."""
+    summarizer = Summarizer()
+    store = make_store(tmp_path, summarizer)
+    call = AIMessage(
+        content="", tool_calls=[{"name": "search", "args": {}, "id": "call"}]
+    )
+    result = ToolMessage(content="A large document.", tool_call_id="call")
+    store.record(
+        "user", "s1", [HumanMessage(content="Hi"), call, result, AIMessage("Hello")]
+    )
+    assert store.flush(timeout=5)
+    assert summarizer.inputs[0]["conversation"] == "Human: Hi\nAI: Hello"
+
+
+def test_updates_queued_meanwhile_are_merged(tmp_path: Path) -> None:
+    """Test that turns recorded while the summarizer runs cost one more call."""
+    summarizer = Summarizer(delay=0.2)
+    store = make_store(tmp_path, summarizer)
+    started = time.perf_counter()
+    store.record("user", "s1", turns("one"))
+    time.sleep(0.05)
+    for i in range(2, 6):
+        store.record("user", "s1", turns(*[str(n) for n in range(1, i + 1)]))
+    # Recording never waits for the summarizer
+    assert time.perf_counter() - started < 0.15
+    assert store.flush(timeout=5)
+    assert len(summarizer.inputs) == 2
+    assert store.merged == 3
+    assert store.get("user", "s1").messages == 10
+
+
+def test_recent_ranks_sessions_and_keeps_the_latest(tmp_path: Path) -> None:
+    """Test that digests are ranked by the query among the kept sessions."""
+    store = make_store(tmp_path, Summarizer(), max_sessions=3)
+    for session, text in enumerate(
+        ["work stress deadlines", "sailing with my father", "learning guitar", "sleep"]
+    ):
+        store.record("user", f"s{session}", turns(text))
+        assert store.flush(timeout=5)
+    store.record("other", "s9", turns("sailing regatta"))
+    assert store.flush(timeout=5)
+
+    # The oldest session was dropped, the newest come first by default
+    assert [d.session_id for d in store.recent("user", k=5)] == ["s3", "s2", "s1"]
+    assert store.recent("user", "sailing", k=1)[0].session_id == "s1"
+    assert [d.session_id for d in store.recent("user", "sailing", exclude="s1")] == [
+        "s3",
+        "s2",
+    ]
+    assert store.recent("nobody") == []
+
+
+def test_failed_updates_are_logged_and_skipped(tmp_path: Path) -> None:
+    """Test that a summarizer error does not stop the background thread."""
+    calls = threading.Event()
+
+    def summarize(inputs: Dict[str, str]) -> str:
+        if not calls.is_set():
+            calls.set()
+            raise RuntimeError("model unavailable")
+        return "summary"
+
+    store = DigestStore(str(tmp_path / "digests.sqlite"), RunnableLambda(summarize))
+    store.record("user", "s1", turns("first"))
+    assert store.flush(timeout=5)
+    store.record("user", "s1", turns("first", "second"))
+    assert store.flush(timeout=5)
+    assert store.failures == 1
+    assert store.get("user", "s1").summary == "summary"
+
+
+def test_max_sessions_must_be_positive(tmp_path: Path) -> None:
+    """Test that a store keeps at least one session per user."""
+    with pytest.raises(ValueError):
+        make_store(tmp_path, Summarizer(), max_sessions=0)
@@ -0,0 +1,182 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pathlib import Path
+import threading
+import time
+from typing import List
+
+from app.utils import doc_index
+from app.utils.doc_index import DocIndex, DocIndexRegistry, HashingEmbeddings
+import numpy as np
+import pytest
+
+DOCS = {
+    "journal": [
+        "I started running every morning to clear my head before work.",
+        "My sister visited and we talked about our childhood in Lisbon.",
+    ],
+    "goals": [
+        "This year I want to finish the novel I have been drafting.",
+        "Learning Portuguese again would let me talk with my grandmother.",
+    ],
+}
+
+
+def build_index(path: Path) -> DocIndex:
+    """Build an index holding the test documents."""
+    index = DocIndex(str(path))
+    for doc_id, chunks in DOCS.items():
+        index.add(doc_id, chunks)
+    return index
+
+
+def test_hashing_embeddings_are_normalized_and_stable() -> None:
+    """Test that embeddings have unit norm and do not depend on the process."""
+    embeddings = HashingEmbeddings(dim=64)
+    vectors = embeddings.embed(["running in the morning", ""])
+    assert vectors.shape == (2, 64)
+    assert np.isclose(np.linalg.norm(vectors[0]), 1.0)
+    assert not vectors[1].any()
+    assert embeddings.embed_query("running in the morning") == pytest.approx(
+        vectors[0].tolist()
+    )
+
+
+def test_search_ranks_matching_chunks_first(tmp_path: Path) -> None:
+    """Test that the chunk sharing the query terms comes first."""
+    index = build_index(tmp_path)
+    results = index.search("running in the morning", k=2)
+    assert results[0].doc_id == "journal"
+    assert results[0].text.startswith("I started running")
+    assert len(results) == 2
+    assert results[0].score >= results[1].score
+    assert index.search("novel", k=1)[0].doc_id == "goals"
+
+
+def test_add_replaces_and_delete_removes_documents(tmp_path: Path) -> None:
+    """Test that documents can be updated and deleted incrementally."""
+    index = build_index(tmp_path)
+    index.add("goals", ["Run a marathon in under four hours."])
+    assert len(index) == 3
+    assert [r.text for r in index.search("novel", k=5) if r.doc_id == "goals"] == [
+        "Run a marathon in under four hours."
+    ]
+    assert index.delete("journal")
+    assert not index.delete("journal")
+    assert {r.doc_id for r in index.search("running sister Lisbon", k=5)} == {"goals"}
+    assert sorted(index.doc_ids()) == ["goals"]
+
+
+def test_index_persists_and_compacts(tmp_path: Path) -> None:
+    """Test that a reopened index finds the same chunks, also once compacted."""
+    index = build_index(tmp_path)
+    index.delete("journal")
+    index.compact()
+    reopened = DocIndex(str(tmp_path))
+    assert len(reopened) == 2
+    assert (tmp_path / "vectors.f32").stat().st_size == 2 * 128 * 4
+    assert reopened.search("grandmother", k=1)[0].text.startswith("Learning")
+    reopened.add("journal", DOCS["journal"])
+    assert reopened.search("sister", k=1)[0].doc_id == "journal"
+
+
+def test_writes_of_other_instances_are_seen(tmp_path: Path) -> None:
+    """Test that an index reloads after another process wrote to it."""
+    reader = DocIndex(str(tmp_path))
+    assert reader.search("running") == []
+    build_index(tmp_path)
+    assert reader.search("running", k=1)[0].doc_id == "journal"
+
+
+def test_writes_of_other_instances_are_applied_incrementally(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that a refresh only tokenizes the chunks added by other processes."""
+    reader = build_index(tmp_path)
+    writer = DocIndex(str(tmp_path))
+    tokenized: List[str] = []
+    monkeypatch.setattr(
+        doc_index, "tokenize", lambda text: tokenized.append(text) or text.split()
+    )
+    writer.add("journal", ["Sailing with my father on the lake."])
+    writer.add("dreams", ["Sailing around the world one day."])
+    tokenized.clear()
+    assert sorted(reader.doc_ids()) == ["dreams", "goals", "journal"]
+    assert tokenized == [
+        "Sailing with my father on the lake.",
+        "Sailing around the world one day.",
+    ]
+    assert len(reader) == 4
+    assert {r.doc_id for r in reader.search("Sailing", k=2)} == {"journal", "dreams"}
+
+    writer.delete("dreams")
+    writer.compact()
+    assert sorted(reader.doc_ids()) == ["goals", "journal"]
+    assert reader.search("Sailing", k=1)[0].text.startswith("Sailing with")
+
+
+def test_failed_add_leaves_the_index_unchanged(tmp_path: Path) -> None:
+    """Test that an add with embeddings of another dimension is rolled back."""
+    build_index(tmp_path)
+    index = DocIndex(str(tmp_path), embeddings=HashingEmbeddings(dim=32))
+    with pytest.raises(ValueError):
+        index.add("journal", ["Something else entirely."])
+    assert len(index) == 4
+    assert sorted(index.doc_ids()) == ["goals", "journal"]
+
+
+def test_registry_keeps_one_index_per_user(tmp_path: Path) -> None:
+    """Test that users get separate indexes in hashed directories."""
+    registry = DocIndexRegistry(str(tmp_path), max_open=1)
+    registry.get("alice/../bob").add("notes", ["Alice likes climbing."])
+    assert registry.get("bob").search("climbing") == []
+    assert registry.get("alice/../bob").search("climbing")[0].doc_id == "notes"
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_registry_loads_indexes_outside_of_its_lock(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that a slow index load only delays the calls of its user."""
+    registry = DocIndexRegistry(str(tmp_path))
+    registry.get("alice").add("notes", ["Alice likes climbing."])
+    registry = DocIndexRegistry(str(tmp_path))
+    loading, release = threading.Event(), threading.Event()
+    load = DocIndex._load
+
+    def slow_load(index: DocIndex) -> None:
+        if index.directory == registry.directory_of("alice"):
+            loading.set()
+            release.wait(5)
+        load(index)
+
+    monkeypatch.setattr(DocIndex, "_load", slow_load)
+    results = []
+    loaders = [
+        threading.Thread(target=lambda: results.append(registry.get("alice")))
+        for _ in range(2)
+    ]
+    for loader in loaders:
+        loader.start()
+    assert loading.wait(5)
+    # Another user is served while the index of alice is loading
+    started = time.perf_counter()
+    assert registry.get("bob").search("climbing") == []
+    assert time.perf_counter() - started < 2
+    release.set()
+    for loader in loaders:
+        loader.join(5)
+    assert results[0] is results[1]
+    assert results[0].search("climbing")[0].doc_id == "notes"
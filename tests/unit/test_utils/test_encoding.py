@@ -0,0 +1,84 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+from app.utils.encoding import END_FRAME, encode_event, encode_metadata
+from app.utils.input_types import default_serialization
+from app.utils.output_types import OnToolEndEvent
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessageChunk, ToolMessage
+
+
+def test_encode_event_matches_default_serialization() -> None:
+    """Test that the fast encoder produces the same payload as json.dumps."""
+    event = {
+        "event": "on_chat_model_stream",
+        "name": "ChatVertexAI",
+        "run_id": "run",
+        "data": {
+            "chunk": AIMessageChunk(
+                content="Hello",
+                usage_metadata={
+                    "input_tokens": 1,
+                    "output_tokens": 2,
+                    "total_tokens": 3,
+                },
+            )
+        },
+    }
+    encoded = encode_event(event)
+    assert encoded.endswith(b"\n")
+    assert encoded.count(b"\n") == 1
+    assert json.loads(encoded) == json.loads(
+        json.dumps(event, default=default_serialization)
+    )
+
+
+def test_encode_event_nested_models() -> None:
+    """Test that models nested in models and lists are converted."""
+    event = {
+        "event": "on_tool_end",
+        "data": {
+            "input": {"query": "q"},
+            "output": ToolMessage(
+                content="result",
+                tool_call_id="call",
+                artifact=[Document(page_content="doc")],
+            ),
+        },
+    }
+    decoded = json.loads(encode_event(event))
+    assert decoded["data"]["output"]["tool_call_id"] == "call"
+    assert decoded["data"]["output"]["artifact"][0]["page_content"] == "doc"
+
+
+def test_encode_event_includes_extra_fields() -> None:
+    """Test that extra fields of custom chain events are kept."""
+    event = OnToolEndEvent(
+        data={"input": {}, "output": ToolMessage(content="c", tool_call_id="t")},
+        custom_field="value",
+    )
+    decoded = json.loads(encode_event(event))
+    assert decoded["custom_field"] == "value"
+    assert decoded == json.loads(json.dumps(event, default=default_serialization))
+
+
+def test_encode_metadata_and_end() -> None:
+    """Test the frames opening and closing every stream."""
+    assert json.loads(encode_metadata("run")) == {
+        "event": "metadata",
+        "data": {"run_id": "run"},
+    }
+    assert json.loads(END_FRAME) == {"event": "end"}
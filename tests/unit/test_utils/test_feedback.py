@@ -0,0 +1,221 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+from pathlib import Path
+import time
+from typing import Any, Dict, List
+from unittest.mock import MagicMock
+
+from app.utils.feedback import (
+    CloudLoggingFeedbackBackend,
+    FeedbackSink,
+    LocalFileFeedbackBackend,
+)
+import pytest
+
+
+class FlakyBackend:
+    """A backend failing until it is repaired."""
+
+    def __init__(self) -> None:
+        self.broken = True
+        self.batches: List[List[Dict[str, Any]]] = []
+
+    def write_batch(self, entries: List[Dict[str, Any]]) -> None:
+        if self.broken:
+            raise ConnectionError("backend unavailable")
+        self.batches.append(entries)
+
+
+def read_jsonl(path: Path) -> List[Dict[str, Any]]:
+    """Read the entries of a JSONL file."""
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+@pytest.mark.asyncio
+async def test_sink_writes_batches_in_background(tmp_path: Path) -> None:
+    """Test that a full batch is written without waiting for the interval."""
+    output = tmp_path / "feedback.jsonl"
+    sink = FeedbackSink(
+        LocalFileFeedbackBackend(str(output)),
+        spill_path=str(tmp_path / "spill.jsonl"),
+        batch_size=2,
+        flush_interval=60,
+    )
+    sink.start()
+    sink.submit({"score": 1})
+    sink.submit({"score": 2})
+    for _ in range(100):
+        if sink.written == 2:
+            break
+        await asyncio.sleep(0.01)
+    assert read_jsonl(output) == [{"score": 1}, {"score": 2}]
+    await sink.stop()
+
+
+@pytest.mark.asyncio
+async def test_sink_flushes_on_stop(tmp_path: Path) -> None:
+    """Test that queued entries are written on shutdown."""
+    output = tmp_path / "feedback.jsonl"
+    sink = FeedbackSink(
+        LocalFileFeedbackBackend(str(output)),
+        spill_path=str(tmp_path / "spill.jsonl"),
+        flush_interval=60,
+    )
+    sink.submit({"score": 1})
+    assert sink.queue_depth == 1
+    await sink.stop()
+    assert read_jsonl(output) == [{"score": 1}]
+    assert sink.queue_depth == 0
+
+
+@pytest.mark.asyncio
+async def test_sink_spills_overflow_to_disk(tmp_path: Path) -> None:
+    """Test that entries beyond the queue capacity are spilled, then replayed."""
+    output = tmp_path / "feedback.jsonl"
+    spill = tmp_path / "spill.jsonl"
+    sink = FeedbackSink(
+        LocalFileFeedbackBackend(str(output)),
+        spill_path=str(spill),
+        max_queue_size=1,
+        flush_interval=60,
+    )
+    sink.submit({"score": 1})
+    sink.submit({"score": 2})
+    sink.submit({"score": 3})
+    # The spill file is written from a worker thread
+    assert not spill.exists()
+    for _ in range(100):
+        if sink.spilled == 2:
+            break
+        await asyncio.sleep(0.01)
+    assert read_jsonl(spill) == [{"score": 2}, {"score": 3}]
+    await sink.stop()
+    assert read_jsonl(output) == [{"score": 1}, {"score": 2}, {"score": 3}]
+    assert not spill.exists()
+
+
+@pytest.mark.asyncio
+async def test_sink_spills_failed_batches(tmp_path: Path) -> None:
+    """Test that a failed write keeps the entries on disk for a later flush."""
+    backend = FlakyBackend()
+    spill = tmp_path / "spill.jsonl"
+    sink = FeedbackSink(backend, spill_path=str(spill), flush_interval=60)
+    sink.submit({"score": 1})
+    await sink.stop()
+    assert read_jsonl(spill) == [{"score": 1}]
+    assert sink.failed_batches >= 1
+
+    backend.broken = False
+    await sink.flush()
+    assert backend.batches == [[{"score": 1}]]
+    assert not spill.exists()
+
+
+@pytest.mark.asyncio
+async def test_failed_replays_back_off(tmp_path: Path) -> None:
+    """Test that the spill file is left as is and replayed less and less often."""
+    backend = FlakyBackend()
+    spill = tmp_path / "spill.jsonl"
+    sink = FeedbackSink(
+        backend, spill_path=str(spill), batch_size=2, flush_interval=0.01
+    )
+    sink._spill([{"score": n} for n in range(3)])
+    content = spill.read_text()
+    sink.start()
+    await asyncio.sleep(0.5)
+    # Every 10 ms, a replay would have failed 50 times
+    assert 1 <= sink.failed_batches <= 8
+    assert sink.spilled == 3
+    assert spill.read_text() == content
+
+    backend.broken = False
+    await sink.stop()
+    assert backend.batches == [[{"score": 0}, {"score": 1}], [{"score": 2}]]
+    assert not spill.exists()
+
+
+def test_replay_quarantines_corrupt_lines(tmp_path: Path) -> None:
+    """Test that lines which are not JSON are moved aside instead of blocking."""
+    backend = FlakyBackend()
+    backend.broken = False
+    spill = tmp_path / "spill.jsonl"
+    spill.write_text('{"score": 1}\n{"score": \n\n{"score": 2}\n{"sco')
+    sink = FeedbackSink(backend, spill_path=str(spill))
+    assert sink._replay_spill()
+    assert backend.batches == [[{"score": 1}, {"score": 2}]]
+    assert (tmp_path / "spill.jsonl.corrupt").read_text().splitlines() == [
+        '{"score": ',
+        '{"sco',
+    ]
+    assert sink.stats()["corrupt"] == 2
+    assert not spill.exists()
+
+
+def test_partial_replay_keeps_the_remaining_entries(tmp_path: Path) -> None:
+    """Test that only the entries which were not written are kept on disk."""
+
+    class FailingOnSecondBatch(FlakyBackend):
+        def write_batch(self, entries: List[Dict[str, Any]]) -> None:
+            self.broken = bool(self.batches)
+            super().write_batch(entries)
+
+    backend = FailingOnSecondBatch()
+    spill = tmp_path / "spill.jsonl"
+    sink = FeedbackSink(backend, spill_path=str(spill), batch_size=2)
+    sink._spill([{"score": n} for n in range(5)])
+    assert not sink._replay_spill()
+    assert read_jsonl(spill) == [{"score": n} for n in range(2, 5)]
+    assert sink.spilled == 5
+
+
+def test_workers_sharing_a_spill_file_replay_each_entry_once(
+    tmp_path: Path,
+) -> None:
+    """Test that concurrent spills and replays of server processes do not race."""
+
+    class SlowBackend(FlakyBackend):
+        def write_batch(self, entries: List[Dict[str, Any]]) -> None:
+            time.sleep(0.01)
+            super().write_batch(entries)
+
+    spill = tmp_path / "spill.jsonl"
+    backends = [SlowBackend() for _ in range(4)]
+    sinks = [FeedbackSink(b, spill_path=str(spill), batch_size=2) for b in backends]
+
+    def spill_and_replay(i: int) -> None:
+        backends[i].broken = False
+        sinks[i]._spill([{"score": 10 * i + n} for n in range(10)])
+        sinks[i]._replay_spill()
+
+    with ThreadPoolExecutor(len(sinks)) as pool:
+        # Raises if a replay lost its file to another one
+        list(pool.map(spill_and_replay, range(len(sinks))))
+
+    written = [e["score"] for b in backends for batch in b.batches for e in batch]
+    assert sorted(written) == list(range(40))
+    assert not spill.exists()
+
+
+def test_cloud_logging_backend_batches_entries() -> None:
+    """Test that a batch is committed as a single Cloud Logging batch."""
+    logger = MagicMock()
+    backend = CloudLoggingFeedbackBackend(lambda: logger)
+    backend.write_batch([{"score": 1}, {"score": 2}])
+    batch = logger.batch.return_value.__enter__.return_value
+    assert batch.log_struct.call_count == 2
+    logger.log_struct.assert_not_called()
@@ -0,0 +1,135 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Any, Dict, List
+
+from app.utils.history import SUMMARY_PREFIX, HistoryManager, estimate_tokens
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    HumanMessage,
+    SystemMessage,
+    ToolMessage,
+)
+from langchain_core.runnables import RunnableLambda
+import pytest
+
+
+def conversation(turns: int) -> List[BaseMessage]:
+    """Build a conversation of turns of about 30 tokens each."""
+    messages: List[BaseMessage] = []
+    for i in range(turns):
+        messages.append(HumanMessage(content=f"Question {i}: " + "word " * 10))
+        messages.append(AIMessage(content=f"Answer {i}: " + "word " * 10))
+    return messages
+
+
+def recording_summarizer(calls: List[Dict[str, Any]]) -> RunnableLambda:
+    """A summarizer recording its inputs and counting the lines it folded."""
+
+    def summarize(inputs: Dict[str, Any]) -> str:
+        calls.append(inputs)
+        return f"{inputs['summary']}+{len(inputs['conversation'].splitlines())}"
+
+    return RunnableLambda(summarize)
+
+
+def test_estimate_tokens_counts_content_and_tool_calls() -> None:
+    """Test that the estimate grows with the content and tool calls."""
+    short = estimate_tokens(HumanMessage(content="a" * 40))
+    assert short == 10 + 4
+    call = AIMessage(
+        content="",
+        tool_calls=[{"name": "search", "args": {"query": "x" * 40}, "id": "1"}],
+    )
+    assert estimate_tokens(call) > 10
+
+
+def test_short_conversations_are_sent_whole() -> None:
+    """Test that nothing is summarized while the history fits the budget."""
+    calls: List[Dict[str, Any]] = []
+    manager = HistoryManager(recording_summarizer(calls), max_tokens=1000)
+    messages = conversation(3)
+    window, memory = manager.window(messages, {})
+    assert window == messages
+    assert memory == {"summary": None, "summarized": 0}
+    assert not calls
+
+
+def test_older_turns_are_folded_in_batches() -> None:
+    """Test that the window stays bounded and the summary is updated in batches."""
+    calls: List[Dict[str, Any]] = []
+    manager = HistoryManager(
+        recording_summarizer(calls), max_tokens=100, fold_tokens=60
+    )
+    memory: Dict[str, Any] = {}
+    sizes = []
+    for turns in range(1, 30):
+        window, memory = manager.window(conversation(turns), memory)
+        sizes.append(sum(estimate_tokens(m) for m in window))
+        if memory["summary"]:
+            assert isinstance(window[0], SystemMessage)
+            assert window[0].content == SUMMARY_PREFIX + memory["summary"]
+            assert isinstance(window[1], HumanMessage)
+    # Each summary call folds at least `fold_tokens` into the previous summary
+    assert 0 < len(calls) < 15
+    assert calls[0]["summary"] == ""
+    assert all(call["summary"] for call in calls[1:])
+    assert max(sizes[10:]) <= 100 + 60 + 20
+
+
+def test_summaries_are_resumed_on_the_next_turn() -> None:
+    """Test that a new run reuses the summary cached by an earlier one."""
+    calls: List[Dict[str, Any]] = []
+    manager = HistoryManager(
+        recording_summarizer(calls), max_tokens=100, fold_tokens=60
+    )
+    _, memory = manager.window(conversation(10), {})
+    assert len(calls) == 1
+
+    # A new run of the next turn starts with an empty memory
+    window, next_memory = manager.window(conversation(11), {})
+    assert len(calls) == 1
+    assert next_memory == memory
+    assert window[0].content == SUMMARY_PREFIX + memory["summary"]
+
+
+def test_window_never_separates_tool_results_from_their_call() -> None:
+    """Test that the window starts on a human message."""
+    manager = HistoryManager(RunnableLambda(lambda _: "summary"), max_tokens=60)
+    messages = conversation(2) + [
+        HumanMessage(content="Look it up"),
+        AIMessage(
+            content="", tool_calls=[{"name": "search", "args": {}, "id": "call"}]
+        ),
+        ToolMessage(content="result " * 30, tool_call_id="call"),
+    ]
+    # The current turn is over budget, and is still sent whole
+    assert manager.window_start(messages) == 4
+
+
+@pytest.mark.asyncio
+async def test_awindow_matches_window() -> None:
+    """Test that the async window folds the same way as the sync one."""
+    calls: List[Dict[str, Any]] = []
+    sync_manager = HistoryManager(
+        recording_summarizer(calls), max_tokens=100, fold_tokens=60
+    )
+    async_manager = HistoryManager(
+        recording_summarizer(calls), max_tokens=100, fold_tokens=60
+    )
+    messages = conversation(12)
+    assert await async_manager.awindow(messages, {}) == sync_manager.window(
+        messages, {}
+    )
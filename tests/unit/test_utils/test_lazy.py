@@ -0,0 +1,70 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pathlib import Path
+from unittest.mock import patch
+
+from app.utils.lazy import LazyChain
+from app.utils.output_types import EndEvent
+import pytest
+
+
+def test_lazy_chain_defers_import() -> None:
+    """Test that the module is imported on first use only."""
+    with patch("importlib.import_module") as mock_import:
+        lazy_chain = LazyChain("some.module")
+        assert not lazy_chain.loaded
+        mock_import.assert_not_called()
+
+        lazy_chain.invoke({"messages": []})
+        mock_import.assert_called_once_with("some.module")
+        mock_import.return_value.chain.invoke.assert_called_once_with({"messages": []})
+
+        lazy_chain.invoke({"messages": []})
+        mock_import.assert_called_once()
+    assert lazy_chain.loaded
+    assert lazy_chain.load_seconds is not None
+
+
+def test_lazy_chain_attribute() -> None:
+    """Test that the attribute after the colon is loaded."""
+    lazy_chain = LazyChain("app.utils.output_types:EndEvent")
+    assert lazy_chain.load() is EndEvent
+
+
+def test_lazy_chain_retries_failed_import() -> None:
+    """Test that a failed import is not cached."""
+    lazy_chain = LazyChain("app.utils.output_types:EndEvent")
+    with patch("importlib.import_module", side_effect=ImportError):
+        with pytest.raises(ImportError):
+            lazy_chain.load()
+    assert not lazy_chain.loaded
+    assert lazy_chain.load() is EndEvent
+
+
+def test_source_digest_follows_the_chain_sources(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that the digest changes with the chain package, without import."""
+    package = tmp_path / "digest_pattern"
+    package.mkdir()
+    (package / "__init__.py").write_text("")
+    (package / "chain.py").write_text('raise RuntimeError("imported")\nLLM = "a"\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    lazy_chain = LazyChain("digest_pattern.chain")
+    digest = lazy_chain.source_digest()
+    assert lazy_chain.source_digest() == digest
+    (package / "prompts.py").write_text('PROMPT = "Be brief."\n')
+    assert lazy_chain.source_digest() != digest
+    assert not lazy_chain.loaded
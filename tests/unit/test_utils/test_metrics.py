@@ -0,0 +1,93 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from typing import Any, AsyncGenerator, Dict, List
+
+from app.utils.metrics import Counter, Gauge, Histogram, Registry, StreamMetrics
+from langchain_core.messages import AIMessageChunk
+import pytest
+
+
+def test_histogram_renders_cumulative_buckets() -> None:
+    """Test that bucket counts are cumulative and end with +Inf."""
+    histogram = Histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 5.0):
+        histogram.observe(value)
+    assert histogram.render().splitlines()[2:] == [
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        "latency_seconds_sum 6.25",
+        "latency_seconds_count 4",
+    ]
+
+
+def test_registry_renders_all_metrics() -> None:
+    """Test the text exposition of counters and gauges."""
+    registry = Registry()
+    counter = registry.register(Counter("events_total", "Events.", "event"))
+    registry.register(Gauge("queue_depth", "Depth.", function=lambda: 3))
+    counter.inc(label_value="start")
+    counter.inc(2, label_value="end")
+    assert registry.render() == (
+        "# HELP events_total Events.\n"
+        "# TYPE events_total counter\n"
+        'events_total{event="end"} 2\n'
+        'events_total{event="start"} 1\n'
+        "# HELP queue_depth Depth.\n"
+        "# TYPE queue_depth gauge\n"
+        "queue_depth 3\n"
+    )
+    with pytest.raises(ValueError):
+        registry.register(Gauge("queue_depth", "Depth."))
+
+
+@pytest.mark.asyncio
+async def test_stream_metrics_track_model_chunks() -> None:
+    """Test that chunk timings and event types are recorded."""
+    metrics = StreamMetrics(Registry())
+    events: List[Dict[str, Any]] = [
+        {"event": "on_tool_start", "data": {}},
+        {
+            "event": "on_chat_model_stream",
+            "run_id": "first",
+            "data": {"chunk": AIMessageChunk("a")},
+        },
+        {
+            "event": "on_chat_model_stream",
+            "run_id": "first",
+            "data": {"chunk": AIMessageChunk("b")},
+        },
+        {
+            "event": "on_chat_model_stream",
+            "run_id": "second",
+            "data": {"chunk": AIMessageChunk("c")},
+        },
+    ]
+
+    async def upstream() -> AsyncGenerator[Dict[str, Any], None]:
+        for event in events:
+            yield event
+
+    started_at = time.perf_counter()
+    stream = metrics.measure(metrics.track(upstream(), started_at), started_at)
+    assert [event async for event in stream] == events
+    assert metrics.time_to_first_token.count == 1
+    assert metrics.inter_token_gap.count == 2
+    assert metrics.stream_duration.count == 1
+    assert metrics.events.values == {"on_tool_start": 1, "on_chat_model_stream": 3}
+    assert metrics.model_calls.sum == 2
+    assert metrics.tool_calls.sum == 1
+    assert metrics.active_streams.value == 0
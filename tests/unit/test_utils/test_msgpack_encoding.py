@@ -0,0 +1,94 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Any, Dict, List, Optional
+
+from app.utils.msgpack_encoding import MSGPACK, accepts_msgpack, slim_event
+from langchain_core.messages import AIMessageChunk, ToolMessage
+import pytest
+
+if MSGPACK is None:
+    pytest.skip("no MessagePack packer installed", allow_module_level=True)
+
+try:
+    from ormsgpack import unpackb
+except ImportError:
+    from msgpack import unpackb
+
+
+def decode_frames(body: bytes) -> List[Dict[str, Any]]:
+    """Decode a body of length-prefixed MessagePack frames."""
+    events = []
+    while body:
+        end = 4 + int.from_bytes(body[:4], "big")
+        events.append(unpackb(body[4:end]))
+        body = body[end:]
+    return events
+
+
+def test_chunk_events_keep_the_fields_read_by_the_ui() -> None:
+    """Test that model chunks are reduced to their content."""
+    event = {
+        "event": "on_chat_model_stream",
+        "run_id": "run",
+        "metadata": {"langgraph_node": "agent"},
+        "data": {
+            "chunk": AIMessageChunk(
+                content="Hello", id="run-1", response_metadata={"safety": []}
+            )
+        },
+    }
+    assert decode_frames(MSGPACK.encode_event(event)) == [
+        {
+            "event": "on_chat_model_stream",
+            "data": {"chunk": {"content": "Hello", "additional_kwargs": {}}},
+        }
+    ]
+
+
+def test_tool_end_events_keep_the_tool_message() -> None:
+    """Test that a tool message can be rebuilt from a slimmed event."""
+    output = ToolMessage(content="docs", tool_call_id="call-1", name="retrieve")
+    event = {
+        "event": "on_tool_end",
+        "name": "retrieve",
+        "run_id": "run",
+        "data": {"input": {"query": "q"}, "output": output},
+    }
+    slimmed = slim_event(event)
+    assert slimmed["data"]["input"] == {"query": "q"}
+    assert ToolMessage(**slimmed["data"]["output"]) == output
+
+
+def test_metadata_and_end_frames() -> None:
+    """Test the frames opening and closing a stream."""
+    body = MSGPACK.encode_metadata("run", 3) + MSGPACK.end_frame
+    assert decode_frames(body) == [
+        {"event": "metadata", "data": {"run_id": "run", "session_version": 3}},
+        {"event": "end"},
+    ]
+
+
+@pytest.mark.parametrize(
+    "accept, expected",
+    [
+        (None, False),
+        ("text/event-stream", False),
+        ("application/x-msgpack, text/event-stream;q=0.5", True),
+        ("application/x-msgpack;q=0", False),
+    ],
+)
+def test_accepts_msgpack(accept: Optional[str], expected: bool) -> None:
+    """Test that only clients asking for MessagePack get it."""
+    assert accepts_msgpack(accept) is expected
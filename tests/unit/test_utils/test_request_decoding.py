@@ -0,0 +1,130 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from typing import Any, Dict, List
+
+from app.utils.input_types import Input
+from app.utils.request_decoding import RequestDecoder
+from fastapi.exceptions import RequestValidationError
+import pytest
+
+
+def body(messages: List[Dict[str, Any]], **fields: Any) -> bytes:
+    """Encode a request body."""
+    return json.dumps({"input": {"messages": messages, **fields}}).encode()
+
+
+HISTORY = [
+    {"type": "human", "content": "Hi"},
+    {"type": "ai", "content": "Hello!"},
+    {"type": "human", "content": "How are you?"},
+]
+
+
+def test_decode_matches_pydantic_validation() -> None:
+    """Test that the decoded input equals the one validated by pydantic."""
+    raw = body(HISTORY, user_id="user", session_id="session")
+    decoded = RequestDecoder().decode(raw)
+    for message in decoded.input.messages:
+        message.id = None
+    assert decoded == Input.model_validate_json(raw)
+
+
+def test_seen_prefixes_are_reused() -> None:
+    """Test that only the messages of a new history suffix are validated."""
+    decoder = RequestDecoder()
+    decoder.decode(body(HISTORY[:2]))
+    assert decoder.stats()["misses"] == 2
+    decoder.decode(body(HISTORY))
+    assert decoder.stats()["hits"] == 2
+    assert decoder.stats()["misses"] == 3
+    # The same message after another history is a different entry
+    decoder.decode(body(HISTORY[1:]))
+    assert decoder.stats()["misses"] == 5
+
+
+def test_reused_messages_have_stable_ids() -> None:
+    """Test that messages get an id once, so the chain never assigns one."""
+    decoder = RequestDecoder()
+    first = decoder.decode(body(HISTORY)).input.messages
+    second = decoder.decode(body(HISTORY)).input.messages
+    assert all(message.id for message in first)
+    assert [m.id for m in first] == [m.id for m in second]
+
+
+def test_deltas_of_other_sessions_are_other_messages() -> None:
+    """Test that identical deltas only share a message when they follow the
+    same stored history."""
+    decoder = RequestDecoder()
+    yes = [{"type": "human", "content": "yes"}]
+
+    def decode(session_id: str, version: int) -> Any:
+        raw = body(yes, user_id="user", session_id=session_id, session_version=version)
+        return decoder.decode(raw).input.messages[0]
+
+    first = decode("s1", 1)
+    assert decode("s1", 1) is first
+    ids = {first.id, decode("s1", 2).id, decode("s2", 1).id}
+    assert len(ids) == 3
+    # A connection may omit the version of the sessions it remembers
+    payload = {"input": {"messages": yes, "user_id": "user", "session_id": "s1"}}
+    delta = decoder.decode_payload(payload, {"user:s1": 1}).input
+    assert delta.session_version == 1
+    assert delta.messages[0] is first
+
+
+def test_cache_is_bounded_by_size() -> None:
+    """Test that large messages evict older ones, or are not kept at all."""
+    decoder = RequestDecoder(max_bytes=1000)
+    small = {"type": "human", "content": "Hi"}
+    decoder.decode(body([small]))
+    decoder.decode(body([{"type": "human", "content": "x" * 2000}]))
+    assert decoder.stats()["messages"] == 1
+    decoder.decode(body([{"type": "human", "content": "x" * 960}]))
+    # The first message was evicted to make room for the second one
+    assert decoder.stats()["messages"] == 1
+    assert 900 < decoder.stats()["bytes"] <= 1000
+    decoder.decode(body([small]))
+    assert decoder.hits == 0
+
+
+def test_leftover_tool_calls_are_dropped() -> None:
+    """Test that tool calls attached to human messages are removed."""
+    message = {
+        "type": "human",
+        "content": "Hi",
+        "additional_kwargs": {"tool_calls": [{"id": "1"}]},
+    }
+    decoded = RequestDecoder().decode(body([message])).input.messages[0]
+    assert decoded.additional_kwargs == {}
+
+
+@pytest.mark.parametrize(
+    "raw, loc",
+    [
+        (b"{not json", ("body", 0)),
+        (
+            body([{"type": "unknown", "content": "Hi"}]),
+            ("body", "input", "messages", 0),
+        ),
+        (body(HISTORY, session_version=-1), ("body", "input", "session_version")),
+        (b'{"messages": []}', ("body", "input")),
+    ],
+)
+def test_invalid_bodies_raise_validation_errors(raw: bytes, loc: tuple) -> None:
+    """Test that errors are reported with FastAPI locations."""
+    with pytest.raises(RequestValidationError) as e:
+        RequestDecoder().decode(raw)
+    assert e.value.errors()[0]["loc"] == loc
@@ -0,0 +1,93 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pathlib import Path
+
+from app.utils.session_store import SessionStore, StaleSessionError
+from langchain_core.messages import AIMessage, HumanMessage
+import pytest
+
+
+def test_deltas_rebuild_the_history() -> None:
+    """Test that deltas are appended to the stored history."""
+    store = SessionStore(":memory:")
+    version, history = store.apply("session", 0, [HumanMessage("Hi")])
+    version, history = store.apply(
+        "session", version, [AIMessage("Hello"), HumanMessage("How are you?")]
+    )
+    assert version == 2
+    assert [m.content for m in history] == ["Hi", "Hello", "How are you?"]
+
+
+def test_stale_version_is_rejected() -> None:
+    """Test that a delta based on an outdated version is rejected."""
+    store = SessionStore(":memory:")
+    store.apply("session", 0, [HumanMessage("Hi")])
+    store.apply("session", 1, [AIMessage("Hello")])
+    with pytest.raises(StaleSessionError) as e:
+        store.apply("session", 1, [HumanMessage("Again")])
+    assert e.value.current_version == 2
+    with pytest.raises(StaleSessionError):
+        store.apply("unknown", 1, [HumanMessage("Hi")])
+
+
+def test_version_zero_replaces_the_history() -> None:
+    """Test that a full resend replaces the stored history."""
+    store = SessionStore(":memory:")
+    store.apply("session", 0, [HumanMessage("Hi"), AIMessage("Hello")])
+    version, history = store.apply("session", 0, [HumanMessage("Hey")])
+    assert version == 2
+    assert [m.content for m in history] == ["Hey"]
+
+
+def test_sessions_survive_eviction_and_restart(tmp_path: Path) -> None:
+    """Test that evicted sessions are reloaded from SQLite."""
+    path = str(tmp_path / "sessions.sqlite")
+    store = SessionStore(path, max_sessions=1)
+    store.apply("a", 0, [HumanMessage("Hi"), AIMessage("Hello")])
+    store.apply("b", 0, [HumanMessage("Other")])
+    assert store.stats()["sessions_in_memory"] == 1
+    store.close()
+
+    store = SessionStore(path, max_sessions=1)
+    version, history = store.apply("a", 1, [HumanMessage("Again")])
+    assert version == 2
+    assert history == [HumanMessage("Hi"), AIMessage("Hello"), HumanMessage("Again")]
+
+
+def test_stores_sharing_a_database_stay_consistent(tmp_path: Path) -> None:
+    """Test that a store sees the turns written by another process' store."""
+    path = str(tmp_path / "sessions.sqlite")
+    first, second = SessionStore(path), SessionStore(path)
+    version, _ = first.apply("session", 0, [HumanMessage("Hi")])
+    assert second.apply("session", version, [AIMessage("Hello")])[0] == 2
+    # The history held in memory by the first store is outdated
+    with pytest.raises(StaleSessionError):
+        first.apply("session", version, [AIMessage("Hey")])
+    version, history = first.apply("session", 2, [HumanMessage("How are you?")])
+    assert [m.content for m in history] == ["Hi", "Hello", "How are you?"]
+
+
+def test_abandoned_sessions_expire() -> None:
+    """Test that sessions not updated within the ttl are deleted."""
+    store = SessionStore(":memory:", ttl=60, prune_interval=0)
+    store.apply("old", 0, [HumanMessage("Hi")])
+    with store._db:
+        store._db.execute("UPDATE sessions SET updated_at = updated_at - 120")
+    store.apply("new", 0, [HumanMessage("Hey")])
+    assert store.stats()["expired"] == 1
+    assert store._db.execute("SELECT key FROM sessions").fetchall() == [("new",)]
+    assert store._db.execute("SELECT key FROM messages").fetchall() == [("new",)]
+    with pytest.raises(StaleSessionError):
+        store.apply("old", 1, [AIMessage("Hello")])
@@ -0,0 +1,86 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from typing import AsyncGenerator, List
+
+from app.utils.single_flight import SingleFlight
+import pytest
+
+
+class Upstream:
+    """An upstream stream emitting items when released."""
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.closed = False
+        self.release = asyncio.Event()
+
+    async def stream(self) -> AsyncGenerator[str, None]:
+        self.calls += 1
+        try:
+            yield "a"
+            await self.release.wait()
+            yield "b"
+        finally:
+            self.closed = True
+
+
+async def collect(stream: AsyncGenerator[str, None]) -> List[str]:
+    """Read a stream to the end."""
+    return [item async for item in stream]
+
+
+@pytest.mark.asyncio
+async def test_late_subscriber_replays_buffered_items() -> None:
+    """Test that identical requests share one upstream stream."""
+    flights: SingleFlight[str] = SingleFlight()
+    upstream = Upstream()
+    first = asyncio.create_task(collect(flights.subscribe("key", upstream.stream)))
+    await asyncio.sleep(0.01)
+    second = asyncio.create_task(collect(flights.subscribe("key", upstream.stream)))
+    await asyncio.sleep(0.01)
+    upstream.release.set()
+
+    assert await first == ["a", "b"]
+    assert await second == ["a", "b"]
+    assert upstream.calls == 1
+    assert flights.stats() == {"in_flight": 0, "started": 1, "joined": 1}
+
+
+@pytest.mark.asyncio
+async def test_upstream_is_cancelled_without_subscribers() -> None:
+    """Test that the upstream stops once every subscriber has gone."""
+    flights: SingleFlight[str] = SingleFlight()
+    upstream = Upstream()
+    stream = flights.subscribe("key", upstream.stream)
+    assert await stream.__anext__() == "a"
+    await stream.aclose()
+    await asyncio.sleep(0.01)
+    assert upstream.closed
+    assert flights.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_errors_reach_every_subscriber() -> None:
+    """Test that an upstream failure is raised to the subscribers."""
+    flights: SingleFlight[str] = SingleFlight()
+
+    async def failing() -> AsyncGenerator[str, None]:
+        yield "a"
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        await collect(flights.subscribe("key", failing))
+    assert flights.in_flight == 0
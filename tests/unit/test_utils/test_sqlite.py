@@ -0,0 +1,49 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from app.utils.sqlite import ProcessConnection
+
+
+def test_connection_is_reopened_after_a_fork(tmp_path: Path) -> None:
+    """Test that a forked process opens its own connection, once."""
+    on_fork = MagicMock()
+    connection = ProcessConnection(str(tmp_path / "db.sqlite"), on_fork=on_fork)
+    parent = connection.get()
+    assert connection.get() is parent
+    on_fork.assert_not_called()
+
+    with patch("os.getpid", return_value=os.getpid() + 1):
+        child = connection.get()
+        assert child is not parent
+        assert connection.get() is child
+    on_fork.assert_called_once_with()
+
+
+def test_connection_is_used_as_the_sqlite_connection(tmp_path: Path) -> None:
+    """Test that queries and transactions go to the connection of the process."""
+    db = ProcessConnection(str(tmp_path / "db.sqlite"))
+    with db:
+        db.execute("CREATE TABLE t (x INTEGER)")
+        db.execute("INSERT INTO t VALUES (1)")
+    try:
+        with db:
+            db.execute("INSERT INTO t VALUES (2)")
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert db.execute("SELECT x FROM t").fetchall() == [(1,)]
@@ -0,0 +1,136 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+from typing import Any, Dict, List
+
+from app.utils.tool_executor import ConcurrentToolNode
+from langchain_core.messages import AIMessage
+from langchain_core.tools import tool
+import pytest
+
+cancelled: List[str] = []
+
+
+@tool
+async def sleep(seconds: float) -> str:
+    """Sleep for a number of seconds."""
+    try:
+        await asyncio.sleep(seconds)
+    except asyncio.CancelledError:
+        cancelled.append(f"sleep {seconds:g}")
+        raise
+    return f"slept {seconds}"
+
+
+@tool
+async def fail(message: str) -> str:
+    """Fail with a message."""
+    raise RuntimeError(message)
+
+
+@tool
+def blocking_sleep(seconds: float) -> str:
+    """Sleep for a number of seconds in a thread."""
+    time.sleep(seconds)
+    return f"slept {seconds}"
+
+
+def calls(*calls: Any) -> Dict[str, List[AIMessage]]:
+    """Build a state whose last message calls tools with the given arguments."""
+    return {
+        "messages": [
+            AIMessage(
+                content="",
+                tool_calls=[
+                    {"name": name, "args": args, "id": str(i)}
+                    for i, (name, args) in enumerate(calls)
+                ],
+            )
+        ]
+    }
+
+
+@pytest.mark.asyncio
+async def test_calls_run_concurrently_in_order() -> None:
+    """Test that the stage takes the longest call and keeps the call order."""
+    node = ConcurrentToolNode([sleep])
+    start = time.perf_counter()
+    output = await node.ainvoke(calls(*[("sleep", {"seconds": 0.2})] * 3))
+    assert time.perf_counter() - start < 0.4
+    assert [m.tool_call_id for m in output["messages"]] == ["0", "1", "2"]
+    assert [m.content for m in output["messages"]] == ["slept 0.2"] * 3
+
+
+@pytest.mark.asyncio
+async def test_concurrency_is_capped() -> None:
+    """Test that no more than `max_concurrency` calls run at once."""
+    node = ConcurrentToolNode([sleep], max_concurrency=1)
+    start = time.perf_counter()
+    await node.ainvoke(calls(*[("sleep", {"seconds": 0.1})] * 3))
+    assert time.perf_counter() - start >= 0.3
+
+
+@pytest.mark.asyncio
+async def test_slow_calls_time_out() -> None:
+    """Test that a call past its tool deadline is cancelled and reported."""
+    cancelled.clear()
+    node = ConcurrentToolNode([sleep], timeout=5, timeouts={"sleep": 0.1})
+    start = time.perf_counter()
+    output = await node.ainvoke(
+        calls(("sleep", {"seconds": 0.01}), ("sleep", {"seconds": 10}))
+    )
+    assert time.perf_counter() - start < 1
+    fast, slow = output["messages"]
+    assert fast.content == "slept 0.01"
+    assert slow.status == "error"
+    assert slow.content == "Error: sleep timed out after 0.1s."
+    assert cancelled == ["sleep 10"]
+
+
+@pytest.mark.asyncio
+async def test_unhandled_errors_cancel_other_calls() -> None:
+    """Test that an unhandled tool error stops the calls still running."""
+    cancelled.clear()
+    node = ConcurrentToolNode([sleep, fail], handle_tool_errors=False)
+    with pytest.raises(RuntimeError, match="boom"):
+        await node.ainvoke(
+            calls(("sleep", {"seconds": 10}), ("fail", {"message": "boom"}))
+        )
+    assert cancelled == ["sleep 10"]
+
+
+@pytest.mark.asyncio
+async def test_handled_errors_are_reported() -> None:
+    """Test that tool errors and unknown tools are answered like ToolNode does."""
+    node = ConcurrentToolNode([fail])
+    output = await node.ainvoke(calls(("fail", {"message": "boom"}), ("nope", {})))
+    error, unknown = output["messages"]
+    assert error.status == "error" and "boom" in error.content
+    assert unknown.status == "error" and "nope" in unknown.content
+
+
+def test_sync_calls_time_out() -> None:
+    """Test that sync runs answer timed out calls without waiting for them."""
+    node = ConcurrentToolNode([blocking_sleep], timeout=0.1)
+    start = time.perf_counter()
+    output = node.invoke(
+        calls(
+            ("blocking_sleep", {"seconds": 0.01}),
+            ("blocking_sleep", {"seconds": 0.5}),
+        )
+    )
+    assert time.perf_counter() - start < 0.4
+    assert [m.status for m in output["messages"]] == ["success", "error"]
@@ -0,0 +1,66 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from app.utils.tool_loop import ToolLoop
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langgraph.graph import END
+import pytest
+
+CALL = AIMessage(content="", tool_calls=[{"name": "search", "args": {}, "id": "call"}])
+
+
+def test_tools_are_allowed_until_the_budget_is_spent() -> None:
+    """Test that the call after the last tool round is made without tools."""
+    loop = ToolLoop(max_tool_rounds=2)
+    assert [loop.tools_allowed(calls) for calls in range(4)] == [
+        True,
+        True,
+        False,
+        False,
+    ]
+    assert not ToolLoop(max_tool_rounds=0).tools_allowed(0)
+
+
+def test_route_to_tools_only_within_the_budget() -> None:
+    """Test that tool calls are run while the budget allows it."""
+    loop = ToolLoop(max_tool_rounds=2)
+    assert loop.route([HumanMessage(content="hi"), CALL], llm_calls=1) == "tools"
+    assert loop.route([HumanMessage(content="hi"), CALL], llm_calls=2) == "tools"
+    assert loop.route([HumanMessage(content="hi"), CALL], llm_calls=3) == END
+    assert loop.route([AIMessage(content="answer")], llm_calls=1) == END
+    assert loop.route([ToolMessage(content="", tool_call_id="call")], 1) == END
+    assert loop.route([], llm_calls=0) == END
+
+
+def test_count_model_and_tool_calls() -> None:
+    """Test that a model call and the tool calls it requests are counted."""
+    loop = ToolLoop()
+    two_calls = AIMessage(
+        content="",
+        tool_calls=[
+            {"name": "search", "args": {}, "id": "1"},
+            {"name": "search", "args": {}, "id": "2"},
+        ],
+    )
+    assert loop.count(1, 1, [two_calls]) == {"llm_calls": 2, "tool_calls": 3}
+    assert loop.count(2, 3, [AIMessage(content="answer")]) == {
+        "llm_calls": 3,
+        "tool_calls": 3,
+    }
+
+
+def test_negative_budget_is_rejected() -> None:
+    """Test that the tool budget cannot be negative."""
+    with pytest.raises(ValueError):
+        ToolLoop(max_tool_rounds=-1)